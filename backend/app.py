@@ -1,30 +1,77 @@
 # app.py
 
 # poetry run uvicorn app:app --reload --host 0.0.0.0 --port 8080
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, status
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+import asyncio
 import os
+import re
 import threading
+import time
 import logging
 import numpy as np
 import cv2  # OpenCV のインポートを追加
 from PIL import Image
 
 from db.client import MongoDBClient, get_client
-from utils.face import FaceRecognition
-
-app = FastAPI()
+from utils.embedding import create_engine
+from utils.face import FaceRecognition, FaceResult
+from utils.frame_store import FrameStore
+from utils.jpeg import decode_jpeg, detection_scale, encode_jpeg, jpeg_size
+from utils.shared_frames import SharedFrameRing, segment_name
+from utils.metrics import CONTENT_TYPE, REGISTRY, STEP_SECONDS, counter, histogram, render, sampled
+from utils.worker import InferencePool, PoolSaturated
 
 LATEST_FRAME_PATH = "./latest_frame.jpg"
+DEFAULT_CAMERA_ID = "default"
+CAMERA_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
 REGISTERED_FACES_DIR = "./registered_faces"
+# 0 より大きい場合、最新フレームをこの間隔 (秒) で LATEST_FRAME_PATH (既定のカメラ以外は
+# latest_frame_<camera_id>.jpg) に書き出します
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", "0"))
+
+# 推論プールの設定 (INFERENCE_EXECUTOR は "thread" または "process")
+INFERENCE_EXECUTOR = os.environ.get("INFERENCE_EXECUTOR", "thread")
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "2"))
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "4"))
+RETRY_AFTER_SECONDS = 1
+
+# 特徴ベクトルを求めるエンジン (EMBEDDING_ENGINE は "deepface" または "onnx")
+EMBEDDING_ENGINE = os.environ.get("EMBEDDING_ENGINE", "deepface")
+EMBEDDING_MODEL_PATH = os.environ.get("EMBEDDING_MODEL_PATH")
+EMBEDDING_QUANTIZE = os.environ.get("EMBEDDING_QUANTIZE", "0") == "1"
+EMBEDDING_THREADS = int(os.environ.get("EMBEDDING_THREADS", "0"))
+# EMBEDDING_ENGINE=stub のときに 1 回の推論で待つ時間 (ミリ秒)
+EMBEDDING_STUB_DELAY_MS = float(os.environ.get("EMBEDDING_STUB_DELAY_MS", "0"))
+
+# 顔検出は幅がこの値以上残る範囲で縮小デコードした画像で行います (0 なら常に元の大きさ)
+DETECTION_MIN_WIDTH = int(os.environ.get("DETECTION_MIN_WIDTH", "640"))
+# アノテーションしたフレームを再エンコードするときの画質
+ANNOTATION_JPEG_QUALITY = int(os.environ.get("ANNOTATION_JPEG_QUALITY", "80"))
+# 送信側に伝えるフレームの最大幅と画質 (0 なら伝えません)。カメラ側の設定と小さい方が使われます
+UPLOAD_MAX_WIDTH = int(os.environ.get("UPLOAD_MAX_WIDTH", "0"))
+UPLOAD_JPEG_QUALITY = int(os.environ.get("UPLOAD_JPEG_QUALITY", "0"))
+
+# 同じホストの image_process から共有メモリでフレームを受け取るカメラ (カンマ区切り、空なら使いません)
+SHM_CAMERAS = [camera_id for camera_id in os.environ.get("SHM_CAMERAS", "").split(",")
+               if CAMERA_ID_PATTERN.match(camera_id)]
+SHM_POLL_INTERVAL = float(os.environ.get("SHM_POLL_INTERVAL", "0.005"))
+# 顔が無いフレームを JPEG にして最新フレームとして公開する間隔 (秒)。顔があるフレームは毎回公開します
+SHM_PUBLISH_INTERVAL = float(os.environ.get("SHM_PUBLISH_INTERVAL", "0.2"))
 
 logging.basicConfig(level=logging.INFO)
-latest_frame_lock = threading.RLock()
 detection_lock = threading.RLock()
 registration_lock = threading.RLock()
 
-latest_detection = None
+# カメラごとの最新の検出データと最新フレーム
+latest_detections = {}
+frame_stores = {}
+
+REQUEST_SECONDS = histogram("http_request_seconds", "Time spent handling HTTP requests", ("route", "status"))
+INFERENCE_REJECTED = counter("inference_rejected_total", "Frames rejected because the inference pool was full")
 
 class DetectionData(BaseModel):
     status: str
@@ -36,104 +83,481 @@ class DetectionData(BaseModel):
             "detail": self.detail
         }
 
-# MongoDBクライアントのインスタンス化
-mongo_client = get_client("face")
-db = mongo_client.connect()
+def check_camera_id(camera_id: str) -> str:
+    if not CAMERA_ID_PATTERN.match(camera_id):
+        raise HTTPException(status_code=400, detail="Invalid camera_id")
+    return camera_id
+
+
+def get_frame_store(camera_id: str) -> FrameStore:
+    """
+    カメラの FrameStore を返します。初めて使うカメラの場合は作成します。
+    """
+    store = frame_stores.get(camera_id)
+    if store is None:
+        if camera_id == DEFAULT_CAMERA_ID:
+            snapshot_path = LATEST_FRAME_PATH
+        else:
+            snapshot_path = f"./latest_frame_{camera_id}.jpg"
+        store = FrameStore(snapshot_path=snapshot_path, snapshot_interval=SNAPSHOT_INTERVAL)
+        frame_stores[camera_id] = store
+    return store
+
+# MongoDB クライアント・顔認識・推論プールは起動後に load_models で作ります。
+# モジュールの import を軽くし、モデルの読み込み中も /healthz に応答できるようにするためです
+mongo_client: Optional[MongoDBClient] = None
+face_recognition: Optional[FaceRecognition] = None
+inference_pool: Optional[InferencePool] = None
+ready = False
+startup_error: Optional[str] = None
+
+
+def create_face_recognition(client: MongoDBClient) -> FaceRecognition:
+    engine = create_engine(EMBEDDING_ENGINE, model_path=EMBEDDING_MODEL_PATH, quantize=EMBEDDING_QUANTIZE,
+                           intra_op_threads=EMBEDDING_THREADS, stub_delay=EMBEDDING_STUB_DELAY_MS / 1000)
+    return FaceRecognition(client, engine=engine)
+
+
+def init_inference_worker():
+    """
+    プロセスプールの各ワーカーで FaceRecognition を作り直します。
+    """
+    global face_recognition
+    face_recognition = create_face_recognition(get_client("face"))
+
+
+def warmup_worker() -> None:
+    """
+    ダミーのフレームでデコードから JPEG のエンコードまでを一通り実行し、
+    モデルのグラフ構築やメモリ確保を最初のリクエストの前に済ませます。
+    """
+    face_recognition.warmup()
+    process_frame(encode_jpeg(np.zeros((480, 640, 3), dtype=np.uint8)))
+
+
+def process_frame(image_data: bytes) -> Optional[Tuple[bytes, List[FaceResult], Dict[str, float]]]:
+    """
+    JPEG のデコード・顔認識・アノテーション・エンコードを推論プール上で行います。
+    デコードに失敗した場合は None を返します。
+
+    顔検出は縮小デコードした画像で行い、アノテーションは元の大きさの画像に描きます。
+    顔が無い場合はデコードし直さず、受け取った JPEG をそのまま返します。
+
+    各段階の秒数も返し、呼び出し側 (メインプロセス) で記録します。
+    プロセスプールのワーカーで記録しても /metrics には現れないためです。
+    """
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    size = jpeg_size(image_data)
+    scale = detection_scale(size[0], DETECTION_MIN_WIDTH) if size is not None else 1
+    frame = decode_jpeg(image_data, scale)
+    timings["decode"] = time.perf_counter() - start
+    if frame is None:
+        return None
+
+    # 顔検出とユーザーの確認を一度に行う
+    faces = face_recognition.recognize_faces(frame, timings)
+    if not faces:
+        return image_data, faces, timings
+    if scale != 1:
+        faces = [face._replace(box=tuple(int(v * scale) for v in face.box)) for face in faces]
+    for face in faces:
+        if sampled("detected_person"):
+            logging.debug(f"Detected person: {face.name} (similarity: {face.score:.3f})")
+
+    # 検出結果を使って元の大きさのフレームにアノテーションを追加
+    if scale != 1:
+        start = time.perf_counter()
+        frame = decode_jpeg(image_data)
+        timings["decode"] += time.perf_counter() - start
+        if frame is None:
+            return None
+    start = time.perf_counter()
+    annotated_frame = face_recognition.annotate_frame(frame, faces)
+    timings["annotation"] = time.perf_counter() - start
+    start = time.perf_counter()
+    jpeg = encode_jpeg(annotated_frame, ANNOTATION_JPEG_QUALITY)
+    timings["encode"] = time.perf_counter() - start
+    return jpeg, faces, timings
+
+
+# 推論を行うプロセスごとに開いた共有メモリ (カメラの識別子 → リング)
+shared_rings = {}
+
+
+def get_shared_ring(camera_id: str, token: int) -> SharedFrameRing:
+    """
+    カメラの共有メモリを返します。image_process が作り直していれば (token が違えば) 開き直します。
+    """
+    ring = shared_rings.get(camera_id)
+    if ring is None or ring.token != token:
+        if ring is not None:
+            ring.close()
+        ring = shared_rings[camera_id] = SharedFrameRing.attach(segment_name(camera_id))
+    return ring
+
+
+def process_shared_frame(camera_id: str, token: int, seq: int,
+                         encode: bool) -> Optional[Tuple[Optional[bytes], List[FaceResult], Dict[str, float], dict]]:
+    """
+    共有メモリ上のフレームをコピーもデコードもせずに顔認識します。
+    アノテーションとエンコードは、顔がある場合か encode=True の場合だけ行います。
+    フレームが処理中に上書きされた場合は None を返します。
+    """
+    timings: Dict[str, float] = {}
+    shared = get_shared_ring(camera_id, token).read(seq)
+    if shared is None:
+        return None
+
+    faces = face_recognition.recognize_faces(shared.frame, timings)
+    jpeg = None
+    if faces or encode:
+        start = time.perf_counter()
+        # 共有メモリには書き込めないので、描画はコピーに対して行います
+        annotated_frame = face_recognition.annotate_frame(shared.frame.copy(), faces)
+        timings["annotation"] = time.perf_counter() - start
+        start = time.perf_counter()
+        jpeg = encode_jpeg(annotated_frame, ANNOTATION_JPEG_QUALITY)
+        timings["encode"] = time.perf_counter() - start
+    if not shared.valid():
+        return None
+    return jpeg, faces, timings, shared.metadata
+
+
+async def receive_shared_frames(camera_id: str) -> None:
+    """
+    カメラの共有メモリを監視し、新しいフレームを推論プールで処理します。
+    処理中に届いたフレームは読み飛ばし、常に最新のフレームを処理します。
+    """
+    ring: Optional[SharedFrameRing] = None
+    last_seq = 0
+    last_publish = 0.0
+    try:
+        while True:
+            if ring is None:
+                try:
+                    ring = SharedFrameRing.attach(segment_name(camera_id))
+                except FileNotFoundError:
+                    await asyncio.sleep(1.0)
+                    continue
+                # 開く前のフレームは古いので処理しません
+                last_seq = ring.latest_seq
+                logging.info(f"Receiving frames from shared memory for camera {camera_id}")
+
+            # image_process が終了または再起動した場合だけ開き直します (新しいフレームが無いだけなら待ちます)
+            if ring.closed:
+                logging.info(f"Shared memory for camera {camera_id} was closed by the writer, reattaching")
+                ring.close()
+                ring = None
+                continue
+            ring.heartbeat()
+            seq = ring.latest_seq
+            if seq == last_seq or not ready:
+                await asyncio.sleep(SHM_POLL_INTERVAL)
+                continue
+            last_seq = seq
+            if inference_pool.saturated:
+                # HTTP で 503 を返す場合と同じく、プールが満杯で捨てたフレームとして数えます
+                INFERENCE_REJECTED.inc()
+                await asyncio.sleep(SHM_POLL_INTERVAL)
+                continue
+
+            encode = time.monotonic() - last_publish >= SHM_PUBLISH_INTERVAL
+            try:
+                result = await inference_pool.run(process_shared_frame, camera_id, ring.token, seq, encode)
+            except PoolSaturated:
+                INFERENCE_REJECTED.inc()
+                continue
+            except Exception as e:
+                logging.error(f"Error processing shared frame: {e}")
+                continue
+            if result is None:
+                continue
+
+            jpeg, faces, timings, metadata = result
+            record_timings(timings)
+            detection = {key: metadata[key] for key in ("status", "detail") if key in metadata}
+            if jpeg is not None:
+                publish_frame(camera_id, jpeg, faces, detection)
+                last_publish = time.monotonic()
+            if detection.keys() == {"status", "detail"}:
+                with detection_lock:
+                    latest_detections[camera_id] = DetectionData(**detection)
+    finally:
+        if ring is not None:
+            ring.close()
+
+
+async def load_models() -> None:
+    """
+    データベースへの接続・モデルの読み込み・ウォームアップをイベントループの外で行い、
+    完了したら ready にします。
+    """
+    global mongo_client, face_recognition, inference_pool, ready, startup_error
+    try:
+        start = time.perf_counter()
+        mongo_client = get_client("face")
+        face_recognition = await asyncio.to_thread(create_face_recognition, mongo_client)
+
+        use_processes = INFERENCE_EXECUTOR == "process"
+        inference_pool = InferencePool(
+            max_workers=INFERENCE_WORKERS,
+            max_pending=INFERENCE_QUEUE_SIZE,
+            use_processes=use_processes,
+            initializer=init_inference_worker if use_processes else None
+        )
+        # ワーカーの数だけ同時に投入し、プロセスプールでは全てのワーカーを起動して温めます
+        await asyncio.gather(*(inference_pool.run(warmup_worker) for _ in range(INFERENCE_WORKERS)))
+
+        ready = True
+        logging.info(f"Models loaded and warmed up in {time.perf_counter() - start:.1f}s")
+    except Exception as e:
+        startup_error = str(e)
+        logging.error(f"Failed to load models: {e}")
+
+
+def add_upload_hints(response: Response) -> None:
+    """
+    送信側がフレームの大きさと画質を合わせられるよう、サーバーの希望をヘッダーで返します。
+    """
+    if UPLOAD_MAX_WIDTH:
+        response.headers["X-Upload-Max-Width"] = str(UPLOAD_MAX_WIDTH)
+    if UPLOAD_JPEG_QUALITY:
+        response.headers["X-Upload-Quality"] = str(UPLOAD_JPEG_QUALITY)
+
+
+def require_ready() -> None:
+    if not ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Models are loading. Retry later.",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loader = asyncio.create_task(load_models())
+    receivers = [asyncio.create_task(receive_shared_frames(camera_id)) for camera_id in SHM_CAMERAS]
+    yield
+    if not loader.done():
+        loader.cancel()
+    for receiver in receivers:
+        receiver.cancel()
+    if inference_pool is not None:
+        inference_pool.shutdown()
+    for store in frame_stores.values():
+        store.close()
+    for ring in shared_rings.values():
+        ring.close()
+    if face_recognition is not None:
+        face_recognition.close()
+    if mongo_client is not None:
+        mongo_client.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def record_request_time(request: Request, call_next):
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # パスではなくルートのテンプレートで数え、ラベルの種類が増え続けないようにします
+        route = request.scope.get("route")
+        REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                route=route.path if route is not None else "unmatched", status=status_code)
+
+
+async def run_inference(camera_id: str, image_data: bytes, detection: Optional[dict] = None) -> List[FaceResult]:
+    """
+    フレームを推論プールで処理し、アノテーション済みのフレームを検出結果と一緒に
+    カメラの最新フレームとして保持します。
+    プールが満杯の場合やモデルの読み込み中は 503 と Retry-After を返してクライアントに間引きを促します。
+    """
+    require_ready()
+    try:
+        result = await inference_pool.run(process_frame, image_data)
+    except PoolSaturated:
+        INFERENCE_REJECTED.inc()
+        if sampled("pool_saturated", every=10):
+            logging.warning("Inference pool saturated, dropping frame")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Inference queue is full. Retry later.",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+
+    if result is None:
+        logging.error("Failed to decode image")
+        raise HTTPException(status_code=400, detail="Failed to decode image. Ensure the image is valid.")
+
+    jpeg, faces, timings = result
+    record_timings(timings)
+    publish_frame(camera_id, jpeg, faces, detection)
+    return faces
+
+
+def record_timings(timings: Dict[str, float]) -> None:
+    for step, seconds in timings.items():
+        STEP_SECONDS.observe(seconds, step=step)
+
+
+def publish_frame(camera_id: str, jpeg: bytes, faces: List[FaceResult], detection: Optional[dict] = None) -> None:
+    """
+    アノテーション済みのフレームを検出結果と一緒にカメラの最新フレームとして保持します。
+    """
+    detection = dict(detection or {})
+    detection["faces"] = [face.to_dict() for face in faces]
+    get_frame_store(camera_id).publish(jpeg, detection)
+
+
+@app.get("/healthz")
+async def healthz():
+    """
+    プロセスが応答できることだけを返します (liveness)。
+    """
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    モデルの読み込みとウォームアップが終わり、フレームを処理できるかを返します (readiness)。
+    """
+    if not ready:
+        content = {"status": "error" if startup_error else "starting"}
+        if startup_error:
+            content["detail"] = startup_error
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=content)
+    return {"status": "ready", "engine": face_recognition.engine.name}
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    処理時間やエラーの数を Prometheus のテキスト形式で返します。
+    """
+    return Response(render({None: REGISTRY.snapshot()}), media_type=CONTENT_TYPE)
 
-# FaceRecognitionクラスのインスタンス化
-face_recognition = FaceRecognition(mongo_client)
 
 @app.post("/upload_frame")
-async def upload_frame(image: UploadFile = File(...)):
+async def upload_frame(response: Response, image: UploadFile = File(...),
+                       camera_id: str = Form(DEFAULT_CAMERA_ID)):
+    check_camera_id(camera_id)
     if image.content_type not in ["image/jpeg", "image/jpg"]:
         logging.error("Invalid image type")
         raise HTTPException(status_code=400, detail="Invalid image type")
     
     try:
-        # 画像を読み込み、OpenCVの形式に変換
         image_data = await image.read()
-        np_arr = np.frombuffer(image_data, np.uint8)
-        frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-
-        if frame is None:
-            logging.error("Failed to decode image")
-            raise HTTPException(status_code=400, detail="Failed to decode image. Ensure the image is valid.")
-
-        # ユーザーの確認
-        name, similarity = face_recognition.verify_user(frame)
-        logging.info(f"Detected person: {name} (similarity: {similarity:.3f})")
-
-        # フレームにアノテーションを追加
-        annotated_frame = face_recognition.annotate_frame(frame, name)
-
-        # アノテーションが追加されたフレームを保存
-        with latest_frame_lock:
-            cv2.imwrite(LATEST_FRAME_PATH, annotated_frame)
-        logging.info("Frame received, processed, and saved with annotations")
+        await run_inference(camera_id, image_data)
+        add_upload_hints(response)
+        if sampled("upload_frame"):
+            logging.debug("Frame received, processed, and saved with annotations")
         return {"message": "Frame received, processed, and saved with annotations"}
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error processing image: {e}")
         raise HTTPException(status_code=500, detail="Failed to process and save image")
 
-@app.get("/get_frame", response_class=FileResponse)
-async def get_frame():
-    with latest_frame_lock:
-        if not os.path.exists(LATEST_FRAME_PATH):
-            logging.error("No frame available")
-            raise HTTPException(status_code=404, detail="No frame available")
-        return FileResponse(LATEST_FRAME_PATH, media_type="image/jpeg", filename="latest_frame.jpg")
+@app.get("/get_frame")
+async def get_frame(request: Request, camera_id: str = Query(DEFAULT_CAMERA_ID)):
+    store = frame_stores.get(check_camera_id(camera_id))
+    snapshot = None if store is None else store.latest()
+    if snapshot is None:
+        logging.error("No frame available")
+        raise HTTPException(status_code=404, detail="No frame available")
+
+    headers = {
+        "ETag": snapshot.etag,
+        "Cache-Control": "no-cache",
+        "X-Frame-Seq": str(snapshot.seq)
+    }
+    # フレームが変わっていなければ本文なしで 304 を返す
+    if request.headers.get("if-none-match") == snapshot.etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=snapshot.jpeg, media_type="image/jpeg", headers=headers)
+
+@app.websocket("/ws/frames")
+async def stream_frames(websocket: WebSocket, camera_id: str = Query(DEFAULT_CAMERA_ID)):
+    """
+    処理済みのフレームを検出結果と組にしてプッシュ配信するエンドポイント。
+    フレームごとに JSON (seq, timestamp, detection) を送り、続けて JPEG のバイナリを送る。
+    """
+    # FrameStore を作るのはフレームを受け取ったときだけにし、未知のカメラの接続は受け付けません
+    # (任意の camera_id で FrameStore とスナップショットのスレッドが増え続けないように)
+    frame_store = frame_stores.get(camera_id) if CAMERA_ID_PATTERN.match(camera_id) else None
+    if frame_store is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    seq = 0
+    try:
+        while True:
+            snapshot = await frame_store.wait_for_newer(seq)
+            seq = snapshot.seq
+            await websocket.send_json({
+                "seq": snapshot.seq,
+                "timestamp": snapshot.timestamp,
+                "detection": snapshot.detection
+            })
+            await websocket.send_bytes(snapshot.jpeg)
+    except WebSocketDisconnect:
+        logging.info("Stream viewer disconnected")
 
 @app.post("/notification")
 async def notification(
+    response: Response,
     status: str = Form(...),
     detail: str = Form(...),
-    image: UploadFile = File(...)
+    image: UploadFile = File(...),
+    camera_id: str = Form(DEFAULT_CAMERA_ID)
 ):
-    global latest_detection
-
+    check_camera_id(camera_id)
     if image.content_type not in ["image/jpeg", "image/jpg"]:
         logging.error("Invalid image type")
         raise HTTPException(status_code=400, detail="Invalid image type")
 
     try:
-        # 画像を読み込み、OpenCVの形式に変換
         image_data = await image.read()
-        np_arr = np.frombuffer(image_data, np.uint8)
-        frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-
-        if frame is None:
-            logging.error("Failed to decode image")
-            raise HTTPException(status_code=400, detail="Failed to decode image. Ensure the image is valid.")
-
-        # ユーザーの確認
-        name, similarity = face_recognition.verify_user(frame)
-        logging.info(f"Detected person: {name} (similarity: {similarity:.3f})")
-
-        # フレームにアノテーションを追加
-        annotated_frame = face_recognition.annotate_frame(frame, name)
-
-        # アノテーションが追加されたフレームを保存
-        with latest_frame_lock:
-            cv2.imwrite(LATEST_FRAME_PATH, annotated_frame)
-        logging.info("Notification received, image processed, and saved with annotations")
+        await run_inference(camera_id, image_data, {"status": status, "detail": detail})
+        add_upload_hints(response)
+        if sampled("notification"):
+            logging.debug("Notification received, image processed, and saved with annotations")
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error processing image: {e}")
         raise HTTPException(status_code=500, detail="Failed to process and save image")
 
     with detection_lock:
-        latest_detection = DetectionData(status=status, detail=detail)
-    logging.info("Detection data updated")
+        latest_detections[camera_id] = DetectionData(status=status, detail=detail)
+    if sampled("detection_updated"):
+        logging.debug(f"Detection data updated for camera {camera_id}")
 
     return {"message": "Notification received and saved"}
 
 @app.get("/get_detection")
-async def get_detection():
+async def get_detection(camera_id: str = Query(DEFAULT_CAMERA_ID)):
+    check_camera_id(camera_id)
     with detection_lock:
+        latest_detection = latest_detections.get(camera_id)
         if latest_detection is None:
             logging.error("No detection data available")
             raise HTTPException(status_code=404, detail="No detection data available")
         return JSONResponse(content=latest_detection.to_dict())
 
+@app.get("/cameras")
+async def list_cameras():
+    return {"cameras": sorted(frame_stores.keys())}
+
 @app.post("/register_face")
 async def register_face(
     name: str = Form(...),
@@ -146,11 +570,12 @@ async def register_face(
         logging.error("Invalid image type for face registration")
         raise HTTPException(status_code=400, detail="Invalid image type. Only JPEG and PNG are supported.")
     
+    require_ready()
     try:
         # 画像を読み込み、OpenCVの形式に変換
         image_data = await image.read()
         np_arr = np.frombuffer(image_data, np.uint8)
-        frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+        frame = await asyncio.to_thread(cv2.imdecode, np_arr, cv2.IMREAD_COLOR)
 
         if frame is None:
             logging.error("Failed to decode image")
@@ -159,7 +584,8 @@ async def register_face(
         # 画像をリストにして登録（単一の画像でもリストで渡す必要があります）
         images = [frame]
 
-        face_recognition.register_user(name=name, images=images)
+        # 登録はまれな操作なので推論プールを使わず、イベントループの外で実行します
+        await asyncio.to_thread(face_recognition.register_user, name=name, images=images)
 
         logging.info(f"Face registered successfully for user: {name}")
         return {"message": f"Face registered successfully for user: {name}"}
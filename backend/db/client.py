@@ -1,5 +1,11 @@
+import os
+
 from pymongo import MongoClient
 
+# "memory" の場合は MongoDB の代わりにプロセス内のデータベース (db.memory) を使います (負荷試験用)
+DB_BACKEND = os.environ.get("DB_BACKEND", "mongodb")
+_memory_clients = {}
+
 class MongoDBClient:
     def __init__(self, host: str = "localhost", port: int = 27017, db_name: str = "my_database") -> None:
         self.host = host
@@ -18,6 +24,12 @@ class MongoDBClient:
             self.client = None
 
 def get_client(db_name: str) -> MongoDBClient:
+    if DB_BACKEND == "memory" and db_name in ("face", "background"):
+        # 同じプロセス内では同じデータを共有します
+        from db.memory import MemoryClient
+        if db_name not in _memory_clients:
+            _memory_clients[db_name] = MemoryClient(db_name)
+        return _memory_clients[db_name]
     if db_name == "face":
         return MongoDBClient(db_name="face")
     elif db_name == "background":
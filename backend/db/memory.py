@@ -0,0 +1,105 @@
+"""
+ベンチマークや負荷試験で MongoDB の代わりに使うプロセス内のデータベース。
+このリポジトリが使う操作と検索条件 (等価・$exists・$gt・$gte・$in・$or) だけに対応します。
+"""
+import copy
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+
+def _match_value(value: Any, condition: Any, present: bool) -> bool:
+    if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+        for op, operand in condition.items():
+            if op == "$exists":
+                if present != bool(operand):
+                    return False
+            elif op == "$gt":
+                if not present or value is None or not value > operand:
+                    return False
+            elif op == "$gte":
+                if not present or value is None or not value >= operand:
+                    return False
+            elif op == "$in":
+                if value not in operand:
+                    return False
+            else:
+                raise NotImplementedError(f"unsupported operator: {op}")
+        return True
+    return present and value == condition
+
+
+def matches(doc: Dict[str, Any], query: Optional[Dict[str, Any]]) -> bool:
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif not _match_value(doc.get(key), condition, key in doc):
+            return False
+    return True
+
+
+class MemoryCollection:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._docs: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def find(self, query: Optional[Dict[str, Any]] = None, projection: Any = None) -> Iterator[Dict[str, Any]]:
+        with self._lock:
+            found = [copy.deepcopy(doc) for doc in self._docs if matches(doc, query)]
+        return iter(found)
+
+    def find_one(self, query: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        return next(self.find(query), None)
+
+    def insert_one(self, doc: Dict[str, Any]) -> None:
+        # pymongo と同じく、渡したドキュメントに _id を設定します
+        doc.setdefault("_id", ObjectId())
+        with self._lock:
+            self._docs.append(copy.deepcopy(doc))
+
+    def update_one(self, query: Dict[str, Any], update: Dict[str, Any]) -> None:
+        with self._lock:
+            for doc in self._docs:
+                if matches(doc, query):
+                    doc.update(copy.deepcopy(update.get("$set", {})))
+                    for key in update.get("$unset", {}):
+                        doc.pop(key, None)
+                    return
+
+    def delete_many(self, query: Optional[Dict[str, Any]] = None) -> None:
+        with self._lock:
+            self._docs = [doc for doc in self._docs if not matches(doc, query)]
+
+    def count_documents(self, query: Optional[Dict[str, Any]] = None) -> int:
+        with self._lock:
+            return sum(1 for doc in self._docs if matches(doc, query))
+
+    def watch(self, *args: Any, **kwargs: Any):
+        # 変更ストリームはレプリカセットが無い場合と同じく失敗させ、ポーリングに切り替えさせます
+        raise OperationFailure("change streams are not supported by the in-memory database")
+
+
+class MemoryDatabase(dict):
+    def __missing__(self, name: str) -> MemoryCollection:
+        collection = self[name] = MemoryCollection(name)
+        return collection
+
+
+class MemoryClient:
+    """
+    MongoDBClient と同じく connect() でデータベースを返すクライアント。
+    """
+
+    def __init__(self, db_name: str = "memory") -> None:
+        self.db_name = db_name
+        self.database = MemoryDatabase()
+
+    def connect(self) -> MemoryDatabase:
+        return self.database
+
+    def close(self) -> None:
+        pass
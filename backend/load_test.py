@@ -0,0 +1,398 @@
+import argparse
+import glob
+import http.client
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+import cv2
+import numpy as np
+
+"""
+バックエンドの負荷試験。JPEG のフレームを /notification と /upload_frame に指定した並列数で送り続け、
+同時に閲覧側として /get_frame と /get_detection を読み続けます。
+
+並列数を段階的に上げながら、段階ごとのスループット・レイテンシのパーセンタイル・エラー率を測り、
+スループットが伸びなくなる並列数 (飽和の膝) を求めます。結果は JSON で出力します。
+
+--url を省略すると、MongoDB の代わりにプロセス内のデータベース (DB_BACKEND=memory) を使う
+バックエンドをこのプロセス内で起動します。--stub を付けると推論をモデルなしのエンジンに置き換え、
+推論以外 (FastAPI・デコード・アノテーション・エンコード) の負荷だけを測れます。
+
+    python load_test.py --stub --concurrency 1,2,4,8,16,32
+    python load_test.py --engine onnx --model arcface.onnx --images ./frames --output result.json
+    python load_test.py --url http://camera-server:8080 --cameras 4
+"""
+
+FRAME_FORM = {"status": "load_test", "detail": "load test frame"}
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def load_frames(image_dir: Optional[str], count: int = 30, width: int = 640, height: int = 480,
+                quality: int = 90) -> List[bytes]:
+    """
+    送信する JPEG を用意します。image_dir が無い場合は、なめらかな模様の合成画像を作ります。
+    """
+    if image_dir:
+        frames = []
+        for path in sorted(glob.glob(os.path.join(image_dir, "*"))):
+            if path.lower().endswith((".jpg", ".jpeg")):
+                with open(path, "rb") as f:
+                    frames.append(f.read())
+        if not frames:
+            raise ValueError(f"no JPEG files in {image_dir}")
+        return frames
+
+    rng = np.random.default_rng(0)
+    frames = []
+    for _ in range(count):
+        noise = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+        frame = cv2.GaussianBlur(cv2.resize(noise, (width, height), interpolation=cv2.INTER_LINEAR), (0, 0), 3)
+        ret, buffer = cv2.imencode(".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+        if not ret:
+            raise RuntimeError("Failed to encode frame")
+        frames.append(buffer.tobytes())
+    return frames
+
+
+def encode_multipart(fields: Dict[str, str], jpeg: bytes) -> Tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n{value}\r\n".encode())
+    parts.append(f"--{boundary}\r\nContent-Disposition: form-data; name=\"image\"; filename=\"frame.jpg\"\r\n"
+                 f"Content-Type: image/jpeg\r\n\r\n".encode())
+    parts.append(jpeg)
+    parts.append(f"\r\n--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+class Client:
+    """
+    接続を使い回す HTTP クライアント (スレッドごとに 1 つ使います)。
+    """
+
+    def __init__(self, base_url: str, timeout: float = 30.0) -> None:
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.timeout = timeout
+        self._conn: Optional[http.client.HTTPConnection] = None
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None,
+                headers: Optional[Dict[str, str]] = None) -> Tuple[int, float, http.client.HTTPResponse]:
+        """
+        Returns:
+            Tuple[int, float, HTTPResponse]: (ステータスコード, 秒数, レスポンス)。接続に失敗した場合のステータスは 0
+        """
+        start = time.perf_counter()
+        try:
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self._conn.request(method, path, body=body, headers=headers or {})
+            response = self._conn.getresponse()
+            response.read()
+            return response.status, time.perf_counter() - start, response
+        except (OSError, http.client.HTTPException):
+            self.close()
+            return 0, time.perf_counter() - start, None
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class Results:
+    """
+    リクエストの種類ごとにステータスとレイテンシを集めます。
+    """
+
+    def __init__(self) -> None:
+        self._samples: Dict[str, List[Tuple[int, float]]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, status: int, elapsed: float) -> None:
+        with self._lock:
+            self._samples.setdefault(kind, []).append((status, elapsed))
+
+    def summary(self, duration: float) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            samples = {kind: list(values) for kind, values in self._samples.items()}
+        result = {}
+        for kind, values in samples.items():
+            # 304 (フレームが変わっていない) は正常な応答です
+            ok = [elapsed for status, elapsed in values if 200 <= status < 400]
+            rejected = sum(1 for status, _ in values if status == 503)
+            errors = len(values) - len(ok) - rejected
+            result[kind] = {
+                "requests": len(values),
+                "ok": len(ok),
+                "throughput_rps": len(ok) / duration if duration else 0.0,
+                "rejected": rejected,
+                "errors": errors,
+                "reject_rate": rejected / len(values) if values else 0.0,
+                "error_rate": errors / len(values) if values else 0.0,
+                "p50_ms": percentile(ok, 50) * 1000,
+                "p90_ms": percentile(ok, 90) * 1000,
+                "p99_ms": percentile(ok, 99) * 1000,
+                "max_ms": max(ok) * 1000 if ok else 0.0
+            }
+        return result
+
+
+def writer(base_url: str, endpoint: str, camera_id: str, frames: List[bytes], offset: int,
+           results: Results, stop: threading.Event, respect_retry_after: bool) -> None:
+    client = Client(base_url)
+    index = offset
+    while not stop.is_set():
+        fields = {"camera_id": camera_id}
+        if endpoint == "notification":
+            fields.update(FRAME_FORM)
+        body, content_type = encode_multipart(fields, frames[index % len(frames)])
+        index += 1
+        status, elapsed, response = client.request("POST", f"/{endpoint}", body, {"Content-Type": content_type})
+        results.add(endpoint, status, elapsed)
+        if status == 503 and respect_retry_after:
+            stop.wait(float(response.getheader("Retry-After", "1")))
+    client.close()
+
+
+def reader(base_url: str, camera_ids: List[str], interval: float, results: Results,
+           stop: threading.Event) -> None:
+    client = Client(base_url)
+    etags: Dict[str, str] = {}
+    index = 0
+    while not stop.is_set():
+        camera_id = camera_ids[index % len(camera_ids)]
+        index += 1
+        query = urlencode({"camera_id": camera_id})
+        headers = {"If-None-Match": etags[camera_id]} if camera_id in etags else {}
+        status, elapsed, response = client.request("GET", f"/get_frame?{query}", headers=headers)
+        results.add("get_frame", status, elapsed)
+        if status == 200:
+            etags[camera_id] = response.getheader("ETag", "")
+        status, elapsed, _ = client.request("GET", f"/get_detection?{query}")
+        results.add("get_detection", status, elapsed)
+        stop.wait(interval)
+    client.close()
+
+
+def run_step(base_url: str, frames: List[bytes], concurrency: int, duration: float, endpoints: List[str],
+             cameras: int, readers: int, read_interval: float, respect_retry_after: bool) -> Dict[str, Any]:
+    """
+    concurrency 個の送信スレッドと readers 個の閲覧スレッドを duration 秒動かし、結果を集計します。
+    送信スレッドは応答を待ってから次を送ります (クローズドループ)。
+    """
+    camera_ids = [f"load{index}" for index in range(cameras)]
+    results = Results()
+    stop = threading.Event()
+    threads = []
+    for index in range(concurrency):
+        endpoint = endpoints[index % len(endpoints)]
+        camera_id = camera_ids[index % len(camera_ids)]
+        threads.append(threading.Thread(
+            target=writer, args=(base_url, endpoint, camera_id, frames, index, results, stop, respect_retry_after),
+            daemon=True))
+    for _ in range(readers):
+        threads.append(threading.Thread(target=reader, args=(base_url, camera_ids, read_interval, results, stop),
+                                        daemon=True))
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    stop.wait(duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=60.0)
+    elapsed = time.perf_counter() - start
+
+    requests = results.summary(elapsed)
+    writes = [requests[endpoint] for endpoint in endpoints if endpoint in requests]
+    total = sum(summary["requests"] for summary in writes)
+    return {
+        "concurrency": concurrency,
+        "duration_s": elapsed,
+        "frames_per_s": sum(summary["throughput_rps"] for summary in writes),
+        "write_p99_ms": max((summary["p99_ms"] for summary in writes), default=0.0),
+        "write_error_rate": sum(summary["errors"] + summary["rejected"] for summary in writes) / total if total else 0.0,
+        "requests": requests
+    }
+
+
+def find_knee(steps: List[Dict[str, Any]], min_gain: float = 0.1, max_error_rate: float = 0.01) -> Dict[str, Any]:
+    """
+    並列数を上げてもフレームの処理量が min_gain 以上増えなくなる (またはエラー率が max_error_rate を
+    超える) 直前の段階を飽和の膝とします。
+    """
+    for step, following in zip(steps, steps[1:]):
+        if step["write_error_rate"] > max_error_rate:
+            return {"concurrency": step["concurrency"], "frames_per_s": step["frames_per_s"],
+                    "reason": "error_rate"}
+        if following["frames_per_s"] < step["frames_per_s"] * (1 + min_gain) \
+                or following["write_error_rate"] > max_error_rate:
+            return {"concurrency": step["concurrency"], "frames_per_s": step["frames_per_s"],
+                    "reason": "throughput_plateau"}
+    last = steps[-1]
+    return {"concurrency": last["concurrency"], "frames_per_s": last["frames_per_s"], "reason": "not_reached"}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def seed_gallery(users: int, engine: str, dim: int = 512, samples: int = 3, seed: int = 0) -> None:
+    """
+    乱数の特徴ベクトルを持つユーザーをプロセス内のデータベースに登録し、照合の負荷を実際の規模に近づけます。
+    engine のエンジンの特徴ベクトルとして登録するため、照合から外されません。
+    """
+    from db.client import get_client
+    from db.codec import encode_array
+    from utils.embedding import EmbeddingEngine, StubEngine
+
+    collection = get_client("face").connect()["faces"]
+    stored_id = (StubEngine if engine == "stub" else EmbeddingEngine)().embedding_id
+    rng = np.random.default_rng(seed)
+    for index in range(users):
+        embeddings = rng.standard_normal((samples, dim)).astype(np.float32)
+        collection.insert_one({"user_id": index + 1, "name": f"user{index + 1}",
+                               "embeddings": encode_array(embeddings), "embedding_id": stored_id})
+
+
+class LocalBackend:
+    """
+    app.py をこのプロセス内の uvicorn で起動します。設定は app.py と同じく環境変数で渡します。
+    """
+
+    def __init__(self, env: Dict[str, str], gallery_size: int, startup_timeout: float = 300.0) -> None:
+        os.environ.update(env)
+        import uvicorn
+
+        seed_gallery(gallery_size, env["EMBEDDING_ENGINE"])
+        import app as backend_app
+
+        port = free_port()
+        self.url = f"http://127.0.0.1:{port}"
+        self.server = uvicorn.Server(uvicorn.Config(backend_app.app, host="127.0.0.1", port=port,
+                                                    log_level="warning", access_log=False))
+        self._thread = threading.Thread(target=self.server.run, name="backend", daemon=True)
+        self._thread.start()
+
+        # モデルの読み込みとウォームアップが終わるまで待ちます
+        client = Client(self.url)
+        deadline = time.monotonic() + startup_timeout
+        while time.monotonic() < deadline:
+            status, _, _ = client.request("GET", "/readyz")
+            if status == 200:
+                client.close()
+                return
+            time.sleep(0.2)
+        raise RuntimeError("backend did not become ready")
+
+    def close(self) -> None:
+        self.server.should_exit = True
+        self._thread.join(timeout=10.0)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load test of the FastAPI backend")
+    parser.add_argument("--url", help="試験するバックエンド (省略時はプロセス内で起動)")
+    parser.add_argument("--images", help="送信する JPEG のディレクトリ (省略時は合成画像)")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--endpoints", default="notification,upload_frame",
+                        help="送信先 (notification・upload_frame をカンマ区切り)")
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32", help="試す送信の並列数 (カンマ区切り)")
+    parser.add_argument("--duration", type=float, default=15.0, help="1 段階の秒数")
+    parser.add_argument("--cameras", type=int, default=4, help="送信に使うカメラの数")
+    parser.add_argument("--readers", type=int, default=2, help="閲覧側の並列数")
+    parser.add_argument("--read-interval", type=float, default=0.1, help="閲覧側のポーリング間隔 (秒)")
+    parser.add_argument("--respect-retry-after", action="store_true",
+                        help="503 を受けたら Retry-After だけ待ちます (カメラと同じ振る舞い)")
+    parser.add_argument("--knee-gain", type=float, default=0.1,
+                        help="並列数を上げたときにこれ未満しか処理量が増えなければ飽和とみなします")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    # プロセス内で起動するバックエンドの設定
+    parser.add_argument("--stub", action="store_true", help="推論をモデルなしのエンジンに置き換えます")
+    parser.add_argument("--stub-delay", type=float, default=0.0, help="スタブの 1 回の推論時間 (ミリ秒)")
+    parser.add_argument("--engine", default="deepface")
+    parser.add_argument("--model", help="ONNX モデルのパス (--engine onnx のとき)")
+    parser.add_argument("--executor", choices=("thread", "process"), default="thread",
+                        help="process の場合、ワーカーは spawn で起動するため --gallery-size の登録は共有されません")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=4)
+    parser.add_argument("--gallery-size", type=int, default=100, help="登録済みユーザー数")
+    parser.add_argument("--output", help="結果の JSON を書き出すファイル (省略時は標準出力)")
+    args = parser.parse_args()
+
+    endpoints = [endpoint.strip() for endpoint in args.endpoints.split(",") if endpoint.strip()]
+    for endpoint in endpoints:
+        if endpoint not in ("notification", "upload_frame"):
+            parser.error(f"unknown endpoint: {endpoint}")
+    levels = sorted({int(level) for level in args.concurrency.split(",")})
+    frames = load_frames(args.images, width=args.width, height=args.height)
+
+    backend = None
+    base_url = args.url
+    if base_url is None:
+        env = {
+            "DB_BACKEND": "memory",
+            "EMBEDDING_ENGINE": "stub" if args.stub else args.engine,
+            "EMBEDDING_STUB_DELAY_MS": str(args.stub_delay),
+            "INFERENCE_EXECUTOR": args.executor,
+            "INFERENCE_WORKERS": str(args.workers),
+            "INFERENCE_QUEUE_SIZE": str(args.queue_size)
+        }
+        if args.model:
+            env["EMBEDDING_MODEL_PATH"] = args.model
+        print("Starting backend...", file=sys.stderr)
+        backend = LocalBackend(env, args.gallery_size)
+        base_url = backend.url
+
+    try:
+        # 閲覧側が 404 ばかりにならないよう、各カメラに 1 枚ずつ送っておきます
+        run_step(base_url, frames, args.cameras, 1.0, endpoints, args.cameras, 0, args.read_interval, True)
+
+        steps = []
+        for level in levels:
+            step = run_step(base_url, frames, level, args.duration, endpoints, args.cameras, args.readers,
+                            args.read_interval, args.respect_retry_after)
+            steps.append(step)
+            print(f"concurrency {level:>3}: {step['frames_per_s']:7.1f} frames/s, "
+                  f"p99 {step['write_p99_ms']:7.1f} ms, errors {step['write_error_rate']:.1%}", file=sys.stderr)
+    finally:
+        if backend is not None:
+            backend.close()
+
+    result = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "frame_bytes": int(np.mean([len(frame) for frame in frames])),
+        "steps": steps,
+        "knee": find_knee(steps, min_gain=args.knee_gain, max_error_rate=args.max_error_rate)
+    }
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,23 +1,56 @@
 import cv2
 import numpy as np
 import logging
-from deepface import DeepFace
 import os
+import time
 from datetime import datetime
-from typing import List, Optional, Tuple
+from typing import Dict, List, NamedTuple, Optional, Tuple
 from db.client import MongoDBClient  # MongoDBクライアントを正しくインポート
+from db.codec import decode_embeddings, encode_array
+from utils.embedding import LEGACY_EMBEDDING_ID, EmbeddingEngine, DeepFaceEngine
+from utils.gallery import FaceGallery
+from utils.gallery_sync import GallerySync
+from utils.metrics import DB_SECONDS
+
+class FaceResult(NamedTuple):
+    """
+    1 回の検出で得られた顔ごとの認識結果。box は (x, y, w, h)。
+    """
+    box: Tuple[int, int, int, int]
+    name: str
+    score: float
+
+    def to_dict(self):
+        return {
+            "box": list(self.box),
+            "name": self.name,
+            "score": self.score
+        }
+
 
 class FaceRecognition:
-    def __init__(self, db_client: MongoDBClient) -> None:
+    def __init__(self, db_client: MongoDBClient, use_faiss: bool = False,
+                 sync_interval: Optional[float] = 5.0, engine: Optional[EmbeddingEngine] = None) -> None:
         self.model_name = 'ArcFace'
         self.db_client = db_client
         self.db = self.db_client.connect()
         self.collection = self.db["faces"]
         self.registered_users = []
+        self.gallery = FaceGallery(use_faiss=use_faiss)
+
+        # 認識モデルは起動時に一度だけ読み込みます (既定は DeepFace の ArcFace)
+        self.engine = engine or DeepFaceEngine(self.model_name)
 
         # データベースから登録済みの顔データを読み込みます
         self.load_registered_embeddings()
 
+        # 他のプロセスで登録・削除された顔データを差分で取り込みます
+        self.sync = None
+        if sync_interval:
+            self.sync = GallerySync(self.collection, on_upsert=self.apply_user, on_delete=self.remove_user,
+                                    known_keys=lambda: list(self.gallery.keys), poll_interval=sync_interval)
+            self.sync.start(self.registered_users)
+
     def register_user(self, name: str, images: List[np.ndarray]) -> None:
         """
         ユーザーを登録します。
@@ -30,31 +63,35 @@ class FaceRecognition:
             embeddings = []
             for idx, image in enumerate(images):
                 # 特徴ベクトルの取得
-                embedding_objs = DeepFace.represent(img_path=image, model_name=self.model_name,
-                                                    detector_backend='mtcnn', enforce_detection=True)
-                if len(embedding_objs) == 0:
+                representations = self.engine.represent(image, enforce_detection=True)
+                if len(representations) == 0:
                     logging.error(f"サンプル {idx + 1} で顔が検出されませんでした。")
                     continue
-                embedding = embedding_objs[0]["embedding"]
+                _, _, embedding = representations[0]
                 embeddings.append(embedding)
 
             if len(embeddings) == 0:
                 logging.error("有効な顔が検出されませんでした。登録を中止します。")
                 return
 
-            # MongoDBに保存
+            # MongoDBに保存 (特徴ベクトルは float32 のバイナリとして保存します)
+            embeddings = np.asarray(embeddings, dtype=np.float32)
             user_id = self.collection.count_documents({}) + 1
             face_data = {
                 "user_id": user_id,
                 "name": name,
-                "embeddings": embeddings,
-                "created_at": datetime.utcnow().isoformat()
+                "embeddings": encode_array(embeddings),
+                "embedding_id": self.engine.embedding_id,
+                "created_at": datetime.utcnow().isoformat(),
+                "updated_at": datetime.utcnow()
             }
-            self.collection.insert_one(face_data)
+            with DB_SECONDS.time(operation="insert_face"):
+                self.collection.insert_one(face_data)
+            face_data["embeddings"] = embeddings
             logging.info(f"ユーザー {name} の顔データが保存されました。")
 
-            # 登録ユーザーのリストを更新
-            self.registered_users.append(face_data)
+            # 登録ユーザーのリストとインデックスを更新
+            self.apply_user(face_data)
         except Exception as e:
             logging.error(f"ユーザーの登録中にエラーが発生しました: {e}")
 
@@ -63,15 +100,101 @@ class FaceRecognition:
         登録されたユーザーの特徴ベクトルをデータベースから読み込みます。
         """
         try:
-            self.registered_users = list(self.collection.find())
+            with DB_SECONDS.time(operation="load_faces"):
+                self.registered_users = list(self.collection.find())
+            for user in self.registered_users:
+                user["embeddings"] = decode_embeddings(user.get("embeddings", []))
+            compatible = [user for user in self.registered_users if self.is_compatible(user)]
+            self.gallery.build(compatible)
             logging.info(f"{len(self.registered_users)} 人のユーザーをデータベースから読み込みました。")
+            if len(compatible) < len(self.registered_users):
+                logging.error(f"{len(self.registered_users) - len(compatible)} 人のユーザーは別のモデルまたは前処理の"
+                              f"特徴ベクトルのため照合から外しました。migrate.py --reembed で作り直すか、再登録してください。")
         except Exception as e:
             logging.error(f"データベースからの読み込み中にエラーが発生しました: {e}")
             self.registered_users = []
+            self.gallery.build([])
+
+    def apply_user(self, user: dict) -> None:
+        """
+        追加・更新されたユーザーをメモリ上のリストとインデックスに反映します。
+        """
+        user["embeddings"] = decode_embeddings(user.get("embeddings", []))
+        key = FaceGallery.user_key(user)
+        self.registered_users = [u for u in self.registered_users if FaceGallery.user_key(u) != key] + [user]
+        if len(user["embeddings"]) > 0 and self.is_compatible(user):
+            self.gallery.add_user(user)
+        else:
+            self.gallery.remove_user(key)
+        logging.info(f"ユーザー {user['name']} の顔データを反映しました。")
+
+    def is_compatible(self, user: dict) -> bool:
+        """
+        ユーザーの特徴ベクトルが今のエンジンと同じモデル・前処理で作られたかを返します。
+        違う場合は類似度が意味を持たないため、照合には使いません。
+        """
+        stored = user.get("embedding_id", LEGACY_EMBEDDING_ID)
+        if stored == self.engine.embedding_id:
+            return True
+        logging.warning(f"ユーザー {user.get('name')} の特徴ベクトル ({stored}) は "
+                        f"現在のエンジン ({self.engine.embedding_id}) と比較できません。")
+        return False
+
+    def remove_user(self, key) -> None:
+        """
+        削除されたユーザーをメモリ上のリストとインデックスから取り除きます。
+        """
+        self.registered_users = [u for u in self.registered_users if FaceGallery.user_key(u) != key]
+        if self.gallery.remove_user(key):
+            logging.info(f"ユーザー {key} の顔データを削除しました。")
+
+    def close(self) -> None:
+        if self.sync is not None:
+            self.sync.stop()
+
+    def warmup(self) -> None:
+        """
+        ダミーの画像で検出と特徴ベクトルの取得を一度実行し、最初のフレームが遅くならないようにします。
+        """
+        self.engine.warmup()
+        self.recognize_faces(np.zeros((480, 640, 3), dtype=np.uint8))
+
+    def recognize_faces(self, image: np.ndarray, timings: Optional[Dict[str, float]] = None) -> List[FaceResult]:
+        """
+        フレーム内の顔を一度だけ検出し、顔ごとの位置・名前・類似度を返します。
+
+        Args:
+            image (np.ndarray): 検証するフレーム
+            timings (Optional[Dict[str, float]]): 渡すと detection_embedding と matching の秒数を書き込みます
+
+        Returns:
+            List[FaceResult]: 検出された顔ごとの認識結果
+        """
+        timings = {} if timings is None else timings
+        try:
+            # 検出と特徴ベクトルの取得をエンジンの 1 回の呼び出しで行います
+            start = time.perf_counter()
+            representations = self.engine.represent(image, enforce_detection=False)
+            timings["detection_embedding"] = time.perf_counter() - start
+            if len(representations) == 0:
+                return []
+
+            start = time.perf_counter()
+            embeddings = np.stack([embedding for _, _, embedding in representations])
+            matches = self.gallery.identify_batch(embeddings)
+            timings["matching"] = time.perf_counter() - start
+
+            results = []
+            for (box, _, _), (name, similarity) in zip(representations, matches):
+                results.append(FaceResult(box=box, name=name, score=similarity))
+            return results
+        except Exception as e:
+            logging.error(f"顔の認識中にエラーが発生しました: {e}")
+            return []
 
     def verify_user(self, image: np.ndarray) -> Tuple[str, float]:
         """
-        入力画像の人物が登録されたadminユーザーかどうかを確認します。
+        入力画像の人物が登録済みユーザーの誰に当たるかを確認します。
 
         Args:
             image (np.ndarray): 検証する顔画像
@@ -79,66 +202,29 @@ class FaceRecognition:
         Returns:
             Tuple[str, float]: (一致したユーザーの名前または "unknown", 類似度スコア)
         """
-        try:
-            # 特徴ベクトルの取得
-            embedding_objs = DeepFace.represent(img_path=image, model_name=self.model_name,
-                                                detector_backend='mtcnn', enforce_detection=True)
-            if len(embedding_objs) == 0:
-                logging.error("顔が検出されませんでした。")
-                return "unknown", 0.0
-            embedding = embedding_objs[0]["embedding"]
-
-            # 登録されたadminユーザーとの比較
-            admin_user = None
-            for user in self.registered_users:
-                if user["name"] == "admin":
-                    admin_user = user
-                    break
-
-            if admin_user is None:
-                logging.error("adminユーザーが登録されていません。")
-                return "unknown", 0.0
-
-            highest_similarity = -1  # 初期値
-
-            user_embeddings = admin_user["embeddings"]
-            for registered_embedding in user_embeddings:
-                registered_embedding = np.array(registered_embedding)
-                # コサイン類似度の計算
-                similarity = np.dot(registered_embedding, embedding) / (np.linalg.norm(registered_embedding) * np.linalg.norm(embedding))
-                if similarity > highest_similarity:
-                    highest_similarity = similarity
-
-            # 閾値を設定（0.7）
-            threshold = 0.7
-            if highest_similarity >= threshold:
-                return "admin", highest_similarity
-            else:
-                return "unknown", highest_similarity
-        except Exception as e:
-            logging.error(f"ユーザーの検証中にエラーが発生しました: {e}")
+        faces = self.recognize_faces(image)
+        if len(faces) == 0:
+            logging.error("顔が検出されませんでした。")
             return "unknown", 0.0
+        best = max(faces, key=lambda face: face.score)
+        return best.name, best.score
 
-    def annotate_frame(self, frame: np.ndarray, name: str) -> np.ndarray:
+    def annotate_frame(self, frame: np.ndarray, faces: List[FaceResult]) -> np.ndarray:
         """
         フレームに検出された顔の位置と名前を描画します。
 
         Args:
             frame (np.ndarray): 元のフレーム
-            name (str): 検出されたユーザーの名前
+            faces (List[FaceResult]): recognize_faces の結果
 
         Returns:
             np.ndarray: アノテーションが追加されたフレーム
         """
-        # 顔検出
-        face_detector = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        detected_faces = face_detector.detectMultiScale(gray, 1.3, 5)
-
-        for (x, y, w, h) in detected_faces:
-            # 類似度の閾値チェックは verify_user で行っているため、ここでは name を使用
-            if name == "admin":
-                label = "admin"
+        for face in faces:
+            x, y, w, h = face.box
+            # 類似度の閾値チェックは recognize_faces で行っているため、ここでは name を使用
+            if face.name != "unknown":
+                label = face.name
                 color = (0, 255, 0)  # 緑
             else:
                 label = "unknown"
@@ -148,4 +234,4 @@ class FaceRecognition:
             cv2.putText(frame, label, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX,
                         0.9, color, 2)
 
-        return frame
\ No newline at end of file
+        return frame
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, NamedTuple, Optional
+
+
+class FrameSnapshot(NamedTuple):
+    """
+    ある時点の最新フレーム。jpeg はエンコード済みのバイト列で、書き換えられません。
+    """
+    seq: int
+    jpeg: bytes
+    etag: str
+    timestamp: float
+    detection: Optional[Dict[str, Any]] = None
+
+
+class FrameStore:
+    """
+    最新のアノテーション済みフレームを JPEG のバイト列としてメモリ上に保持します。
+
+    フレームごとに連番を振り、ETag として使えるようにします。配信中の視聴者は
+    wait_for_newer で次のフレームを待ち、全員が同じバイト列を共有します。
+    snapshot_path を指定するとバックグラウンドのスレッドが snapshot_interval 秒ごとに
+    ディスクへ書き出します。
+    """
+
+    def __init__(self, snapshot_path: Optional[str] = None, snapshot_interval: float = 0.0) -> None:
+        self._lock = threading.Lock()
+        self._latest: Optional[FrameSnapshot] = None
+        self._seq = 0
+        # 再起動後に古い ETag と衝突しないよう、起動ごとの識別子を付けます
+        self._boot_id = uuid.uuid4().hex[:8]
+
+        # 配信用の通知。最初に待ち受けたイベントループに紐付けます
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._new_frame: Optional[asyncio.Event] = None
+
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._stop = threading.Event()
+        self._snapshot_thread = None
+        if snapshot_path and snapshot_interval > 0:
+            self._snapshot_thread = threading.Thread(target=self._snapshot_loop, name="frame-snapshot", daemon=True)
+            self._snapshot_thread.start()
+
+    def publish(self, jpeg: bytes, detection: Optional[Dict[str, Any]] = None) -> FrameSnapshot:
+        """
+        新しいフレームを最新として登録します。
+        """
+        with self._lock:
+            self._seq += 1
+            snapshot = FrameSnapshot(
+                seq=self._seq,
+                jpeg=jpeg,
+                etag=f'"{self._boot_id}-{self._seq}"',
+                timestamp=time.time(),
+                detection=detection
+            )
+            self._latest = snapshot
+        self._notify()
+        return snapshot
+
+    def latest(self) -> Optional[FrameSnapshot]:
+        return self._latest
+
+    def _notify(self) -> None:
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._wake()
+        else:
+            loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self) -> None:
+        # 待機中の視聴者を全員起こし、次のフレーム用に新しいイベントを用意します
+        event = self._new_frame
+        self._new_frame = asyncio.Event()
+        event.set()
+
+    async def wait_for_newer(self, seq: int) -> FrameSnapshot:
+        """
+        seq より新しいフレームが届くまで待ち、その時点の最新フレームを返します。
+        処理が遅い視聴者は途中のフレームを読み飛ばします。
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._new_frame = asyncio.Event()
+        while True:
+            snapshot = self._latest
+            if snapshot is not None and snapshot.seq > seq:
+                return snapshot
+            await self._new_frame.wait()
+
+    def _snapshot_loop(self) -> None:
+        written_seq = 0
+        while not self._stop.wait(self.snapshot_interval):
+            snapshot = self._latest
+            if snapshot is None or snapshot.seq == written_seq:
+                continue
+            try:
+                # 読み手が書きかけのファイルを見ないよう、一時ファイルから置き換えます
+                tmp_path = f"{self.snapshot_path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(snapshot.jpeg)
+                os.replace(tmp_path, self.snapshot_path)
+                written_seq = snapshot.seq
+            except OSError as e:
+                logging.error(f"Failed to write frame snapshot: {e}")
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join(timeout=1.0)
@@ -0,0 +1,118 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Optional
+from pymongo.errors import OperationFailure, PyMongoError
+
+
+class GallerySync:
+    """
+    faces コレクションの変更をメモリ上のギャラリーへ差分で反映します。
+
+    MongoDB の change stream が使える場合はそれを購読し、使えない場合 (レプリカセットで
+    ない単体の mongod など) は _id と updated_at の最大値を基準にしたポーリングに切り替えます。
+    ポーリングでは削除を検知できないため、full_check_interval 秒ごとに _id だけを取得して
+    消えたユーザーを取り除きます。
+
+    Args:
+        collection: faces コレクション
+        on_upsert (Callable[[Dict[str, Any]], None]): 追加・更新されたドキュメントを受け取る関数
+        on_delete (Callable[[Any], None]): 削除されたドキュメントの _id を受け取る関数
+        known_keys (Callable[[], Iterable[Any]]): 現在メモリ上にあるユーザーの _id を返す関数
+    """
+
+    def __init__(self, collection, on_upsert: Callable[[Dict[str, Any]], None],
+                 on_delete: Callable[[Any], None], known_keys: Callable[[], Iterable[Any]],
+                 poll_interval: float = 5.0, full_check_interval: float = 60.0) -> None:
+        self.collection = collection
+        self.on_upsert = on_upsert
+        self.on_delete = on_delete
+        self.known_keys = known_keys
+        self.poll_interval = poll_interval
+        self.full_check_interval = full_check_interval
+
+        self.last_id = None
+        self.last_updated_at: Optional[datetime] = None
+        self._resume_token = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, loaded_docs: Iterable[Dict[str, Any]] = ()) -> None:
+        """
+        全件読み込み済みのドキュメントから基準値を決め、同期用のスレッドを開始します。
+        """
+        for doc in loaded_docs:
+            self._advance(doc)
+        self._thread = threading.Thread(target=self._run, name="gallery-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+
+    def _advance(self, doc: Dict[str, Any]) -> None:
+        if "_id" in doc and (self.last_id is None or doc["_id"] > self.last_id):
+            self.last_id = doc["_id"]
+        updated_at = doc.get("updated_at")
+        if isinstance(updated_at, datetime) and (self.last_updated_at is None or updated_at > self.last_updated_at):
+            self.last_updated_at = updated_at
+
+    def _run(self) -> None:
+        try:
+            self._watch()
+        except OperationFailure as e:
+            logging.info(f"change stream が使えないためポーリングで同期します: {e}")
+        self._poll()
+
+    def _watch(self) -> None:
+        while not self._stop.is_set():
+            try:
+                with self.collection.watch(full_document="updateLookup", resume_after=self._resume_token,
+                                           max_await_time_ms=1000) as stream:
+                    while not self._stop.is_set():
+                        change = stream.try_next()
+                        if change is None:
+                            continue
+                        self._resume_token = stream.resume_token
+                        self._apply_change(change)
+            except OperationFailure:
+                raise
+            except PyMongoError as e:
+                logging.error(f"change stream の購読中にエラーが発生しました: {e}")
+                self._stop.wait(self.poll_interval)
+
+    def _apply_change(self, change: Dict[str, Any]) -> None:
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace"):
+            doc = change.get("fullDocument")
+            if doc is not None:
+                self.on_upsert(doc)
+                self._advance(doc)
+        elif operation == "delete":
+            self.on_delete(change["documentKey"]["_id"])
+
+    def _poll(self) -> None:
+        since_full_check = 0.0
+        while not self._stop.wait(self.poll_interval):
+            try:
+                conditions = []
+                if self.last_id is not None:
+                    conditions.append({"_id": {"$gt": self.last_id}})
+                if self.last_updated_at is not None:
+                    conditions.append({"updated_at": {"$gt": self.last_updated_at}})
+                query = {"$or": conditions} if conditions else {}
+
+                for doc in self.collection.find(query):
+                    self.on_upsert(doc)
+                    self._advance(doc)
+
+                since_full_check += self.poll_interval
+                if since_full_check >= self.full_check_interval:
+                    since_full_check = 0.0
+                    existing = {doc["_id"] for doc in self.collection.find({}, {"_id": 1})}
+                    for key in list(self.known_keys()):
+                        if key not in existing:
+                            self.on_delete(key)
+            except PyMongoError as e:
+                logging.error(f"顔データの同期中にエラーが発生しました: {e}")
@@ -0,0 +1,72 @@
+import struct
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+# 縮小デコードの倍率と cv2.imdecode のフラグ (libjpeg が DCT の段階で縮小するため、全体をデコードするより速い)
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# 画像の大きさを持つ SOF マーカー (DHT・JPG・DAC の C4・C8・CC を除く)
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    デコードせずに JPEG のヘッダーから (幅, 高さ) を読み取ります。JPEG でない場合は None です。
+    """
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # マーカーの前の詰め物
+            offset += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            return None
+        length = struct.unpack(">H", data[offset + 2:offset + 4])[0]
+        if marker in _SOF_MARKERS:
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + length
+    return None
+
+
+def detection_scale(width: int, min_width: int) -> int:
+    """
+    縮小しても幅が min_width 以上残る最大の縮小倍率 (1・2・4・8) を返します。min_width が 0 なら縮小しません。
+    """
+    scale = 1
+    if min_width <= 0:
+        return scale
+    while scale < 8 and width // (scale * 2) >= min_width:
+        scale *= 2
+    return scale
+
+
+def decode_jpeg(data: bytes, scale: int = 1) -> Optional[np.ndarray]:
+    """
+    JPEG を 1/scale の大きさでデコードします。失敗した場合は None です。
+    """
+    return cv2.imdecode(np.frombuffer(data, np.uint8), REDUCED_FLAGS[scale])
+
+
+def encode_jpeg(frame: np.ndarray, quality: int = 80) -> bytes:
+    ret, buffer = cv2.imencode(".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    if not ret:
+        raise RuntimeError("Failed to encode frame")
+    return buffer.tobytes()
@@ -0,0 +1,282 @@
+"""
+カウンターと処理時間のヒストグラムを集計し、Prometheus のテキスト形式で出力します。
+
+記録はロック 1 回と数値の加算だけで済むため、毎フレーム呼び出しても負荷になりません。
+複数のプロセスの値は snapshot() を JSON で書き出し (MetricsDumper)、1 つのサーバーでまとめて出力できます。
+"""
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# 秒単位のヒストグラムの既定のバケット (1ms〜5s)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            samples = [[list(key), value] for key, value in self._values.items()]
+        return {"type": "counter", "help": self.help, "labelnames": list(self.labelnames), "samples": samples}
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # ラベルごとの [バケットごとの件数 (+Inf を含む), 合計, 件数]
+        self._values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            samples = [[list(key), {"counts": list(counts), "sum": total, "count": count}]
+                       for key, (counts, total, count) in self._values.items()]
+        return {"type": "histogram", "help": self.help, "labelnames": list(self.labelnames),
+                "buckets": list(self.buckets), "samples": samples}
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"metric {name} is already registered as {type(metric).__name__}")
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labelnames, buckets)
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.counter(name, help, labelnames)
+
+
+def histogram(name: str, help: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, help, labelnames, buckets)
+
+
+# 複数のモジュールで共有する指標
+STEP_SECONDS = histogram("frame_processing_seconds", "Time spent in each frame processing step", ("step",))
+DB_SECONDS = histogram("db_call_seconds", "Time spent in database calls", ("operation",))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render(snapshots: Dict[Optional[str], Dict[str, dict]]) -> str:
+    """
+    snapshot() の結果を Prometheus のテキスト形式にします。
+
+    Args:
+        snapshots: プロセス名から snapshot() の結果への辞書。プロセス名が None でなければ
+            process ラベルを付けて 1 つの出力にまとめます
+    """
+    families: Dict[str, Tuple[dict, List[Tuple[List[str], List[str], object]]]] = {}
+    for process, snapshot in snapshots.items():
+        for name, family in snapshot.items():
+            entry = families.setdefault(name, (family, []))
+            labelnames = list(family["labelnames"])
+            for values, sample in family["samples"]:
+                names, values = list(labelnames), list(values)
+                if process is not None:
+                    names.append("process")
+                    values.append(process)
+                entry[1].append((names, values, sample))
+
+    lines = []
+    for name in sorted(families):
+        family, samples = families[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for names, values, sample in samples:
+            if family["type"] == "counter":
+                lines.append(f"{name}{_format_labels(names, values)} {_format_value(sample)}")
+                continue
+            cumulative = 0
+            bounds = [str(bound) for bound in family["buckets"]] + ["+Inf"]
+            for bound, count in zip(bounds, sample["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(names + ['le'], values + [bound])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(names, values)} {_format_value(sample['sum'])}")
+            lines.append(f"{name}_count{_format_labels(names, values)} {sample['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def load_snapshots(directory: str) -> Dict[Optional[str], Dict[str, dict]]:
+    """
+    MetricsDumper が書き出した各プロセスの値を読み込みます。
+    """
+    snapshots: Dict[Optional[str], Dict[str, dict]] = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        try:
+            with open(path) as f:
+                snapshots[os.path.splitext(os.path.basename(path))[0]] = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Failed to read metrics from {path}: {e}")
+    return snapshots
+
+
+class MetricsDumper:
+    """
+    REGISTRY の値を一定間隔で JSON ファイルに書き出します (一時ファイルからの置き換えで書きかけを読ませません)。
+    """
+
+    def __init__(self, path: str, interval: float = 10.0, registry: Registry = REGISTRY) -> None:
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-dumper", daemon=True)
+
+    def start(self) -> "MetricsDumper":
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._thread.start()
+        return self
+
+    def dump(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(tmp_path, self.path)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.dump()
+            except OSError as e:
+                logging.warning(f"Failed to write metrics to {self.path}: {e}")
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=1.0)
+        try:
+            self.dump()
+        except OSError:
+            pass
+
+
+class MetricsServer:
+    """
+    /metrics で Prometheus のテキスト形式を返す小さな HTTP サーバー。
+
+    Args:
+        port (int): 待ち受けるポート
+        collect (Callable): 出力する snapshot の辞書を返す関数 (render の引数と同じ形)
+        host (str): 待ち受けるアドレス
+    """
+
+    def __init__(self, port: int, collect: Optional[Callable[[], Dict[Optional[str], Dict[str, dict]]]] = None,
+                 host: str = "127.0.0.1") -> None:
+        collect = collect or (lambda: {None: REGISTRY.snapshot()})
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render(collect()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+
+    def start(self) -> "MetricsServer":
+        self._thread.start()
+        logging.info(f"Metrics available at http://{self.server.server_address[0]}:"
+                     f"{self.server.server_address[1]}/metrics")
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+_sample_counts: Dict[str, int] = {}
+
+
+def sampled(key: str, every: int = 100) -> bool:
+    """
+    key ごとに every 回に 1 回だけ True を返します。毎フレームのログを間引くために使います。
+    """
+    count = _sample_counts.get(key, 0)
+    _sample_counts[key] = count + 1
+    return count % every == 0
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import multiprocessing as mp
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+
+class PoolSaturated(Exception):
+    """
+    推論プールの待ち行列が満杯で、新しい処理を受け付けられないことを表します。
+    """
+
+
+class InferencePool:
+    """
+    イベントループを塞がないよう、重い処理をスレッドまたはプロセスのプールで実行します。
+
+    実行中と待機中の処理の合計を max_pending までに制限し、それを超えた要求は
+    待たせずに PoolSaturated で即座に断ります。
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 4, use_processes: bool = False,
+                 initializer: Optional[Callable[..., Any]] = None, initargs: tuple = ()) -> None:
+        self.max_workers = max_workers
+        self.max_pending = max(max_pending, max_workers)
+        self.use_processes = use_processes
+        self.pending = 0
+        self.rejected = 0
+        if use_processes:
+            # 親プロセスでは既に TensorFlow を読み込んでいるため、fork ではなく spawn で起動します
+            # (スレッドを持つプロセスの fork はデッドロックの原因になります)
+            self.executor: Executor = ProcessPoolExecutor(max_workers=max_workers,
+                                                          mp_context=mp.get_context("spawn"),
+                                                          initializer=initializer, initargs=initargs)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference",
+                                               initializer=initializer, initargs=initargs)
+        logging.info(f"Inference pool started ({'process' if use_processes else 'thread'} x {max_workers}, "
+                     f"max pending {self.max_pending})")
+
+    @property
+    def saturated(self) -> bool:
+        return self.pending >= self.max_pending
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """
+        fn(*args) をプールで実行して結果を返します。イベントループ上からのみ呼び出してください。
+
+        Raises:
+            PoolSaturated: 待ち行列が満杯の場合
+        """
+        if self.saturated:
+            self.rejected += 1
+            raise PoolSaturated()
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,232 @@
+import argparse
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+import numpy as np
+from facenet_pytorch import MTCNN
+
+import main as config
+from db.codec import encode_array
+from db.memory import MemoryClient
+from utils.background import Background
+from utils.embedding import ENGINES, create_engine
+from utils.face import FaceRecognition
+from utils.http import FrameSender
+from utils.pipeline import percentile
+from utils.policy import UploadPolicy
+from utils.roi import RoiSelector
+from utils.sources import SyntheticSource, open_source
+from utils.tracker import FaceTracker
+
+"""
+動き検出 → 顔検出 → 特徴ベクトル → 送信 の実際の処理を、カメラ・バックエンド・MongoDB なしで
+計測するベンチマーク。バックエンドはプロセス内の HTTP サーバー、データベースは db.memory で代用します。
+結果は JSON で出力します。
+
+    python benchmark.py --frames 600 --face-dir ./faces
+    python benchmark.py --source ./recordings/entrance.mp4 --engine onnx --model arcface.onnx --output result.json
+"""
+
+
+class StandInBackend:
+    """
+    /notification と /upload_frame を受けて 200 を返すだけのバックエンドの代わり。
+
+    Args:
+        latency (float): 応答までに待つ秒数 (バックエンドの処理時間の模擬)
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.requests = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self.rfile.read(length)
+                with backend._lock:
+                    backend.requests += 1
+                    backend.bytes += length
+                if latency:
+                    time.sleep(latency)
+                body = b'{"message": "ok"}'
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/notification"
+        self._thread = threading.Thread(target=self.server.serve_forever, name="stand-in-backend", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def peak_rss_mb() -> float:
+    # Linux では ru_maxrss は KiB 単位です
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def seed_gallery(collection, engine, users: int, samples: int = 3, seed: int = 0) -> None:
+    """
+    乱数の特徴ベクトルを持つユーザーを登録し、照合の負荷を実際の規模に近づけます。
+    """
+    height, width = engine.input_size
+    dim = engine.embed([np.zeros((height, width, 3), dtype=np.uint8)]).shape[1]
+    rng = np.random.default_rng(seed)
+    for index in range(users):
+        embeddings = rng.standard_normal((samples, dim)).astype(np.float32)
+        collection.insert_one({"user_id": index + 1, "name": f"user{index + 1}",
+                               "embeddings": encode_array(embeddings), "embedding_id": engine.embedding_id})
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    backend = StandInBackend(latency=args.backend_latency / 1000)
+    baseline_start = peak_rss_mb()
+
+    engine = create_engine(args.engine, model_path=args.model, quantize=args.quantize,
+                           intra_op_threads=args.threads)
+    face_client = MemoryClient("face")
+    seed_gallery(face_client.connect()["faces"], engine, args.gallery_size)
+    recognizer = FaceRecognition(face_client, sync_interval=None, engine=engine)
+    detector = MTCNN()
+
+    if args.source == "synthetic":
+        source = SyntheticSource(args.width, args.height, fps=args.fps, frames=args.frames + 1,
+                                 motion_rate=args.motion_rate, face_rate=args.face_rate, face_dir=args.face_dir,
+                                 seed=args.seed, realtime=args.realtime)
+    else:
+        source = open_source(args.source, width=args.width, height=args.height, fps=args.fps,
+                             realtime=args.realtime)
+
+    background = Background(MemoryClient("background"), detector=args.detector, adaptive=config.adaptive_background)
+    background.save_background(source)
+    background.load_background()
+
+    sender = FrameSender(url=backend.url, camera_id="benchmark", jpeg_quality=args.jpeg_quality,
+                         max_width=args.upload_width)
+    pipeline = config.build_pipeline(
+        background, detector, recognizer, FaceTracker(reidentify_interval=config.reidentify_interval),
+        UploadPolicy(config.upload_configs, heartbeat_interval=config.heartbeat_interval), sender,
+        RoiSelector(padding=config.roi_padding, max_coverage=config.roi_max_coverage),
+        detection_kind=config.face_detection_kind
+    )
+    baseline = peak_rss_mb()
+
+    source.start()
+    pipeline.start()
+    first = pipeline.stages[0]
+    frame_id = 0
+    submitted = 0
+    start = time.perf_counter()
+    while submitted < args.frames:
+        latest = source.read_latest(newer_than=frame_id, timeout=1.0)
+        if latest is None:
+            if source.finished:
+                break
+            continue
+        frame, captured_at, frame_id = latest
+        if not args.realtime:
+            # 全てのフレームを処理させるため、先頭の段に空きができるまで待ちます
+            while first.queue.full():
+                time.sleep(0.001)
+        pipeline.submit({"frame": frame, "captured_at": captured_at, "frame_id": frame_id})
+        submitted += 1
+
+    # 停止は段の順に行われ、各段は残ったフレームを処理してから止まります
+    pipeline.stop(timeout=60.0)
+    duration = time.perf_counter() - start
+    deadline = time.monotonic() + 10.0
+    while sender.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    sender.close()
+    source.release()
+    background.close()
+    backend.close()
+
+    stages = pipeline.stats()
+    for stage_stats in stages.values():
+        del stage_stats["queue_depth"]
+    upload = list(sender.latencies)
+    result = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "frames": submitted,
+        "duration_s": duration,
+        "fps": submitted / duration if duration else 0.0,
+        "completed_fps": stages["output"]["processed"] / duration if duration else 0.0,
+        "stages": stages,
+        "upload": {
+            "sent": sender.sent,
+            "dropped": sender.dropped,
+            "failed": sender.failed,
+            "received_by_backend": backend.requests,
+            "bytes": backend.bytes,
+            "p50_ms": percentile(upload, 50) * 1000,
+            "p99_ms": percentile(upload, 99) * 1000
+        },
+        "source": source.stats(),
+        "memory": {
+            "startup_rss_mb": baseline_start,
+            "models_loaded_rss_mb": baseline,
+            "peak_rss_mb": peak_rss_mb()
+        }
+    }
+    if isinstance(source, SyntheticSource):
+        result["events"] = source.events
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the image_process pipeline")
+    parser.add_argument("--source", default="synthetic", help="synthetic・動画ファイル・画像のディレクトリ")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--fps", type=float, default=30.0)
+    parser.add_argument("--realtime", action="store_true",
+                        help="fps に合わせて再生し、処理が追いつかないフレームは捨てます (既定は全フレームを処理)")
+    parser.add_argument("--motion-rate", type=float, default=0.3)
+    parser.add_argument("--face-rate", type=float, default=0.1)
+    parser.add_argument("--face-dir", help="合成の入力に差し込む顔写真のディレクトリ")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--detector", default=config.motion_detector)
+    parser.add_argument("--engine", choices=ENGINES, default=config.embedding_options["name"])
+    parser.add_argument("--model", default=config.embedding_options["model_path"])
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--gallery-size", type=int, default=100, help="登録済みユーザー数")
+    parser.add_argument("--jpeg-quality", type=int, default=80, help="送信する JPEG の画質")
+    parser.add_argument("--upload-width", type=int, default=0, help="送信するフレームの最大の幅 (0 なら元の大きさ)")
+    parser.add_argument("--backend-latency", type=float, default=0.0, help="バックエンドの応答時間 (ミリ秒)")
+    parser.add_argument("--output", help="結果の JSON を書き出すファイル (省略時は標準出力)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List
+
+import cv2
+import numpy as np
+from facenet_pytorch import MTCNN
+from PIL import Image
+
+from utils.embedding import (DeepFaceEngine, EmbeddingEngine, OnnxEngine, align_face, deepface_reference,
+                             export_arcface_onnx)
+from utils.gallery import normalize_rows
+
+"""
+特徴ベクトルのエンジンを比較するツール。
+同じ顔画像を DeepFace.represent (DeepFace 自身の前処理) に渡した出力を基準に、
+DeepFaceEngine.embed と ONNX Runtime (float32 / int8) の特徴ベクトルのずれと推論時間を測ります。
+
+    python compare_engines.py --export arcface.onnx
+    python compare_engines.py --model arcface.onnx --images ./registered_faces --quantize --threads 1
+"""
+logging.basicConfig(level=logging.INFO)
+
+
+def load_faces(image_dir: str, input_size, limit: int) -> List[np.ndarray]:
+    """
+    ディレクトリ内の画像から顔を検出し、モデルの入力サイズに整列した顔画像を返します。
+    """
+    detector = MTCNN()
+    faces = []
+    paths = sorted(glob.glob(os.path.join(image_dir, "**", "*.*"), recursive=True))
+    for path in paths:
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        boxes, _, landmarks = detector.detect(Image.fromarray(rgb), landmarks=True)
+        if boxes is None:
+            continue
+        for box, landmark in zip(boxes, landmarks):
+            faces.append(align_face(image, box, input_size, landmark))
+        if len(faces) >= limit:
+            break
+    return faces[:limit]
+
+
+def measure(engine: EmbeddingEngine, faces: List[np.ndarray], batch_size: int, repeat: int):
+    """
+    全ての顔の特徴ベクトルと、バッチごとの推論時間 (ミリ秒) を返します。
+    """
+    engine.warmup()
+    latencies = []
+    embeddings = None
+    for _ in range(repeat):
+        outputs = []
+        for start in range(0, len(faces), batch_size):
+            batch = faces[start:start + batch_size]
+            begin = time.perf_counter()
+            outputs.append(engine.embed(batch))
+            latencies.append((time.perf_counter() - begin) * 1000)
+        embeddings = np.concatenate(outputs)
+    return embeddings, np.asarray(latencies)
+
+
+def compare(reference: np.ndarray, embeddings: np.ndarray) -> Dict[str, float]:
+    cosine = np.sum(normalize_rows(reference) * normalize_rows(embeddings), axis=1)
+    return {
+        "cosine_mean": float(cosine.mean()),
+        "cosine_min": float(cosine.min()),
+        "max_abs_diff": float(np.abs(reference - embeddings).max())
+    }
+
+
+def summarize(latencies: np.ndarray, faces: int, batch_size: int) -> Dict[str, float]:
+    return {
+        "latency_ms_p50": float(np.percentile(latencies, 50)),
+        "latency_ms_p95": float(np.percentile(latencies, 95)),
+        "faces_per_second": float(min(faces, batch_size) / (np.median(latencies) / 1000))
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compare embedding engines against DeepFace")
+    parser.add_argument("--export", metavar="PATH", help="DeepFace の ArcFace を ONNX に書き出して終了します")
+    parser.add_argument("--model", default="arcface.onnx", help="比較する ONNX モデル")
+    parser.add_argument("--images", help="顔画像のディレクトリ (省略時は乱数の画像で数値のずれだけを確認します)")
+    parser.add_argument("--limit", type=int, default=64, help="比較に使う顔の最大数")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0, help="ONNX Runtime の intra-op スレッド数")
+    parser.add_argument("--quantize", action="store_true", help="int8 に動的量子化したモデルも比較します")
+    parser.add_argument("--tolerance", type=float, default=0.99,
+                        help="DeepFace.represent とのコサイン類似度の最小値がこれを下回ると失敗にします (int8 以外)")
+    parser.add_argument("--int8-tolerance", type=float, default=0.95)
+    args = parser.parse_args()
+
+    if args.export:
+        export_arcface_onnx(args.export)
+        logging.info(f"ONNX モデルを {args.export} に書き出しました。")
+        return 0
+
+    reference_engine = DeepFaceEngine()
+    if args.images:
+        faces = load_faces(args.images, reference_engine.input_size, args.limit)
+    else:
+        logging.warning("--images が指定されていないため乱数の画像で比較します。")
+        height, width = reference_engine.input_size
+        rng = np.random.default_rng(0)
+        faces = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(args.limit)]
+    if not faces:
+        logging.error("顔が見つかりませんでした。")
+        return 1
+    logging.info(f"{len(faces)} 個の顔で比較します。")
+
+    # 基準は DeepFace.represent の出力です。embed 同士だけを比べると、前処理が揃って
+    # 間違っている場合にも一致してしまうためです
+    begin = time.perf_counter()
+    reference = deepface_reference(faces, reference_engine.model_name)
+    report = {"represent": {"seconds": time.perf_counter() - begin}}
+
+    candidates = [("deepface", reference_engine, args.tolerance),
+                  ("onnx", OnnxEngine(args.model, intra_op_threads=args.threads), args.tolerance)]
+    if args.quantize:
+        candidates.append(("onnx_int8", OnnxEngine(args.model, quantize=True, intra_op_threads=args.threads),
+                           args.int8_tolerance))
+
+    ok = True
+    for name, engine, tolerance in candidates:
+        embeddings, latencies = measure(engine, faces, args.batch_size, args.repeat)
+        result = summarize(latencies, len(faces), args.batch_size)
+        result.update(compare(reference, embeddings))
+        result["within_tolerance"] = result["cosine_min"] >= tolerance
+        ok = ok and result["within_tolerance"]
+        report[name] = result
+
+    print(json.dumps(report, indent=2))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
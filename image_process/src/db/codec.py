@@ -0,0 +1,56 @@
+import zlib
+import numpy as np
+from bson.binary import Binary
+from typing import Any, Dict
+
+RAW = "raw"
+ZLIB = "zlib"
+
+
+def encode_array(array: np.ndarray, compress: bool = False) -> Dict[str, Any]:
+    """
+    NumPy 配列を MongoDB に保存するためのドキュメントに変換します。
+    要素は BSON の数値のリストではなく、1 つのバイナリとして保存します。
+
+    Args:
+        array (np.ndarray): 保存する配列
+        compress (bool): zlib で圧縮するか (背景画像のような uint8 の画像向け)
+
+    Returns:
+        Dict[str, Any]: dtype, shape, codec, data を持つドキュメント
+    """
+    array = np.ascontiguousarray(array)
+    data = array.tobytes()
+    if compress:
+        data = zlib.compress(data, 1)
+    return {
+        "dtype": array.dtype.str,
+        "shape": list(array.shape),
+        "codec": ZLIB if compress else RAW,
+        "data": Binary(data)
+    }
+
+
+def decode_array(doc: Dict[str, Any]) -> np.ndarray:
+    """
+    encode_array で保存したドキュメントを配列に戻します。
+    非圧縮の場合は np.frombuffer でコピーせずに読み取り専用のビューを返します。
+    """
+    data = doc["data"]
+    if doc.get("codec", RAW) == ZLIB:
+        data = zlib.decompress(data)
+    return np.frombuffer(data, dtype=np.dtype(doc["dtype"])).reshape(doc["shape"])
+
+
+def is_encoded(value: Any) -> bool:
+    return isinstance(value, dict) and "data" in value and "dtype" in value
+
+
+def decode_embeddings(value: Any) -> np.ndarray:
+    """
+    特徴ベクトルを (N, D) の float32 配列として読み込みます。
+    バイナリ形式と、旧形式の数値のリストの両方に対応します。
+    """
+    if is_encoded(value):
+        return decode_array(value)
+    return np.asarray(value, dtype=np.float32)
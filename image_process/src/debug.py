@@ -1,6 +1,8 @@
 import cv2
 import logging
+import sys
 from utils.face import FaceRecognition
+from utils.sources import open_source
 from db.client import get_client
 
 """
@@ -8,8 +10,9 @@ from db.client import get_client
 """
 logging.basicConfig(level=logging.INFO)
 
-# カメラを初期化
-cap = cv2.VideoCapture(0)
+# カメラを初期化 (引数で動画ファイルや画像のディレクトリも指定できます)
+source = sys.argv[1] if len(sys.argv) > 1 else 0
+cap = open_source(int(source) if str(source).isdigit() else source, realtime=False)
 if not cap.isOpened():
     print("Cannot open camera")
     exit()
@@ -27,8 +30,8 @@ name = "admin"
 samples = []
 
 while True:
-    ret, frame = cap.read()
-    if not ret:
+    frame = cap.read()
+    if frame is None:
         print("Failed to read frame.")
         break
 
@@ -1,11 +1,26 @@
+import glob
 import logging
+import multiprocessing as mp
+import os
+import threading
 import cv2
 import time
 import numpy as np
+from facenet_pytorch import MTCNN
 from utils.background import Background
-from utils.face import FaceRecognition
+from utils.cameras import CameraConfig, load_camera_configs
+from utils.annotate import annotate_frame
+from utils.metrics import STEP_SECONDS, MetricsDumper, MetricsServer, load_snapshots, sampled
+from utils.recognition_pool import RecognitionPool
 from db.client import get_client
-from utils.http import send_detection_data_to_server, DetectionData
+from utils.http import FrameSender, DetectionData
+from utils.tracker import FaceTracker
+from utils.policy import UploadPolicy, StateConfig, IDLE, MOTION, FACES
+from utils.pipeline import Pipeline, Stage
+from utils.recorder import ClipRecorder
+from utils.shared_sender import SharedFrameSender
+from utils.sources import open_source
+from utils.roi import RoiSelector
 from PIL import Image
 
 logging.basicConfig(
@@ -14,80 +29,365 @@ logging.basicConfig(
 )
 
 similarity_threshold = 0.85
+# motion_detector が "diff" の場合の閾値。類似度は (1 - 変化したブロックの割合) なので SSIM とは尺度が違う
+# (0.99 ならブロックの 1% 以上が変化したときに動きありとみなす)
+diff_similarity_threshold = 0.99
+motion_detector = "cascade"  # "cascade", "ssim", "diff" のいずれか
+adaptive_background = True  # 照明の変化などに合わせて背景を少しずつ更新する
+reidentify_interval = 5.0  # 同じトラックを再認識するまでの秒数
+roi_padding = 48  # 変化した領域の周囲に足して顔検出を行う余白 (ピクセル)
+roi_max_coverage = 0.6  # 変化した領域がフレームのこの割合を超えたら 1 つの領域にまとめて検出する
+# 顔検出 (MTCNN) の段の動かし方。"process" ならカメラのプロセスとは別のプロセスで動かし、
+# 動き検出や送信のスレッドと GIL を取り合わないようにする ("thread" ならカメラのプロセス内で動かす)
+face_detection_kind = "process"
 
-def main():
-    logging.info("Surveillance system started")
+# 状態ごとの送信フレームレートと縮小率、変化がないときのキーフレーム間隔 (秒)
+upload_configs = {
+    IDLE: StateConfig(max_fps=0.0, scale=0.5),
+    MOTION: StateConfig(max_fps=1.0, scale=0.5),
+    FACES: StateConfig(max_fps=5.0, scale=1.0),
+}
+heartbeat_interval = 30.0
+stats_interval = 60.0  # カメラとパイプラインの統計情報をログに出す間隔 (秒)
+
+# 動きや未登録の顔を検出したとき、その前後の映像を動画として保存する
+record_clips = True
+clip_dir = "clips"
+clip_fps = 10.0
+clip_pre_seconds = 5.0  # イベントの何秒前から保存するか
+clip_post_seconds = 10.0  # 最後のイベントの何秒後まで保存するか
+clip_buffer_jpeg = False  # True にするとイベント前のバッファを JPEG で持ちメモリを抑える (CPU は増える)
+clip_triggers = ("motion", "unknown")  # 保存を始めるイベント
+
+# transport が "shm" のカメラで、バックエンドと共有するフレームの枚数
+# (バックエンドの処理中に上書きされないよう、処理時間 × 送信フレームレートより多くする)
+shm_slots = 8
+
+camera_config_path = "cameras.json"  # 形式は cameras.example.json を参照
+# 全カメラで共有する顔認識のワーカープロセス数 (0 ならコア数に合わせる)
+recognition_workers = 0
+# コア数に合わせる場合の上限 (0 なら上限なし)。ワーカーごとにモデル (ArcFace で数百 MB) と
+# ギャラリーを読み込むため、コア数の多いマシンでもメモリに収まる数にする
+recognition_max_workers = 4
+# 特徴ベクトルを求めるエンジン。"onnx" の場合は compare_engines.py --export で書き出したモデルを使う
+embedding_options = {
+    "name": "deepface",
+    "model_path": "arcface.onnx",
+    "quantize": False,  # int8 の動的量子化
+    "intra_op_threads": 1,  # 1 つの推論のスレッド数 ("onnx" のみ。"deepface" では TensorFlow の既定のまま)
+}
+
+# 各プロセスの処理時間などの指標。プロセスごとに metrics_dir へ書き出し、
+# メインプロセスが http://127.0.0.1:{metrics_port}/metrics でまとめて返す (0 なら無効)
+metrics_port = 9100
+metrics_dir = "metrics"
+metrics_dump_interval = 10.0
+
+
+def detect_faces_in_regions(detector, frame, regions):
+    """
+    フレームの各領域を切り出して MTCNN で顔を検出し、座標を元のフレームに戻して返します。
+
+    Returns:
+        Tuple[Optional[np.ndarray], Optional[np.ndarray]]: 顔の矩形 (N, 4) と特徴点 (N, 5, 2)。顔が無ければ (None, None)
+    """
+    min_size = getattr(detector, "min_face_size", 20)
+    all_boxes, all_landmarks = [], []
+    with STEP_SECONDS.time(step="detection"):
+        for x1, y1, x2, y2 in regions:
+            if x2 - x1 < min_size or y2 - y1 < min_size:
+                continue
+            # 切り出した範囲だけ RGB に変換する
+            crop_rgb = cv2.cvtColor(frame[y1:y2, x1:x2], cv2.COLOR_BGR2RGB)
+            boxes, _, landmarks = detector.detect(Image.fromarray(crop_rgb), landmarks=True)
+            if boxes is None:
+                continue
+            offset = np.array([x1, y1], dtype=boxes.dtype)
+            all_boxes.append(boxes + np.tile(offset, 2))
+            all_landmarks.append(landmarks + offset)
+    if not all_boxes:
+        return None, None
+    return np.concatenate(all_boxes), np.concatenate(all_landmarks)
+
+
+# face_detection_kind が "process" の場合に、顔検出のプロセスで使う MTCNN
+_process_detector = None
+
+
+def init_detection_worker() -> None:
+    global _process_detector
+    _process_detector = MTCNN()
+
+
+def detect_faces_job(job):
+    """
+    顔検出のプロセスで (フレーム, 領域) の顔を検出します (detect_faces_in_regions を参照)。
+    """
+    return detect_faces_in_regions(_process_detector, *job)
+
+
+def build_pipeline(background, detector, recognizer, tracker, upload_policy, sender, roi_selector,
+                   recorder=None, detection_kind: str = "thread") -> Pipeline:
+    """
+    動き検出 → 顔検出 → 追跡 → 顔認識 → アノテーションと送信 の段をつないだパイプラインを作ります。
+    フレームの順序を保つため各段は 1 ワーカーで動かし、顔検出の段は detection_kind="process" なら
+    別のプロセスで動かします。トラッカーは追跡と送信の 2 つの段から使うため、ロックで守ります。
+
+    Args:
+        detector: 顔検出に使う MTCNN (detection_kind="thread" の場合)
+        recognizer: identify_faces(frame, boxes, landmarks) を持つ顔認識 (FaceRecognition や RecognitionClient)
+        roi_selector (RoiSelector): 顔検出を行う領域を決める
+        recorder (Optional[ClipRecorder]): イベントの前後の映像を保存する (None なら保存しない)
+        detection_kind (str): 顔検出の段を "thread" と "process" のどちらで動かすか
+    """
+
+    tracker_lock = threading.Lock()
+    threshold = diff_similarity_threshold if background.detector == "diff" else similarity_threshold
+
+    def detect_motion(item):
+        current_frame = item["frame"]
+        similarity = background.compute_similarity_with_frame(current_frame)
+        if similarity is None:
+            print("Failed to compute similarity.")
+            return None
+        item["motion"] = similarity < threshold
+        item["job"] = None
+        if item["motion"]:
+            if sampled("difference"):
+                logging.debug("Difference detected")
+            # 変化した領域 (と設定した検出領域) の周辺だけで MTCNN を使用して顔検出する
+            # (変化したブロックは次のフレームで上書きされるため、この段で領域にしておく)
+            regions = roi_selector.select(current_frame.shape, background.last_changed_blocks)
+            if sampled("regions"):
+                logging.debug(f"Face detection on {len(regions)} regions ({roi_selector.last_coverage:.0%} of frame)")
+            item["job"] = (current_frame, regions)
+        return item
+
+    def detect_faces(item):
+        job = item.get("job")
+        item["result"] = None if job is None else detect_faces_in_regions(detector, *job)
+        return item
+
+    def track_faces(item):
+        boxes, landmarks = item.get("result") or (None, None)
+        item.update(boxes=None, job=None, result=None)
+        current_frame = item["frame"]
+        if boxes is not None:
+            keep = roi_selector.allowed(boxes, current_frame.shape)
+            boxes, landmarks = (boxes[keep], landmarks[keep]) if keep.any() else (None, None)
+        if boxes is None:
+            with tracker_lock:
+                tracker.update(None)
+            return item
 
-    background_client = get_client("background")
-    face_client = get_client("face")
+        # 新しい顔・信頼度の下がった顔・再認識の時期が来た顔だけを認識の段へ回す
+        now = time.monotonic()
+        with tracker_lock:
+            tracks = tracker.update(boxes, now)
+            pending = [i for i, track in enumerate(tracks) if tracker.needs_identification(track, now)]
+            for i in pending:
+                tracker.mark_pending(tracks[i], now)
+        item.update(boxes=boxes, tracks=tracks, pending=pending)
+        if pending:
+            item["job"] = (current_frame, boxes[pending], None if landmarks is None else landmarks[pending])
+        return item
 
-    background = Background(background_client)
-    face_recognition_module = FaceRecognition(face_client)
+    def identify_faces(item):
+        job = item.get("job")
+        item["result"] = None if job is None else recognizer.identify_faces(*job)
+        return item
+
+    def annotate_and_send(item):
+        current_frame = item["frame"]
+        boxes = item["boxes"]
+        if boxes is not None:
+            tracks = item["tracks"]
+            now = time.monotonic()
+            with tracker_lock:
+                for i, (name, score) in zip(item["pending"], item.get("result") or []):
+                    tracker.assign(tracks[i], name, score, now)
+                    logging.info(f"Detected person: {name} (score: {score:.3f}, track: {tracks[i].track_id})")
+                names = [track.name for track in tracks]
+                # 認識の結果を待っているトラックも名前は "unknown" なので、認識済みのトラックだけで判定する
+                unknown_faces = any(track.identified_at is not None and track.name == "unknown"
+                                    for track in tracks)
+
+            # フレームにアノテーションを追加
+            with STEP_SECONDS.time(step="annotation"):
+                annotated_frame = annotate_frame(current_frame, boxes, names)
+
+            state, frame_to_send = FACES, annotated_frame
+            data = DetectionData(status="person detected", detail=f"Detected persons: {names}")
+        elif item["motion"]:
+            if sampled("no_faces"):
+                logging.debug("No faces detected.")
+            names = []
+            unknown_faces = False
+            state, frame_to_send = MOTION, current_frame
+            data = DetectionData(status="face not detected", detail="No faces detected")
+        else:
+            # 差分がない場合
+            names = []
+            unknown_faces = False
+            state, frame_to_send = IDLE, current_frame
+            data = DetectionData(status="no difference detected", detail="background unchanged")
+
+        if recorder is not None:
+            if "unknown" in clip_triggers and unknown_faces:
+                recorder.trigger("unknown")
+            elif "motion" in clip_triggers and item["motion"]:
+                recorder.trigger("motion")
+
+        # 状態が変わったとき・人物が変わったとき・ハートビートのときだけ送信 (エンコードと送信は送信スレッドで行う)
+        config = upload_policy.decide(state, names)
+        if config is not None:
+            sender.send(UploadPolicy.prepare(frame_to_send, config), data)
+        return None
+
+    if detection_kind == "process":
+        detection = Stage("detection", detect_faces_job, kind="process", initializer=init_detection_worker)
+    else:
+        detection = Stage("detection", detect_faces)
+    return Pipeline([
+        Stage("motion", detect_motion),
+        detection,
+        Stage("tracking", track_faces),
+        Stage("recognition", identify_faces),
+        Stage("output", annotate_and_send),
+    ])
+
+
+def run_camera(config: CameraConfig, recognizer) -> None:
+    """
+    1 台のカメラの取得・動き検出・顔検出・送信を行うプロセスの本体。
+    顔認識は共有のプールに依頼します。
+    """
+    logging.basicConfig(format=f'%(levelname)s: [{config.camera_id}] %(message)s', level=logging.INFO)
+    logging.info(f"Camera process started: {config}")
+
+    background = Background(get_client("background"), camera_id=config.camera_id,
+                            detector=motion_detector, adaptive=adaptive_background)
+    # 顔検出を別のプロセスで動かす場合、MTCNN はそのプロセスの中で読み込む
+    detector = MTCNN() if face_detection_kind == "thread" else None
+    tracker = FaceTracker(reidentify_interval=reidentify_interval)
+    sender = FrameSender(camera_id=config.camera_id, jpeg_quality=config.jpeg_quality,
+                         max_width=config.upload_width)
+    if config.transport == "shm":
+        sender = SharedFrameSender(config.camera_id, (config.height, config.width, 3), fallback=sender,
+                                   slots=shm_slots)
+    upload_policy = UploadPolicy(upload_configs, heartbeat_interval=heartbeat_interval)
+    roi_selector = RoiSelector(config.zones, config.masks, padding=roi_padding, max_coverage=roi_max_coverage)
+    dumper = None
+    if metrics_port:
+        dumper = MetricsDumper(os.path.join(metrics_dir, f"camera-{config.camera_id}.json"),
+                               interval=metrics_dump_interval).start()
+
+    camera = open_source(config.source, width=config.width, height=config.height, fps=config.fps)
+    if not camera.isOpened():
+        print("Cannot open camera")
+        return
 
     logging.info("Background image saving started")
-    background.save_background()
+    print("Please move away from the camera to save the background image.")
+    time.sleep(1)
+    background.save_background(camera)
 
     logging.info("Background image loading started")
     background.load_background()
 
-    cap = cv2.VideoCapture(0)
-    if not cap.isOpened():
-        print("Cannot open camera")
-        return
+    camera.start()
+
+    recorder = None
+    if record_clips:
+        recorder = ClipRecorder(clip_dir, camera_id=config.camera_id, frame_size=(config.width, config.height),
+                                fps=clip_fps, pre_seconds=clip_pre_seconds, post_seconds=clip_post_seconds,
+                                encode_jpeg=clip_buffer_jpeg)
 
+    pipeline = build_pipeline(background, detector, recognizer, tracker, upload_policy, sender,
+                              roi_selector, recorder, detection_kind=face_detection_kind).start()
+
+    frame_id = 0
+    last_stats = time.monotonic()
     try:
         while True:
-            ret, current_frame = cap.read()
-            if not ret:
+            # 処理中に溜まった古いフレームは捨て、常に最新のフレームをパイプラインに流す
+            latest = camera.read_latest(newer_than=frame_id, timeout=1.0)
+            if latest is None:
+                if camera.finished:
+                    logging.info("Frame source finished")
+                    break
                 print("Failed to read frame.")
                 continue
+            current_frame, captured_at, frame_id = latest
+            if recorder is not None:
+                recorder.push(current_frame, captured_at)
+            pipeline.submit({"frame": current_frame, "captured_at": captured_at, "frame_id": frame_id})
 
-            similarity = background.compute_similarity_with_frame(current_frame)
-            if similarity is None:
-                print("Failed to compute similarity.")
-                continue
-
-            if similarity < similarity_threshold:
-                logging.info("Difference detected")
+            if time.monotonic() - last_stats >= stats_interval:
+                last_stats = time.monotonic()
+                stats = camera.stats()
+                logging.info(f"Camera: {stats['capture_fps']:.1f} fps, {stats['dropped_frames']} frames dropped")
+                for name, stage_stats in pipeline.stats().items():
+                    logging.info(f"Stage {name}: queue {stage_stats['queue_depth']}, "
+                                 f"{stage_stats['latency_ms']:.1f} ms/frame, "
+                                 f"{stage_stats['processed']} processed, {stage_stats['dropped']} dropped, "
+                                 f"{stage_stats['errors']} errors")
 
-                # フレームを RGB に変換
-                image_rgb = cv2.cvtColor(current_frame, cv2.COLOR_BGR2RGB)
-                pil_image = Image.fromarray(image_rgb)
+    except KeyboardInterrupt:
+        logging.info("Camera process stopped")
+    finally:
+        pipeline.stop()
+        background.close()
+        if recorder is not None:
+            recorder.stop()
+        sender.close()
+        camera.release()
+        if dumper is not None:
+            dumper.stop()
 
-                # MTCNN を使用して顔検出
-                boxes, _ = face_recognition_module.mtcnn.detect(pil_image)
 
-                if boxes is not None:
-                    names = []
-                    for box in boxes:
-                        x1, y1, x2, y2 = map(int, box)
-                        face_crop = current_frame[y1:y2, x1:x2]
+def main():
+    logging.info("Surveillance system started")
 
-                        # ユーザーの確認
-                        name, score = face_recognition_module.verify_user(face_crop)
-                        logging.info(f"Detected person: {name} (score: {score:.3f})")
-                        names.append(name)
+    configs = load_camera_configs(camera_config_path)
+    context = mp.get_context("spawn")  # PyTorch / TensorFlow は fork に対応していないため spawn を使う
 
-                    # フレームにアノテーションを追加
-                    annotated_frame = face_recognition_module.annotate_frame(current_frame, boxes, names)
+    metrics_server = None
+    if metrics_port:
+        # 前回の実行で書き出された指標が混ざらないよう消しておく
+        os.makedirs(metrics_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+            os.remove(path)
+        metrics_server = MetricsServer(metrics_port, collect=lambda: load_snapshots(metrics_dir)).start()
 
-                    data = DetectionData(status="person detected", detail=f"Detected persons: {names}")
-                    send_detection_data_to_server(annotated_frame, data)
-                else:
-                    logging.info("No faces detected.")
-                    data = DetectionData(status="face not detected", detail="No faces detected")
-                    send_detection_data_to_server(current_frame, data)
-            else:
-                # 差分がない場合
-                data = DetectionData(status="no difference detected", detail="background unchanged")
-                send_detection_data_to_server(current_frame, data)
+    # 顔認識はカメラの台数によらずコア数に合わせたプールで共有する
+    pool = RecognitionPool([config.camera_id for config in configs], workers=recognition_workers,
+                           max_workers=recognition_max_workers,
+                           context=context, engine_options=embedding_options,
+                           metrics_dir=metrics_dir if metrics_port else None,
+                           metrics_interval=metrics_dump_interval).start()
 
-            time.sleep(0.01)
+    # カメラごとに取得・動き検出のプロセスを起動する
+    processes = []
+    for config in configs:
+        process = context.Process(target=run_camera, args=(config, pool.client(config.camera_id)),
+                                  name=f"camera-{config.camera_id}")
+        process.start()
+        processes.append(process)
 
+    try:
+        for process in processes:
+            process.join()
     except KeyboardInterrupt:
         logging.info("Surveillance system stopped")
     finally:
-        cap.release()
+        for process in processes:
+            process.join(timeout=5.0)
+            if process.is_alive():
+                process.terminate()
+        pool.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
         cv2.destroyAllWindows()  # OpenCV のウィンドウを閉じる
 
 if __name__ == '__main__':
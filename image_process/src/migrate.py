@@ -0,0 +1,119 @@
+import argparse
+import glob
+import logging
+import os
+from datetime import datetime
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+from db.client import get_client
+from db.codec import encode_array, is_encoded
+from utils.embedding import ENGINES, LEGACY_EMBEDDING_ID, EmbeddingEngine, create_engine
+
+"""
+旧形式 (数値のリスト) で保存された背景画像と特徴ベクトルを
+バイナリ形式に変換するマイグレーション
+
+--reembed を指定すると、今のエンジンと違うモデル・前処理で作られた特徴ベクトルを
+ユーザーごとの顔画像 (<ディレクトリ>/<名前>/*.jpg) から作り直します。
+
+    python migrate.py
+    python migrate.py --reembed ./registered_faces --engine onnx --model arcface.onnx
+"""
+logging.basicConfig(level=logging.INFO)
+
+
+def migrate_faces(collection) -> int:
+    migrated = 0
+    for doc in collection.find({}, {"embeddings": 1}):
+        embeddings = doc.get("embeddings")
+        if embeddings is None or is_encoded(embeddings):
+            continue
+        array = np.asarray(embeddings, dtype=np.float32)
+        collection.update_one({"_id": doc["_id"]}, {"$set": {"embeddings": encode_array(array)}})
+        migrated += 1
+    return migrated
+
+
+def migrate_background(collection) -> int:
+    migrated = 0
+    for doc in collection.find({"background_vector": {"$exists": True}}):
+        array = np.asarray(doc["background_vector"], dtype=np.uint8).reshape(doc["shape"])
+        collection.update_one(
+            {"_id": doc["_id"]},
+            {
+                "$set": {"background": encode_array(array, compress=True)},
+                "$unset": {"background_vector": "", "shape": ""}
+            }
+        )
+        migrated += 1
+    return migrated
+
+
+def find_stale_faces(collection, engine: EmbeddingEngine) -> List[dict]:
+    """
+    今のエンジンと embedding_id が違う (照合に使われない) ユーザーのドキュメントを返します。
+    """
+    return [doc for doc in collection.find({}, {"name": 1, "embedding_id": 1})
+            if doc.get("embedding_id", LEGACY_EMBEDDING_ID) != engine.embedding_id]
+
+
+def reembed_faces(collection, engine: EmbeddingEngine, image_dir: str) -> Tuple[int, List[str]]:
+    """
+    image_dir/<名前>/ の顔画像から、embedding_id が今のエンジンと違うユーザーの特徴ベクトルを作り直します。
+
+    Returns:
+        Tuple[int, List[str]]: (作り直したユーザー数, 顔画像が無いため作り直せなかったユーザーの名前)
+    """
+    reembedded = 0
+    missing = []
+    for doc in find_stale_faces(collection, engine):
+        name = doc.get("name", "")
+        embeddings = []
+        for path in sorted(glob.glob(os.path.join(image_dir, name, "*.*"))):
+            image = cv2.imread(path)
+            if image is None:
+                continue
+            try:
+                representations = engine.represent(image, enforce_detection=True)
+            except ValueError:
+                logging.warning(f"{path} で顔が検出されませんでした。")
+                continue
+            embeddings.append(representations[0][2])
+        if not embeddings:
+            missing.append(name)
+            continue
+        collection.update_one(
+            {"_id": doc["_id"]},
+            {"$set": {"embeddings": encode_array(np.asarray(embeddings, dtype=np.float32)),
+                      "embedding_id": engine.embedding_id, "updated_at": datetime.utcnow()}}
+        )
+        reembedded += 1
+    return reembedded, missing
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrate stored faces and backgrounds")
+    parser.add_argument("--reembed", metavar="DIR", help="ユーザーごとの顔画像のディレクトリ (<DIR>/<名前>/*.jpg)")
+    parser.add_argument("--engine", choices=ENGINES, default="deepface", help="照合に使うエンジン")
+    parser.add_argument("--model", default="arcface.onnx", help="--engine onnx のモデル")
+    args = parser.parse_args()
+
+    face_db = get_client("face").connect()
+    count = migrate_faces(face_db["faces"])
+    logging.info(f"{count} 件の顔データを変換しました。")
+
+    background_db = get_client("background").connect()
+    count = migrate_background(background_db["background"])
+    logging.info(f"{count} 件の背景画像を変換しました。")
+
+    engine = create_engine(args.engine, model_path=args.model)
+    if args.reembed:
+        count, missing = reembed_faces(face_db["faces"], engine, args.reembed)
+        logging.info(f"{count} 人のユーザーの特徴ベクトルを {engine.embedding_id} で作り直しました。")
+    else:
+        missing = [doc.get("name", "") for doc in find_stale_faces(face_db["faces"], engine)]
+    if missing:
+        logging.warning(f"次のユーザーの特徴ベクトルは {engine.embedding_id} と比較できず、照合に使われません。"
+                        f"--reembed で顔画像から作り直すか、再登録してください: {missing}")
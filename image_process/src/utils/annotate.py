@@ -0,0 +1,31 @@
+import cv2
+import numpy as np
+from typing import List
+
+
+def annotate_frame(frame: np.ndarray, boxes: np.ndarray, names: List[str]) -> np.ndarray:
+    """
+    フレームに検出された顔の位置と名前を描画します。
+
+    Args:
+        frame (np.ndarray): 元のフレーム
+        boxes (np.ndarray): 顔のバウンディングボックスの配列
+        names (List[str]): 各顔に対応する名前のリスト
+
+    Returns:
+        np.ndarray: アノテーションが追加されたフレーム
+    """
+    for box, name in zip(boxes, names):
+        x1, y1, x2, y2 = map(int, box)
+        if name != "unknown":
+            label = name
+            color = (0, 255, 0)  # 緑
+        else:
+            label = "unknown"
+            color = (0, 0, 255)  # 赤
+
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+        cv2.putText(frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.9, color, 2)
+
+    return frame
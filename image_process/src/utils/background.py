@@ -1,51 +1,146 @@
 import logging
 import cv2
 import numpy as np
+import threading
 import time
+from typing import Dict, List, Optional, Tuple
 from skimage.metrics import structural_similarity as ssim
 from db.client import MongoDBClient
+from db.codec import decode_array, encode_array
+from utils.metrics import DB_SECONDS, STEP_SECONDS, sampled
 logging.basicConfig(
     format='%(levelname)s: %(message)s'
 )
 
 
+DETECTORS = ("cascade", "ssim", "diff")
+MODEL_SIZE = (320, 240)
+DEFAULT_CAMERA_ID = "default"
+
+
 class Background:
-    def __init__(self, db_client: MongoDBClient):
+    """
+    背景画像との比較で動きを検出します。
+
+    detector は次のいずれかです。
+        "ssim": 毎フレーム SSIM を計算します (従来の動作)
+        "diff": 縮小画像のブロック差分だけで判定します
+        "cascade": ブロック差分が閾値を超えたときだけ SSIM を計算します
+
+    adaptive=True の場合、背景は指数移動平均で少しずつ更新され、照明の変化に追従します。
+    動きのある領域は更新せずに凍結し、前景マスクとその外接矩形を取り出せます。
+    更新した背景は snapshot_interval 秒ごとに別のスレッドからデータベースへ保存します。
+
+    背景はカメラごとに camera_id をキーとして保存します。
+    """
+
+    def __init__(self, db_client: MongoDBClient, camera_id: str = DEFAULT_CAMERA_ID, detector: str = "cascade",
+                 block_size: Tuple[int, int] = (80, 60), block_threshold: int = 12,
+                 min_changed_ratio: float = 0.002, adaptive: bool = False,
+                 learning_rate: float = 0.02, foreground_threshold: int = 25,
+                 min_region_area: int = 20, snapshot_interval: float = 300.0):
+        if detector not in DETECTORS:
+            raise ValueError(f"detector must be one of {DETECTORS}")
         self.background = None
+        self.background_blocks = None
         self.db = db_client.connect()
         self.collection = self.db["background"]
+        self.camera_id = camera_id
 
-    def save_background(self):
-        cap = cv2.VideoCapture(0)
-        if not cap.isOpened():
-            print("cannot open camera")
-            return
+        self.detector = detector
+        self.block_size = block_size
+        self.block_threshold = block_threshold
+        self.min_changed_ratio = min_changed_ratio
+        self.last_changed_blocks: Optional[np.ndarray] = None
+        self.last_timings: Dict[str, float] = {}
 
-        print("Please move away from the camera to save the background image.")
-        time.sleep(1)
+        # 適応的な背景モデル。更新は全て確保済みの配列上でその場で行います
+        self.adaptive = adaptive
+        self.learning_rate = learning_rate
+        self.foreground_threshold = foreground_threshold
+        self.min_region_area = min_region_area
+        self.snapshot_interval = snapshot_interval
+        self.last_snapshot = time.monotonic()
+        self.frame_shape: Optional[Tuple[int, int]] = None
+        width, height = MODEL_SIZE
+        self._model = np.zeros((height, width), dtype=np.float32)
+        self._model_u8 = np.zeros((height, width), dtype=np.uint8)
+        self._resized = np.zeros((height, width, 3), dtype=np.uint8)
+        self._gray = np.zeros((height, width), dtype=np.uint8)
+        self._diff = np.zeros((height, width), dtype=np.uint8)
+        self._foreground = np.zeros((height, width), dtype=np.uint8)
+        self._frozen = np.zeros((height, width), dtype=np.uint8)
+        self._update_mask = np.zeros((height, width), dtype=np.uint8)
+        self._kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
 
-        ret, frame = cap.read()
-        cap.release()
+        # 背景の保存は動き検出を待たせないよう別のスレッドで行い、保存待ちは最新の 1 枚だけ持ちます
+        self._snapshot_cond = threading.Condition()
+        self._pending_snapshot: Optional[np.ndarray] = None
+        self._snapshot_thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def save_background(self, source=0):
+        """
+        背景画像を撮影して保存します。
+
+        Args:
+            source: デバイス番号・URL、または開いている入力 (utils.sources.FrameSource)
+        """
+        if hasattr(source, "read"):
+            # 既に開いている入力から 1 枚読みます (同じデバイスを二重に開かないため)
+            frame = source.read()
+            ret = frame is not None
+        else:
+            cap = cv2.VideoCapture(source)
+            if not cap.isOpened():
+                print("cannot open camera")
+                return
+
+            print("Please move away from the camera to save the background image.")
+            time.sleep(1)
+
+            ret, frame = cap.read()
+            cap.release()
         if ret:
-            resized_frame = cv2.resize(frame, (320, 240))
+            resized_frame = cv2.resize(frame, MODEL_SIZE)
             gray_frame = cv2.cvtColor(resized_frame, cv2.COLOR_BGR2GRAY)
-
-            bg_vector = gray_frame.flatten().tolist()
-            bg_data = {
-                "background_vector": bg_vector,
-                "shape": gray_frame.shape
-            }
-            self.collection.delete_many({})
-            self.collection.insert_one(bg_data)
+            self.store_background(gray_frame)
             print("saved background image to MongoDB.")
         else:
             print("Failed to capture background image.")
 
+    def store_background(self, gray_frame: np.ndarray) -> None:
+        # 画素は数値のリストではなく、圧縮したバイナリとして保存します
+        bg_data = {
+            "camera_id": self.camera_id,
+            "background": encode_array(gray_frame, compress=True)
+        }
+        with DB_SECONDS.time(operation="store_background"):
+            self.collection.delete_many(self._query())
+            self.collection.insert_one(bg_data)
+
+    def _query(self):
+        if self.camera_id == DEFAULT_CAMERA_ID:
+            # camera_id を持たない旧形式のドキュメントは既定のカメラのものとして扱います
+            return {"$or": [{"camera_id": self.camera_id}, {"camera_id": {"$exists": False}}]}
+        return {"camera_id": self.camera_id}
+
     def load_background(self):
-        bg_data = self.collection.find_one()
+        with DB_SECONDS.time(operation="load_background"):
+            bg_data = self.collection.find_one(self._query())
         if bg_data:
-            bg_vector = np.array(bg_data["background_vector"], dtype=np.uint8)
-            self.background = bg_vector.reshape(bg_data["shape"])
+            if "background" in bg_data:
+                self.background = decode_array(bg_data["background"])
+            else:
+                # 旧形式 (数値のリスト) のドキュメント
+                bg_vector = np.array(bg_data["background_vector"], dtype=np.uint8)
+                self.background = bg_vector.reshape(bg_data["shape"])
+            if self.adaptive:
+                # 以後は確保済みの配列を背景として使い回します
+                self._model[...] = self.background
+                self._model_u8[...] = self.background
+                self.background = self._model_u8
+            self.background_blocks = cv2.resize(self.background, self.block_size, interpolation=cv2.INTER_AREA)
             print("loaded background image from MongoDB.")
         else:
             print("no background image found in MongoDB.")
@@ -80,15 +175,156 @@ class Background:
 
         avg_frame = np.mean(frames, axis=0).astype(np.uint8)
         return avg_frame
+    def update_model(self, frame) -> np.ndarray:
+        """
+        フレームから前景マスクを求め、動きのない領域だけ背景モデルを更新します。
+
+        Returns:
+            np.ndarray: MODEL_SIZE での前景マスク (0 または 255)
+        """
+        self._to_gray(frame)
+        return self._update_from_gray()
+
+    def _to_gray(self, frame) -> None:
+        self.frame_shape = frame.shape[:2]
+        cv2.resize(frame, MODEL_SIZE, dst=self._resized, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._resized, cv2.COLOR_BGR2GRAY, dst=self._gray)
+
+    def _update_from_gray(self) -> np.ndarray:
+        cv2.absdiff(self._gray, self._model_u8, dst=self._diff)
+        cv2.threshold(self._diff, self.foreground_threshold, 255, cv2.THRESH_BINARY, dst=self._foreground)
+        cv2.morphologyEx(self._foreground, cv2.MORPH_OPEN, self._kernel, dst=self._foreground)
+
+        # 動いている物体の周辺は背景に溶け込まないよう少し広めに凍結します
+        cv2.dilate(self._foreground, self._kernel, dst=self._frozen, iterations=2)
+        cv2.bitwise_not(self._frozen, dst=self._update_mask)
+        cv2.accumulateWeighted(self._gray, self._model, self.learning_rate, mask=self._update_mask)
+        cv2.convertScaleAbs(self._model, dst=self._model_u8)
+        cv2.resize(self._model_u8, self.block_size, dst=self.background_blocks, interpolation=cv2.INTER_AREA)
+
+        now = time.monotonic()
+        if now - self.last_snapshot >= self.snapshot_interval:
+            self._queue_snapshot(self._model_u8.copy())
+            self.last_snapshot = now
+        return self._foreground
+
+    def _queue_snapshot(self, snapshot: np.ndarray) -> None:
+        with self._snapshot_cond:
+            if self._closed:
+                return
+            self._pending_snapshot = snapshot
+            if self._snapshot_thread is None:
+                self._snapshot_thread = threading.Thread(target=self._snapshot_loop,
+                                                         name=f"background-{self.camera_id}", daemon=True)
+                self._snapshot_thread.start()
+            self._snapshot_cond.notify()
+
+    def _snapshot_loop(self) -> None:
+        while True:
+            with self._snapshot_cond:
+                self._snapshot_cond.wait_for(lambda: self._pending_snapshot is not None or self._closed)
+                snapshot, self._pending_snapshot = self._pending_snapshot, None
+            if snapshot is not None:
+                try:
+                    self.store_background(snapshot)
+                except Exception as e:
+                    logging.error(f"Failed to store background: {e}")
+            with self._snapshot_cond:
+                if self._closed and self._pending_snapshot is None:
+                    return
+
+    def close(self, timeout: float = 5.0) -> None:
+        """
+        保存待ちの背景を書き出してから保存のスレッドを止めます。
+        """
+        with self._snapshot_cond:
+            self._closed = True
+            self._snapshot_cond.notify_all()
+            thread = self._snapshot_thread
+        if thread is not None:
+            thread.join(timeout=timeout)
+
+    def foreground_regions(self) -> List[Tuple[int, int, int, int]]:
+        """
+        直近の前景マスクから変化した領域の外接矩形を元のフレームの座標で返します。
+
+        Returns:
+            List[Tuple[int, int, int, int]]: (x1, y1, x2, y2) のリスト
+        """
+        if self.frame_shape is None:
+            return []
+        count, _, stats, _ = cv2.connectedComponentsWithStats(self._foreground, connectivity=8)
+        height, width = self.frame_shape
+        sx, sy = width / MODEL_SIZE[0], height / MODEL_SIZE[1]
+        regions = []
+        for x, y, w, h, area in stats[1:count]:
+            if area < self.min_region_area:
+                continue
+            regions.append((int(x * sx), int(y * sy), int((x + w) * sx), int((y + h) * sy)))
+        return regions
+
+    def changed_block_ratio(self, frame) -> float:
+        """
+        フレームを縮小したブロック平均と背景を比べ、変化したブロックの割合を返します。
+        変化したブロックのマスクは last_changed_blocks に残します。
+        """
+        small = cv2.resize(frame, self.block_size, interpolation=cv2.INTER_AREA)
+        small_gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        diff = cv2.absdiff(small_gray, self.background_blocks)
+        self.last_changed_blocks = diff > self.block_threshold
+        return float(np.count_nonzero(self.last_changed_blocks)) / diff.size
+
     def compute_similarity_with_frame(self, frame):
+        """
+        フレームと背景の類似度を返します。"ssim" と "cascade" は SSIM、"diff" は 1 - 変化したブロックの割合で、
+        尺度が違うため "diff" には専用の閾値を使ってください。
+        adaptive=True の場合、判定には更新前の背景を使い、判定の後で背景モデルを更新します。
+        """
         if self.background is None:
             print("no background image loaded.")
             raise ValueError("no background image loaded.")
 
-        resized_frame = cv2.resize(frame, (320, 240))
-        frame_gray = cv2.cvtColor(resized_frame, cv2.COLOR_BGR2GRAY)
+        self.last_timings = {}
+        if self.adaptive:
+            start = time.perf_counter()
+            self._to_gray(frame)
+            self.last_timings["model_update"] = time.perf_counter() - start
 
-        similarity, _ = ssim(self.background, frame_gray, full=True)
-        logging.info(f"SSIM: {similarity:.4f}")
+        similarity = self._similarity(frame)
+
+        if self.adaptive:
+            start = time.perf_counter()
+            self._update_from_gray()
+            self.last_timings["model_update"] += time.perf_counter() - start
+        self._observe_timings()
+        return similarity
+
+    def _similarity(self, frame) -> float:
+        if self.detector != "ssim":
+            start = time.perf_counter()
+            changed_ratio = self.changed_block_ratio(frame)
+            self.last_timings["block_diff"] = time.perf_counter() - start
+
+            if self.detector == "diff":
+                return 1.0 - changed_ratio
+            if changed_ratio < self.min_changed_ratio:
+                # 安価な判定で変化なしとみなせる場合は SSIM を計算しません
+                return 1.0
+
+        start = time.perf_counter()
+        if self.adaptive:
+            frame_gray = self._gray
+        else:
+            resized_frame = cv2.resize(frame, MODEL_SIZE)
+            frame_gray = cv2.cvtColor(resized_frame, cv2.COLOR_BGR2GRAY)
+
+        similarity = ssim(self.background, frame_gray)
+        self.last_timings["ssim"] = time.perf_counter() - start
+        if sampled("ssim"):
+            logging.debug(f"SSIM: {similarity:.4f}")
+
+        return similarity
 
-        return similarity
\ No newline at end of file
+    def _observe_timings(self) -> None:
+        for step, elapsed in self.last_timings.items():
+            STEP_SECONDS.observe(elapsed, step=f"motion_{step}")
@@ -1,50 +1,80 @@
+import time
+
 import cv2
 import numpy as np
 
-class Camera:
-    def __init__(self, camera_id=0):
+from utils.sources import FrameSource
+
+
+class Camera(FrameSource):
+    """
+    カメラ (デバイス番号または URL) からの入力。start() 後はバックグラウンドで最新フレームを取得し続けます。
+    """
+
+    live = True
+
+    def __init__(self, camera_id=0, width=640, height=480, fps=30):
+        super().__init__(fps=fps, realtime=True)
         self.camera_id = camera_id
         self.cap = cv2.VideoCapture(self.camera_id)
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-        self.cap.set(cv2.CAP_PROP_FPS, 30)
-    
-    def read(self):
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.cap.set(cv2.CAP_PROP_FPS, fps)
+        # ドライバー側のバッファを最小にして古いフレームが溜まらないようにする
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    def next_frame(self):
         ret, frame = self.cap.read()
-        return frame
-    
+        return frame if ret else None
+
     def isOpened(self):
         return self.cap.isOpened()
-    
+
     def take_photo(self) -> np.ndarray:
-        ret, frame = self.cap.read()
-        return frame 
-    
+        return self.read()
+
     def take_video(self, filename, duration=10):
+        """
+        duration 秒の動画を撮影します。撮影中は呼び出し元を止めるため、監視中の録画には
+        utils.recorder.ClipRecorder を使ってください。
+        start() 後は取得スレッドと同じデバイスを読み合わないよう、取得スレッドの最新フレームを使います。
+        """
         fourcc = cv2.VideoWriter_fourcc(*'XVID')
-        out = cv2.VideoWriter(filename, fourcc, 20.0, (640, 480))
-        start_time = cv2.getTickCount()
-        while True:
-            ret, frame = self.cap.read()
+        out = None
+        frame_id = 0
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            if self._thread is not None:
+                latest = self.read_latest(newer_than=frame_id, timeout=1.0)
+                if latest is None:
+                    continue
+                frame, _, frame_id = latest
+            else:
+                frame = self.next_frame()
+                if frame is None:
+                    break
+            if out is None:
+                height, width = frame.shape[:2]
+                out = cv2.VideoWriter(filename, fourcc, self.fps, (width, height))
             out.write(frame)
-            if (cv2.getTickCount() - start_time) / cv2.getTickFrequency() > duration:
-                break
-        out.release()
-    
+        if out is not None:
+            out.release()
+
     def imshow(self, frame):
         cv2.imshow(str(self), frame)
-    
+
     def imwrite(self, frame, filename):
         cv2.imwrite(filename, frame)
-        
+
     def wait_key(self, delay=1):
         return cv2.waitKey(delay)
-    
+
     def release(self):
+        self.stop()
         self.cap.release()
-    
+
     def __del__(self):
         self.release()
-    
+
     def __str__(self):
-        return f"Camera {self.camera_id}"
\ No newline at end of file
+        return f"Camera {self.camera_id}"
@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import re
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+from utils.background import DEFAULT_CAMERA_ID
+
+TRANSPORTS = ("http", "shm")
+# バックエンドが受け付けるカメラの識別子 (backend/app.py の CAMERA_ID_PATTERN と同じ)
+CAMERA_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class CameraConfig:
+    """
+    1 台のカメラの設定。
+
+    Args:
+        camera_id (str): サーバーへの送信やデータベースで使うカメラの識別子
+        source (Union[int, str]): cv2.VideoCapture に渡すデバイス番号または URL
+        width (int): 取得する映像の幅
+        height (int): 取得する映像の高さ
+        fps (int): 取得する映像のフレームレート
+        zones (Optional[Sequence]): 顔検出の対象にする領域 (x1, y1, x2, y2)。幅と高さに対する割合で指定します
+        masks (Optional[Sequence]): 顔検出から除外する領域 (道路やテレビなど)。指定方法は zones と同じです
+        upload_width (int): サーバーへ送るフレームの最大の幅 (0 なら制限しません)。高さは縦横比を保って縮めます
+        jpeg_quality (int): サーバーへ送る JPEG の画質 (1〜100)
+        transport (str): "http" または "shm"。"shm" はバックエンドが同じホストにある場合に
+            共有メモリでフレームを渡します (バックエンドが読んでいない間は HTTP で送ります)
+    """
+
+    def __init__(self, camera_id: str = DEFAULT_CAMERA_ID, source: Union[int, str] = 0,
+                 width: int = 640, height: int = 480, fps: int = 30,
+                 zones: Optional[Sequence[Sequence[float]]] = None,
+                 masks: Optional[Sequence[Sequence[float]]] = None,
+                 upload_width: int = 0, jpeg_quality: int = 80, transport: str = "http") -> None:
+        if not isinstance(camera_id, str) or not CAMERA_ID_PATTERN.match(camera_id):
+            raise ValueError(f"camera_id must match {CAMERA_ID_PATTERN.pattern}: {camera_id!r}")
+        self.camera_id = camera_id
+        self.source = source
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.zones = [self._check_rect(rect) for rect in zones or []]
+        self.masks = [self._check_rect(rect) for rect in masks or []]
+        if upload_width < 0:
+            raise ValueError(f"upload_width must not be negative: {upload_width}")
+        if not 1 <= jpeg_quality <= 100:
+            raise ValueError(f"jpeg_quality must be between 1 and 100: {jpeg_quality}")
+        if transport not in TRANSPORTS:
+            raise ValueError(f"transport must be one of {TRANSPORTS}: {transport}")
+        self.upload_width = upload_width
+        self.jpeg_quality = jpeg_quality
+        self.transport = transport
+
+    @staticmethod
+    def _check_rect(rect: Sequence[float]) -> List[float]:
+        if len(rect) != 4:
+            raise ValueError(f"region must be [x1, y1, x2, y2]: {rect}")
+        x1, y1, x2, y2 = (float(v) for v in rect)
+        if not (0.0 <= x1 < x2 <= 1.0 and 0.0 <= y1 < y2 <= 1.0):
+            raise ValueError(f"region must be given as fractions of the frame size: {rect}")
+        return [x1, y1, x2, y2]
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "CameraConfig":
+        return cls(**data)
+
+    def __repr__(self) -> str:
+        return f"CameraConfig(camera_id={self.camera_id!r}, source={self.source!r})"
+
+
+def load_camera_configs(path: str) -> List[CameraConfig]:
+    """
+    カメラの一覧を JSON ファイルから読み込みます。ファイルが無い場合はカメラ 0 だけを使います。
+
+    ファイルの形式:
+        {"cameras": [{"camera_id": "entrance", "source": 0}, {"camera_id": "garage", "source": "rtsp://..."}]}
+    """
+    if not os.path.exists(path):
+        logging.info(f"{path} not found, using camera 0 only")
+        return [CameraConfig()]
+
+    with open(path) as f:
+        data = json.load(f)
+    configs = [CameraConfig.from_dict(entry) for entry in data.get("cameras", [])]
+
+    camera_ids = [config.camera_id for config in configs]
+    if len(set(camera_ids)) != len(camera_ids):
+        raise ValueError(f"camera_id must be unique: {camera_ids}")
+    if not configs:
+        raise ValueError(f"no cameras configured in {path}")
+    return configs
@@ -0,0 +1,300 @@
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+ENGINES = ("deepface", "onnx", "stub")
+
+# 特徴ベクトルの前処理 (検出・整列・正規化) の版。変えた場合は上げてください。
+# 版やモデルが違う特徴ベクトルは比較できないため、保存時に embedding_id として記録し、読み込み時に確かめます
+PREPROCESS_VERSION = 2
+# embedding_id を持たないドキュメント (DeepFace.represent の前処理で作った特徴ベクトル)
+LEGACY_EMBEDDING_ID = "ArcFace/deepface-represent"
+
+
+def embedding_id(model_name: str) -> str:
+    """
+    モデル名と前処理の版から、特徴ベクトルを比較できるかの判定に使う識別子を作ります。
+    """
+    return f"{model_name}/v{PREPROCESS_VERSION}"
+
+# represent が返す顔ごとの結果: ((x, y, w, h), 検出の信頼度, 特徴ベクトル)
+Representation = Tuple[Tuple[int, int, int, int], float, np.ndarray]
+
+
+def align_face(frame: np.ndarray, box: np.ndarray, input_size: Tuple[int, int],
+               landmark: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    顔領域を切り出し、両目が水平になるよう回転させてモデルの入力サイズに合わせます。
+    回転・切り出し・リサイズは 1 回の warpAffine で行います。
+
+    Args:
+        frame (np.ndarray): 元のフレーム (BGR)
+        box (np.ndarray): 顔のバウンディングボックス (x1, y1, x2, y2)
+        input_size (Tuple[int, int]): モデルの入力サイズ (高さ, 幅)
+        landmark (Optional[np.ndarray]): MTCNN の 5 点ランドマーク
+
+    Returns:
+        np.ndarray: 整列済みの顔画像 (BGR, モデルの入力サイズ)
+    """
+    x1, y1, x2, y2 = map(float, box)
+    target_h, target_w = input_size
+    center = ((x1 + x2) / 2, (y1 + y2) / 2)
+    scale = min(target_w, target_h) / max(x2 - x1, y2 - y1, 1.0)
+
+    angle = 0.0
+    if landmark is not None:
+        (lx, ly), (rx, ry) = landmark[0], landmark[1]
+        angle = float(np.degrees(np.arctan2(ry - ly, rx - lx)))
+
+    matrix = cv2.getRotationMatrix2D(center, angle, scale)
+    matrix[0, 2] += target_w / 2 - center[0]
+    matrix[1, 2] += target_h / 2 - center[1]
+    return cv2.warpAffine(frame, matrix, (target_w, target_h), flags=cv2.INTER_LINEAR)
+
+
+def to_model_input(faces: List[np.ndarray]) -> np.ndarray:
+    """
+    整列済みの顔画像 (BGR) を (N, H, W, 3) の BGR [0, 1] の float32 にまとめます。
+
+    DeepFace.represent がモデルに渡す形 (extract_faces で RGB にした顔を BGR に戻し、255 で割ったもの) と
+    同じです。compare_engines.py で DeepFace.represent との一致を確かめられます。
+    """
+    return np.stack(faces).astype(np.float32) / 255.0
+
+
+class EmbeddingEngine:
+    """
+    整列済みの顔画像を特徴ベクトルに変換するエンジンの共通部分。
+
+    サブクラスは input_size を設定し、embed を実装します。
+    represent はフレームから顔を検出して特徴ベクトルまで求めます (既定では MTCNN を使います)。
+    """
+
+    name = "base"
+    model_name = "ArcFace"
+    input_size: Tuple[int, int] = (112, 112)
+
+    def __init__(self) -> None:
+        self._detector = None
+
+    def embed(self, faces: List[np.ndarray]) -> np.ndarray:
+        """
+        Args:
+            faces (List[np.ndarray]): align_face で得た顔画像 (BGR) のリスト
+
+        Returns:
+            np.ndarray: (N, D) の特徴ベクトル (float32)
+        """
+        raise NotImplementedError
+
+    @property
+    def embedding_id(self) -> str:
+        """
+        このエンジンの特徴ベクトルの識別子。同じ識別子の特徴ベクトルどうしだけを比較できます。
+        """
+        return embedding_id(self.model_name)
+
+    def represent(self, image: np.ndarray, enforce_detection: bool = False) -> List[Representation]:
+        """
+        画像内の顔を検出し、顔ごとの位置・信頼度・特徴ベクトルを返します。
+        enforce_detection=True で顔が見つからない場合は ValueError を送出します。
+        """
+        from PIL import Image
+
+        if self._detector is None:
+            from facenet_pytorch import MTCNN
+            self._detector = MTCNN()
+
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        boxes, probs, landmarks = self._detector.detect(Image.fromarray(rgb), landmarks=True)
+        if boxes is None or len(boxes) == 0:
+            if enforce_detection:
+                raise ValueError("Face could not be detected")
+            return []
+
+        faces = [align_face(image, box, self.input_size, landmark) for box, landmark in zip(boxes, landmarks)]
+        embeddings = self.embed(faces)
+        results = []
+        for box, prob, embedding in zip(boxes, probs, embeddings):
+            x1, y1, x2, y2 = (int(v) for v in box)
+            results.append(((x1, y1, x2 - x1, y2 - y1), float(prob), embedding))
+        return results
+
+    def warmup(self) -> None:
+        """
+        初回の推論で発生するグラフの構築やメモリ確保を起動時に済ませます。
+        """
+        height, width = self.input_size
+        self.embed([np.zeros((height, width, 3), dtype=np.uint8)])
+
+
+class DeepFaceEngine(EmbeddingEngine):
+    """
+    DeepFace (TensorFlow) の ArcFace を使うエンジン。既定のエンジンです。
+
+    登録 (represent) と照合 (embed) の特徴ベクトルが同じ前処理になるよう、represent も
+    DeepFace.represent ではなく align_face と embed を使います (EmbeddingEngine.represent)。
+    """
+
+    name = "deepface"
+
+    def __init__(self, model_name: str = "ArcFace") -> None:
+        super().__init__()
+        from deepface import DeepFace
+
+        self.model_name = model_name
+        # バッチ推論用にモデルを直接保持します
+        model = DeepFace.build_model(model_name)
+        self.model = getattr(model, "model", model)
+        self.input_size = tuple(self.model.input_shape[1:3])
+
+    def embed(self, faces: List[np.ndarray]) -> np.ndarray:
+        embeddings = self.model(to_model_input(faces), training=False)
+        return np.asarray(embeddings, dtype=np.float32)
+
+
+def deepface_reference(faces: List[np.ndarray], model_name: str = "ArcFace") -> np.ndarray:
+    """
+    整列済みの顔画像を検出なしで DeepFace.represent に渡し、DeepFace 自身の前処理での特徴ベクトルを返します。
+    """
+    from deepface import DeepFace
+
+    embeddings = []
+    for face in faces:
+        objs = DeepFace.represent(img_path=face, model_name=model_name, detector_backend="skip",
+                                  enforce_detection=False, align=False)
+        embeddings.append(objs[0]["embedding"])
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+class OnnxEngine(EmbeddingEngine):
+    """
+    ONNX Runtime で ArcFace を動かすエンジン。TensorFlow を読み込まないため起動が速く、
+    スレッド数を制御できます。モデルは export_arcface_onnx で DeepFace のモデルから書き出します。
+
+    Args:
+        model_path (str): ONNX モデルのパス
+        quantize (bool): True の場合、重みを int8 に動的量子化したモデルを使います (初回に作成して保存します)
+        intra_op_threads (int): 1 回の推論で使うスレッド数 (0 なら ONNX Runtime に任せます)
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_path: str, quantize: bool = False, intra_op_threads: int = 0) -> None:
+        super().__init__()
+        import onnxruntime as ort
+
+        if quantize:
+            model_path = quantize_model(model_path)
+        self.model_path = model_path
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        shape = model_input.shape
+        # tf2onnx で書き出したモデルは NHWC のまま。NCHW のモデルにも対応します
+        self.channels_first = shape[1] == 3
+        self.input_size = (int(shape[2]), int(shape[3])) if self.channels_first else (int(shape[1]), int(shape[2]))
+
+    def embed(self, faces: List[np.ndarray]) -> np.ndarray:
+        batch = to_model_input(faces)
+        if self.channels_first:
+            batch = batch.transpose(0, 3, 1, 2)
+        embeddings = self.session.run(None, {self.input_name: np.ascontiguousarray(batch)})[0]
+        return np.asarray(embeddings, dtype=np.float32)
+
+
+class StubEngine(EmbeddingEngine):
+    """
+    モデルを使わずに決まった結果を返すエンジン。負荷試験で推論以外の処理の負荷を測るために使います。
+
+    represent はフレームの中央に顔が 1 つあるものとして扱い、delay 秒待ってから
+    乱数の特徴ベクトルを返します。
+
+    Args:
+        delay (float): 1 回の represent / embed で待つ秒数 (推論時間の模擬)
+        dim (int): 特徴ベクトルの次元
+    """
+
+    name = "stub"
+    model_name = "stub"
+
+    def __init__(self, delay: float = 0.0, dim: int = 512) -> None:
+        super().__init__()
+        self.delay = delay
+        self.dim = dim
+        self._rng = np.random.default_rng(0)
+
+    def embed(self, faces: List[np.ndarray]) -> np.ndarray:
+        if self.delay:
+            time.sleep(self.delay)
+        embeddings = self._rng.standard_normal((len(faces), self.dim)).astype(np.float32)
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    def represent(self, image: np.ndarray, enforce_detection: bool = False) -> List[Representation]:
+        height, width = image.shape[:2]
+        size = min(height, width) // 3
+        box = ((width - size) // 2, (height - size) // 2, size, size)
+        return [(box, 1.0, self.embed([image])[0])]
+
+
+def quantize_model(model_path: str) -> str:
+    """
+    重みを int8 に動的量子化したモデルを model_path の隣に作り、そのパスを返します。
+    既に作成済みで元のモデルより新しい場合は作り直しません。
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    root, ext = os.path.splitext(model_path)
+    quantized_path = f"{root}.int8{ext}"
+    if not os.path.exists(quantized_path) or os.path.getmtime(quantized_path) < os.path.getmtime(model_path):
+        logging.info(f"Quantizing {model_path} to {quantized_path}")
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+def export_arcface_onnx(output_path: str, model_name: str = "ArcFace", opset: int = 13) -> str:
+    """
+    DeepFace の Keras モデルを ONNX に書き出します (tf2onnx が必要です)。
+    入力は DeepFaceEngine と同じ (N, H, W, 3) の BGR [0, 1] です (to_model_input を参照)。
+    """
+    import tensorflow as tf
+    import tf2onnx
+
+    engine = DeepFaceEngine(model_name)
+    height, width = engine.input_size
+    signature = (tf.TensorSpec((None, height, width, 3), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(engine.model, input_signature=signature, opset=opset, output_path=output_path)
+    return output_path
+
+
+def create_engine(name: str = "deepface", model_path: Optional[str] = None, quantize: bool = False,
+                  intra_op_threads: int = 0, stub_delay: float = 0.0) -> EmbeddingEngine:
+    """
+    設定からエンジンを作ります。
+
+    Args:
+        name (str): "deepface"・"onnx"・"stub" のいずれか
+        model_path (Optional[str]): ONNX モデルのパス (name="onnx" のとき必須)
+        quantize (bool): int8 の動的量子化を使うか (name="onnx" のとき)
+        intra_op_threads (int): 推論のスレッド数 (name="onnx" のとき)
+        stub_delay (float): 1 回の推論で待つ秒数 (name="stub" のとき)
+    """
+    if name not in ENGINES:
+        raise ValueError(f"embedding engine must be one of {ENGINES}")
+    if name == "onnx":
+        if not model_path:
+            raise ValueError("model_path is required for the onnx engine")
+        return OnnxEngine(model_path, quantize=quantize, intra_op_threads=intra_op_threads)
+    if name == "stub":
+        return StubEngine(delay=stub_delay)
+    return DeepFaceEngine()
@@ -1,28 +1,47 @@
 import cv2
 import numpy as np
 import logging
-from deepface import DeepFace
 from facenet_pytorch import MTCNN
 import os
 from datetime import datetime
 from typing import List, Optional, Tuple
 from db.client import MongoDBClient  # MongoDBクライアントを正しくインポート
+from db.codec import decode_embeddings, encode_array
 from PIL import Image
+from utils.annotate import annotate_frame
+from utils.embedding import LEGACY_EMBEDDING_ID, EmbeddingEngine, DeepFaceEngine, align_face
+from utils.gallery import FaceGallery
+from utils.gallery_sync import GallerySync
+from utils.metrics import DB_SECONDS, STEP_SECONDS
 
 class FaceRecognition:
-    def __init__(self, db_client: MongoDBClient) -> None:
+    def __init__(self, db_client: MongoDBClient, use_faiss: bool = False,
+                 sync_interval: Optional[float] = 5.0, engine: Optional[EmbeddingEngine] = None,
+                 detector: bool = True) -> None:
         self.model_name = 'ArcFace'
         self.db_client = db_client
         self.db = self.db_client.connect()
         self.collection = self.db["faces"]
         self.registered_users = []
+        self.gallery = FaceGallery(use_faiss=use_faiss)
 
-        # MTCNNの初期化
-        self.mtcnn = MTCNN()
+        # MTCNNの初期化 (検出済みの顔を受け取って認識だけを行う場合は読み込みません)
+        self.mtcnn = MTCNN() if detector else None
+
+        # 特徴ベクトルを求めるエンジン (既定は DeepFace の ArcFace)
+        self.engine = engine or DeepFaceEngine(self.model_name)
+        self.input_size = self.engine.input_size
 
         # データベースから登録済みの顔データを読み込みます
         self.load_registered_embeddings()
 
+        # 他のプロセスで登録・削除された顔データを差分で取り込みます
+        self.sync = None
+        if sync_interval:
+            self.sync = GallerySync(self.collection, on_upsert=self.apply_user, on_delete=self.remove_user,
+                                    known_keys=lambda: list(self.gallery.keys), poll_interval=sync_interval)
+            self.sync.start(self.registered_users)
+
     def register_user(self, name: str, images: List[np.ndarray]) -> None:
         """
         ユーザーを登録します。
@@ -35,31 +54,35 @@ class FaceRecognition:
             embeddings = []
             for idx, image in enumerate(images):
                 # 特徴ベクトルの取得
-                embedding_objs = DeepFace.represent(img_path=image, model_name=self.model_name,
-                                                    detector_backend='mtcnn', enforce_detection=True)
-                if len(embedding_objs) == 0:
+                representations = self.engine.represent(image, enforce_detection=True)
+                if len(representations) == 0:
                     logging.error(f"サンプル {idx + 1} で顔が検出されませんでした。")
                     continue
-                embedding = embedding_objs[0]["embedding"]
+                _, _, embedding = representations[0]
                 embeddings.append(embedding)
 
             if len(embeddings) == 0:
                 logging.error("有効な顔が検出されませんでした。登録を中止します。")
                 return
 
-            # MongoDBに保存
+            # MongoDBに保存 (特徴ベクトルは float32 のバイナリとして保存します)
+            embeddings = np.asarray(embeddings, dtype=np.float32)
             user_id = self.collection.count_documents({}) + 1
             face_data = {
                 "user_id": user_id,
                 "name": name,
-                "embeddings": embeddings,
-                "created_at": datetime.utcnow().isoformat()
+                "embeddings": encode_array(embeddings),
+                "embedding_id": self.engine.embedding_id,
+                "created_at": datetime.utcnow().isoformat(),
+                "updated_at": datetime.utcnow()
             }
-            self.collection.insert_one(face_data)
+            with DB_SECONDS.time(operation="insert_face"):
+                self.collection.insert_one(face_data)
+            face_data["embeddings"] = embeddings
             logging.info(f"ユーザー {name} の顔データが保存されました。")
 
-            # 登録ユーザーのリストを更新
-            self.registered_users.append(face_data)
+            # 登録ユーザーのリストとインデックスを更新
+            self.apply_user(face_data)
         except Exception as e:
             logging.error(f"ユーザーの登録中にエラーが発生しました: {e}")
 
@@ -68,15 +91,61 @@ class FaceRecognition:
         登録されたユーザーの特徴ベクトルをデータベースから読み込みます。
         """
         try:
-            self.registered_users = list(self.collection.find())
+            with DB_SECONDS.time(operation="load_faces"):
+                self.registered_users = list(self.collection.find())
+            for user in self.registered_users:
+                user["embeddings"] = decode_embeddings(user.get("embeddings", []))
+            compatible = [user for user in self.registered_users if self.is_compatible(user)]
+            self.gallery.build(compatible)
             logging.info(f"{len(self.registered_users)} 人のユーザーをデータベースから読み込みました。")
+            if len(compatible) < len(self.registered_users):
+                logging.error(f"{len(self.registered_users) - len(compatible)} 人のユーザーは別のモデルまたは前処理の"
+                              f"特徴ベクトルのため照合から外しました。migrate.py --reembed で作り直すか、再登録してください。")
         except Exception as e:
             logging.error(f"データベースからの読み込み中にエラーが発生しました: {e}")
             self.registered_users = []
+            self.gallery.build([])
+
+    def apply_user(self, user: dict) -> None:
+        """
+        追加・更新されたユーザーをメモリ上のリストとインデックスに反映します。
+        """
+        user["embeddings"] = decode_embeddings(user.get("embeddings", []))
+        key = FaceGallery.user_key(user)
+        self.registered_users = [u for u in self.registered_users if FaceGallery.user_key(u) != key] + [user]
+        if len(user["embeddings"]) > 0 and self.is_compatible(user):
+            self.gallery.add_user(user)
+        else:
+            self.gallery.remove_user(key)
+        logging.info(f"ユーザー {user['name']} の顔データを反映しました。")
+
+    def is_compatible(self, user: dict) -> bool:
+        """
+        ユーザーの特徴ベクトルが今のエンジンと同じモデル・前処理で作られたかを返します。
+        違う場合は類似度が意味を持たないため、照合には使いません。
+        """
+        stored = user.get("embedding_id", LEGACY_EMBEDDING_ID)
+        if stored == self.engine.embedding_id:
+            return True
+        logging.warning(f"ユーザー {user.get('name')} の特徴ベクトル ({stored}) は "
+                        f"現在のエンジン ({self.engine.embedding_id}) と比較できません。")
+        return False
+
+    def remove_user(self, key) -> None:
+        """
+        削除されたユーザーをメモリ上のリストとインデックスから取り除きます。
+        """
+        self.registered_users = [u for u in self.registered_users if FaceGallery.user_key(u) != key]
+        if self.gallery.remove_user(key):
+            logging.info(f"ユーザー {key} の顔データを削除しました。")
+
+    def close(self) -> None:
+        if self.sync is not None:
+            self.sync.stop()
 
     def verify_user(self, image: np.ndarray) -> Tuple[str, float]:
         """
-        入力画像の人物が登録されたadminユーザーかどうかを確認します。
+        入力画像の人物が登録済みユーザーの誰に当たるかを確認します。
 
         Args:
             image (np.ndarray): 検証する顔画像
@@ -85,6 +154,9 @@ class FaceRecognition:
             Tuple[str, float]: (一致したユーザーの名前または "unknown", 類似度スコア)
         """
         try:
+            if self.mtcnn is None:
+                raise RuntimeError("face detector is disabled")
+
             # MTCNNで顔検出
             img_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
             pil_image = Image.fromarray(img_rgb)
@@ -94,72 +166,64 @@ class FaceRecognition:
                 logging.error("顔が検出されませんでした。")
                 return "unknown", 0.0
 
-            # 検出された顔領域をクロップ
-            x1, y1, x2, y2 = map(int, boxes[0])
-            face_crop = image[y1:y2, x1:x2]
-
-            # DeepFaceで特徴ベクトルを取得
-            embedding_objs = DeepFace.represent(img_path=face_crop, model_name=self.model_name,
-                                                detector_backend='skip', enforce_detection=False)
-            if len(embedding_objs) == 0:
-                logging.error("特徴ベクトルの取得に失敗しました。")
-                return "unknown", 0.0
-            embedding = embedding_objs[0]["embedding"]
-
-            # 登録されたadminユーザーとの比較
-            admin_user = None
-            for user in self.registered_users:
-                if user["name"] == "admin":
-                    admin_user = user
-                    break
-
-            if admin_user is None:
-                logging.error("adminユーザーが登録されていません。")
-                return "unknown", 0.0
+            # 検出された顔領域を切り出して特徴ベクトルを取得
+            embedding = self.embed_faces([self.align_face(image, boxes[0])])[0]
 
-            highest_similarity = -1  # 初期値
-
-            user_embeddings = admin_user["embeddings"]
-            for registered_embedding in user_embeddings:
-                registered_embedding = np.array(registered_embedding)
-                # コサイン類似度の計算
-                similarity = np.dot(registered_embedding, embedding) / (np.linalg.norm(registered_embedding) * np.linalg.norm(embedding))
-                if similarity > highest_similarity:
-                    highest_similarity = similarity
-
-            # 閾値を設定（0.7）
-            threshold = 0.7
-            if highest_similarity >= threshold:
-                return "admin", highest_similarity
-            else:
-                return "unknown", highest_similarity
+            # 登録された全ユーザーとの比較
+            return self.gallery.identify(embedding)
         except Exception as e:
             logging.error(f"ユーザーの検証中にエラーが発生しました: {e}")
             return "unknown", 0.0
 
-    def annotate_frame(self, frame: np.ndarray, boxes: np.ndarray, names: List[str]) -> np.ndarray:
+    def align_face(self, frame: np.ndarray, box: np.ndarray, landmark: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        顔領域を切り出して整列させます (utils.embedding.align_face を参照)。
         """
-        フレームに検出された顔の位置と名前を描画します。
+        return align_face(frame, box, self.input_size, landmark)
+
+    def embed_faces(self, faces: List[np.ndarray]) -> np.ndarray:
+        """
+        整列済みの顔画像をまとめて 1 回の順伝播で特徴ベクトルに変換します。
 
         Args:
-            frame (np.ndarray): 元のフレーム
-            boxes (np.ndarray): 顔のバウンディングボックスの配列
-            names (List[str]): 各顔に対応する名前のリスト
+            faces (List[np.ndarray]): align_face で得た顔画像 (BGR) のリスト
 
         Returns:
-            np.ndarray: アノテーションが追加されたフレーム
-        """
-        for box, name in zip(boxes, names):
-            x1, y1, x2, y2 = map(int, box)
-            if name == "admin":
-                label = "admin"
-                color = (0, 255, 0)  # 緑
-            else:
-                label = "unknown"
-                color = (0, 0, 255)  # 赤
-
-            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-            cv2.putText(frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX,
-                        0.9, color, 2)
-
-        return frame
\ No newline at end of file
+            np.ndarray: (N, D) の特徴ベクトル
+        """
+        with STEP_SECONDS.time(step="embedding"):
+            return self.engine.embed(faces)
+
+    def identify_faces(self, frame: np.ndarray, boxes: np.ndarray,
+                       landmarks: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        """
+        1 回の検出で得た全ての顔をまとめて認識します。
+
+        Args:
+            frame (np.ndarray): 元のフレーム (BGR)
+            boxes (np.ndarray): MTCNN のバウンディングボックスの配列
+            landmarks (Optional[np.ndarray]): MTCNN のランドマークの配列
+
+        Returns:
+            List[Tuple[str, float]]: 顔ごとの (一致したユーザーの名前または "unknown", 類似度スコア)
+        """
+        if boxes is None or len(boxes) == 0:
+            return []
+        try:
+            faces = [
+                self.align_face(frame, box, None if landmarks is None else landmarks[i])
+                for i, box in enumerate(boxes)
+            ]
+            embeddings = self.embed_faces(faces)
+            with STEP_SECONDS.time(step="matching"):
+                return self.gallery.identify_batch(embeddings)
+        except Exception as e:
+            logging.error(f"顔の一括認識中にエラーが発生しました: {e}")
+            return [("unknown", 0.0)] * len(boxes)
+
+    @staticmethod
+    def annotate_frame(frame: np.ndarray, boxes: np.ndarray, names: List[str]) -> np.ndarray:
+        """
+        フレームに検出された顔の位置と名前を描画します (utils.annotate.annotate_frame を参照)。
+        """
+        return annotate_frame(frame, boxes, names)
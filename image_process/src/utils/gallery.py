@@ -0,0 +1,241 @@
+import logging
+import threading
+import numpy as np
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import faiss
+except ImportError:  # faiss-cpu が無い環境では NumPy の行列積にフォールバック
+    faiss = None
+
+DEFAULT_THRESHOLD = 0.7
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """
+    各行を L2 正規化した float32 の連続配列を返します。
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[np.newaxis, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(vectors / norms)
+
+
+class FaceGallery:
+    """
+    登録済みユーザー全員の特徴ベクトルを 1 つの行列にまとめた 1:N 検索用インデックス。
+
+    特徴ベクトルは正規化済みの float32 行列として保持し、行番号からユーザーへの
+    対応表を持ちます。同じユーザーの行は連続して並ぶため、ユーザー単位の最大値は
+    np.maximum.reduceat で一度に求められます。ユーザーはドキュメントの _id (無ければ名前)
+    をキーとして追加・更新・削除できます。
+    """
+
+    def __init__(self, use_faiss: bool = False, default_threshold: float = DEFAULT_THRESHOLD) -> None:
+        if use_faiss and faiss is None:
+            logging.warning("faiss が見つからないため NumPy で検索します。")
+            use_faiss = False
+        self.use_faiss = use_faiss
+        self.default_threshold = default_threshold
+        self.dim: Optional[int] = None
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+        self.row_to_user = np.empty(0, dtype=np.int64)
+        self.user_offsets = np.empty(0, dtype=np.int64)
+        self.names: List[str] = []
+        self.keys: List[Any] = []
+        self.thresholds = np.empty(0, dtype=np.float32)
+        self.index = None
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def num_rows(self) -> int:
+        return int(self.matrix.shape[0])
+
+    @staticmethod
+    def user_key(user: Dict[str, Any]) -> Any:
+        return user.get("_id", user["name"])
+
+    def build(self, users: List[Dict[str, Any]]) -> None:
+        """
+        ユーザーのドキュメントのリストからインデックスを作り直します。
+
+        Args:
+            users (List[Dict[str, Any]]): "name", "embeddings" と任意の "threshold" を持つドキュメント
+        """
+        with self._lock:
+            self._build(users)
+
+    def _build(self, users: List[Dict[str, Any]]) -> None:
+        blocks = []
+        names = []
+        keys = []
+        thresholds = []
+        counts = []
+        for user in users:
+            embeddings = np.asarray(user.get("embeddings", []), dtype=np.float32)
+            if embeddings.size == 0:
+                continue
+            blocks.append(normalize_rows(embeddings))
+            names.append(user["name"])
+            keys.append(self.user_key(user))
+            thresholds.append(user.get("threshold", self.default_threshold))
+            counts.append(len(blocks[-1]))
+
+        self.names = names
+        self.keys = keys
+        self.thresholds = np.asarray(thresholds, dtype=np.float32)
+        if blocks:
+            self.matrix = np.ascontiguousarray(np.vstack(blocks))
+            self.dim = self.matrix.shape[1]
+        else:
+            self.matrix = np.empty((0, self.dim or 0), dtype=np.float32)
+        counts = np.asarray(counts, dtype=np.int64)
+        self.row_to_user = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+        self.user_offsets = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64) if len(counts) else counts
+        self._rebuild_index()
+
+    def add_user(self, user: Dict[str, Any]) -> None:
+        """
+        1 人分のユーザーを追加します。同じキーのユーザーが既にいる場合は置き換えます。
+        """
+        embeddings = normalize_rows(np.asarray(user["embeddings"], dtype=np.float32))
+        with self._lock:
+            if self.dim is not None and self.num_rows > 0 and embeddings.shape[1] != self.dim:
+                raise ValueError(f"特徴ベクトルの次元が一致しません: {embeddings.shape[1]} != {self.dim}")
+
+            key = self.user_key(user)
+            replaced = key in self.keys
+            if replaced:
+                self._remove(self.keys.index(key))
+
+            user_idx = len(self.names)
+            self.names.append(user["name"])
+            self.keys.append(key)
+            self.thresholds = np.append(self.thresholds, np.float32(user.get("threshold", self.default_threshold)))
+            self.user_offsets = np.append(self.user_offsets, np.int64(self.num_rows))
+            self.row_to_user = np.append(self.row_to_user, np.full(len(embeddings), user_idx, dtype=np.int64))
+            if self.num_rows == 0:
+                self.matrix = embeddings
+                self.dim = embeddings.shape[1]
+            else:
+                self.matrix = np.ascontiguousarray(np.vstack((self.matrix, embeddings)))
+
+            if self.index is not None and not replaced:
+                self.index.add(embeddings)
+            else:
+                self._rebuild_index()
+
+    def remove_user(self, key: Any) -> bool:
+        """
+        キーに対応するユーザーを削除します。
+
+        Returns:
+            bool: 削除した場合は True
+        """
+        with self._lock:
+            if key not in self.keys:
+                return False
+            self._remove(self.keys.index(key))
+            self._rebuild_index()
+            return True
+
+    def _remove(self, user_idx: int) -> None:
+        keep_rows = self.row_to_user != user_idx
+        self.matrix = np.ascontiguousarray(self.matrix[keep_rows])
+        row_to_user = self.row_to_user[keep_rows]
+        self.row_to_user = row_to_user - (row_to_user > user_idx)
+        self.user_offsets = np.delete(self.user_offsets, user_idx)
+        self.user_offsets[user_idx:] -= int(np.count_nonzero(~keep_rows))
+        self.thresholds = np.delete(self.thresholds, user_idx)
+        del self.names[user_idx]
+        del self.keys[user_idx]
+
+    def _rebuild_index(self) -> None:
+        self.index = None
+        if self.use_faiss and self.num_rows > 0:
+            self.index = faiss.IndexFlatIP(self.dim)
+            self.index.add(self.matrix)
+
+    def _user_scores(self, queries: np.ndarray, k: int = 1) -> np.ndarray:
+        """
+        クエリごと・ユーザーごとの最大コサイン類似度 (num_queries, num_users) を返します。
+        FAISS を使う場合は上位 k 人の値だけが正確で、見つからなかったユーザーは -1 です。
+        """
+        if self.index is not None:
+            # 1 人あたり最大 max_rows 行なので、上位 k × max_rows 行には上位 k 人の最良の行が必ず含まれます
+            max_rows = int(np.max(np.diff(np.append(self.user_offsets, self.num_rows))))
+            k_rows = min(self.num_rows, max_rows * k)
+            sims, rows = self.index.search(queries, k_rows)
+            scores = np.full((len(queries), len(self.names)), -1.0, dtype=np.float32)
+            valid = rows >= 0
+            q_idx = np.nonzero(valid)[0]
+            u_idx = self.row_to_user[rows[valid]]
+            np.maximum.at(scores, (q_idx, u_idx), sims[valid])
+            # インデックスが k 人分の行を返さなかったクエリだけは全件を計算し直します
+            found = np.zeros(scores.shape, dtype=bool)
+            found[q_idx, u_idx] = True
+            short = np.count_nonzero(found, axis=1) < k
+            if np.any(short):
+                sims = queries[short] @ self.matrix.T
+                scores[short] = np.maximum.reduceat(sims, self.user_offsets, axis=1)
+            return scores
+
+        sims = queries @ self.matrix.T
+        return np.maximum.reduceat(sims, self.user_offsets, axis=1)
+
+    def search(self, embeddings: np.ndarray, k: int = 1) -> List[List[Tuple[str, float, bool]]]:
+        """
+        複数の特徴ベクトルについて上位 k 人のユーザーを検索します。
+
+        Args:
+            embeddings (np.ndarray): (N, D) または (D,) の特徴ベクトル
+            k (int): 返すユーザー数
+
+        Returns:
+            List[List[Tuple[str, float, bool]]]: クエリごとの (名前, 類似度, 閾値を超えたか) のリスト
+        """
+        queries = normalize_rows(embeddings)
+        with self._lock:
+            if len(self.names) == 0:
+                return [[] for _ in range(len(queries))]
+
+            k = min(k, len(self.names))
+            scores = self._user_scores(queries, k)
+            top = np.argsort(-scores, axis=1)[:, :k]
+            results = []
+            for q, users in enumerate(top):
+                results.append([
+                    (self.names[u], float(scores[q, u]), bool(scores[q, u] >= self.thresholds[u]))
+                    for u in users
+                ])
+            return results
+
+    def identify(self, embedding: np.ndarray) -> Tuple[str, float]:
+        """
+        最も類似度の高いユーザーを返します。閾値を下回る場合は "unknown" になります。
+
+        Returns:
+            Tuple[str, float]: (一致したユーザーの名前または "unknown", 類似度スコア)
+        """
+        return self.identify_batch(embedding)[0]
+
+    def identify_batch(self, embeddings: np.ndarray) -> List[Tuple[str, float]]:
+        """
+        複数の特徴ベクトルをまとめて照合し、それぞれの最も近いユーザーを返します。
+
+        Returns:
+            List[Tuple[str, float]]: クエリごとの (名前または "unknown", 類似度スコア)
+        """
+        results = []
+        for matches in self.search(embeddings, k=1):
+            if not matches:
+                results.append(("unknown", 0.0))
+                continue
+            name, similarity, accepted = matches[0]
+            results.append(((name if accepted else "unknown"), similarity))
+        return results
@@ -1,6 +1,22 @@
 import requests
 import cv2
 import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from typing import Optional
+from utils.metrics import STEP_SECONDS, counter, histogram
+
+DEFAULT_URL = "http://localhost:8080/notification"
+DEFAULT_JPEG_QUALITY = 80
+
+_send_seconds = histogram("http_send_seconds", "Time to post a frame to the server")
+_send_total = counter("http_send_total", "Frame posts by result", ("result",))
+_send_bytes = counter("http_send_bytes_total", "JPEG bytes posted to the server")
+
 
 class DetectionData:
     def __init__(self, status: str, detail: str):
@@ -13,12 +29,61 @@ class DetectionData:
             'detail': self.detail
         }
 
-def send_detection_data_to_server(frame, data: DetectionData):
-    url = "http://localhost:8080/notification"
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Retry-After ヘッダー (秒数または HTTP の日付) を待つ秒数に変換します。解釈できない場合は None です。
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if when is None:
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def create_session(pool_size: int = 4) -> requests.Session:
+    """
+    接続を使い回すための requests.Session を作ります。
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_session = create_session()
+
+
+def encode_frame(frame, quality: int = DEFAULT_JPEG_QUALITY, max_width: int = 0):
+    """
+    フレームを幅が max_width 以下になるよう縮小し (0 なら縮小しません)、指定した画質の JPEG にエンコードします。
+
+    Returns:
+        Tuple[bool, np.ndarray]: cv2.imencode と同じ (成功したか, バイト列)
+    """
+    height, width = frame.shape[:2]
+    if max_width and width > max_width:
+        frame = cv2.resize(frame, (max_width, max(1, height * max_width // width)), interpolation=cv2.INTER_AREA)
+    return cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+
+
+def send_detection_data_to_server(frame, data: DetectionData, url: str = DEFAULT_URL,
+                                  jpeg_quality: int = DEFAULT_JPEG_QUALITY, max_width: int = 0):
     payload = data.to_dict()
 
     # フレームをJPEGにエンコード
-    ret, buffer = cv2.imencode('.jpg', frame)
+    ret, buffer = encode_frame(frame, jpeg_quality, max_width)
     if not ret:
         logging.error("フレームのエンコードに失敗しました")
         return
@@ -30,9 +95,183 @@ def send_detection_data_to_server(frame, data: DetectionData):
     }
 
     try:
-        response = requests.post(url, data=payload, files=files)
+        response = _session.post(url, data=payload, files=files)
         response.raise_for_status()
     except requests.exceptions.RequestException as e:
         logging.error(f"サーバーへの送信中にエラーが発生しました: {e}")
     else:
-        logging.info(f"サーバーからのレスポンス: {response.text}")
\ No newline at end of file
+        logging.info(f"サーバーからのレスポンス: {response.text}")
+
+
+class FrameSender:
+    """
+    フレームをバックグラウンドのスレッドからサーバーへ送信します。
+
+    送信待ちのフレームは queue_size 件までしか保持せず、満杯のときは古いものから捨てます
+    (最新優先)。サーバーに届かない場合は指数バックオフで再送し、待っている間に新しい
+    フレームが届けば古いフレームの再送はやめます。send() はネットワークを待たずに戻ります。
+
+    フレームは幅 max_width 以下・画質 jpeg_quality で送ります。サーバーが応答の
+    X-Upload-Max-Width・X-Upload-Quality で希望を返した場合は、それぞれ小さい方に合わせます。
+    """
+
+    def __init__(self, url: str = DEFAULT_URL, queue_size: int = 1, timeout: float = 5.0,
+                 backoff_base: float = 0.5, backoff_max: float = 10.0, camera_id: Optional[str] = None,
+                 jpeg_quality: int = DEFAULT_JPEG_QUALITY, max_width: int = 0) -> None:
+        self.url = url
+        self.camera_id = camera_id
+        self.jpeg_quality = jpeg_quality
+        self.max_width = max_width
+        # サーバーが希望した値 (無ければ None)
+        self.server_quality: Optional[int] = None
+        self.server_max_width: Optional[int] = None
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = create_session()
+
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=1024)  # 直近の送信にかかった時間 (秒)
+
+        self._queue = deque(maxlen=queue_size)
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._delay = backoff_base
+        self._thread = threading.Thread(target=self._run, name="frame-sender", daemon=True)
+        self._thread.start()
+
+    def send(self, frame, data: DetectionData) -> None:
+        """
+        フレームを送信待ちに入れます。JPEG へのエンコードも送信スレッドで行います。
+        """
+        with self._cond:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append((frame, data))
+            self._cond.notify()
+
+    def _next(self):
+        with self._cond:
+            while not self._stop.is_set() and not self._queue:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            return self._queue.popleft()
+
+    def _has_newer(self) -> bool:
+        with self._cond:
+            return len(self._queue) > 0
+
+    def _run(self) -> None:
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            # 1 件の失敗で送信スレッドが止まらないよう、予期しない例外もここで受け止めます
+            try:
+                self._deliver(*item)
+            except Exception:
+                logging.exception("フレームの送信中に予期しないエラーが発生しました")
+                self.failed += 1
+                _send_total.inc(result="error")
+
+    def _deliver(self, frame, data: DetectionData) -> None:
+        """
+        1 フレームをエンコードし、送れるか新しいフレームが届くまで再送します。
+        """
+        with STEP_SECONDS.time(step="encode"):
+            ret, buffer = encode_frame(frame, *self.upload_settings())
+        if not ret:
+            logging.error("フレームのエンコードに失敗しました")
+            return
+        frame_data = buffer.tobytes()
+
+        while not self._stop.is_set():
+            done, retry_after = self._post(frame_data, data)
+            if done:
+                self._delay = self.backoff_base
+                return
+
+            self.failed += 1
+            wait = min(retry_after if retry_after is not None else self._delay, self.backoff_max)
+            self._delay = min(self._delay * 2, self.backoff_max)
+            self._stop.wait(wait)
+            # 待っている間に新しいフレームが来ていれば、古いフレームは捨てます
+            if self._has_newer():
+                self.dropped += 1
+                return
+
+    def upload_settings(self):
+        """
+        Returns:
+            Tuple[int, int]: 送信に使う (画質, 最大の幅)。最大の幅が 0 なら縮小しません
+        """
+        quality = min(self.jpeg_quality, self.server_quality or self.jpeg_quality)
+        widths = [width for width in (self.max_width, self.server_max_width) if width]
+        return quality, min(widths) if widths else 0
+
+    def _apply_hints(self, headers) -> None:
+        try:
+            if "X-Upload-Max-Width" in headers:
+                self.server_max_width = int(headers["X-Upload-Max-Width"])
+            if "X-Upload-Quality" in headers:
+                self.server_quality = int(headers["X-Upload-Quality"])
+        except ValueError:
+            logging.warning(f"サーバーが不正な送信設定を返しました: {dict(headers)}")
+
+    def _post(self, frame_data: bytes, data: DetectionData):
+        """
+        1 回だけ送信を試みます。
+
+        Returns:
+            Tuple[bool, Optional[float]]: (再送が不要か, サーバーが指定した Retry-After 秒数)
+        """
+        files = {
+            'image': ('frame.jpg', frame_data, 'image/jpeg')
+        }
+        payload = data.to_dict()
+        if self.camera_id is not None:
+            payload['camera_id'] = self.camera_id
+        _send_bytes.inc(len(frame_data))
+        start = time.perf_counter()
+        try:
+            response = self.session.post(self.url, data=payload, files=files, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"サーバーへの送信中にエラーが発生しました: {e}")
+            _send_total.inc(result="error")
+            return False, None
+        elapsed = time.perf_counter() - start
+        self.latencies.append(elapsed)
+        _send_seconds.observe(elapsed)
+
+        if response.status_code == 503:
+            # サーバーが混雑している場合は Retry-After に従います (解釈できなければ通常のバックオフ)
+            _send_total.inc(result="busy")
+            return False, parse_retry_after(response.headers.get("Retry-After"))
+        if response.status_code >= 400:
+            logging.error(f"サーバーがエラーを返しました: {response.status_code} {response.text}")
+            _send_total.inc(result="rejected")
+            # クライアント側の誤りは再送しても直らないので諦めます
+            return response.status_code < 500, None
+
+        self.sent += 1
+        _send_total.inc(result="ok")
+        self._apply_hints(response.headers)
+        logging.debug(f"サーバーからのレスポンス: {response.text}")
+        return True, None
+
+    def pending(self) -> int:
+        """
+        送信待ちのフレーム数を返します。
+        """
+        with self._cond:
+            return len(self._queue)
+
+    def close(self, timeout: float = 1.0) -> None:
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        self._thread.join(timeout=timeout)
+        self.session.close()
@@ -0,0 +1,191 @@
+import logging
+import multiprocessing as mp
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from utils.metrics import counter, histogram
+
+_STOP = object()
+_STOP_POLL_SECONDS = 0.5  # 停止中に空のキューを待つ間隔
+
+_stage_seconds = histogram("pipeline_stage_seconds", "Time spent in each pipeline stage per frame", ("stage",))
+_stage_dropped = counter("pipeline_dropped_frames_total", "Frames dropped from a full stage queue", ("stage",))
+_stage_errors = counter("pipeline_stage_errors_total", "Frames whose stage function raised", ("stage",))
+
+
+def percentile(values, q: float) -> float:
+    """
+    values の q パーセンタイル (0〜100) を返します (最も近い順位の値)。空なら 0 です。
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(q / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class Stage:
+    """
+    パイプラインの 1 段。
+
+    kind="thread" の場合は fn(item) をスレッドで実行し、戻り値を次の段へ渡します
+    (None を返すとそのフレームはそこで終わります)。
+    kind="process" の場合は fn(item["job"]) をプロセスプールで実行し、戻り値を
+    item["result"] に入れて item を次の段へ渡します (job が None なら実行しません)。
+    fn と job は pickle できる必要があります。
+
+    Args:
+        name (str): 段の名前 (統計情報のキー)
+        fn (Callable): 各フレームに対する処理
+        workers (int): 並列に処理するワーカー数
+        queue_size (int): この段の入力キューの長さ。満杯のときは一番古いフレームを捨てます
+        kind (str): "thread" または "process"
+        initializer (Optional[Callable]): プロセスプールの各ワーカーの初期化関数
+        sample_size (int): パーセンタイルの計算のために保持する直近の処理時間の数
+    """
+
+    def __init__(self, name: str, fn: Callable[[Any], Any], workers: int = 1, queue_size: int = 2,
+                 kind: str = "thread", initializer: Optional[Callable[..., Any]] = None,
+                 initargs: tuple = (), sample_size: int = 1024) -> None:
+        if kind not in ("thread", "process"):
+            raise ValueError("kind must be 'thread' or 'process'")
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.kind = kind
+        self.initializer = initializer
+        self.initargs = initargs
+        self.queue: "queue.Queue[Any]" = queue.Queue(maxsize=queue_size)
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency = 0.0  # 1 フレームあたりの処理時間 (秒) の指数移動平均
+        self._samples: "deque[float]" = deque(maxlen=sample_size)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def offer(self, item: Any) -> None:
+        """
+        フレームを入力キューに入れます。満杯の場合は一番古いフレームを捨てて待たずに戻ります。
+        """
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    with self._lock:
+                        self.dropped += 1
+                    _stage_dropped.inc(stage=self.name)
+                except queue.Empty:
+                    pass
+
+    def record(self, elapsed: float, failed: bool = False) -> None:
+        """
+        1 フレームの処理時間を記録します。例外で終わったフレームは processed ではなく errors に数えます。
+        """
+        _stage_seconds.observe(elapsed, stage=self.name)
+        if failed:
+            _stage_errors.inc(stage=self.name)
+        with self._lock:
+            if failed:
+                self.errors += 1
+            else:
+                self.processed += 1
+            self.latency = elapsed if not self._samples else 0.9 * self.latency + 0.1 * elapsed
+            self._samples.append(elapsed)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            samples = list(self._samples)
+            return {
+                "queue_depth": self.queue.qsize(),
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "latency_ms": self.latency * 1000,
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000
+            }
+
+
+class Pipeline:
+    """
+    有界キューでつないだ段を並列に動かし、スループットを最も遅い段の速度に近づけます。
+    """
+
+    def __init__(self, stages: List[Stage]) -> None:
+        self.stages = stages
+        self._threads: List[List[threading.Thread]] = [[] for _ in stages]
+
+    def start(self) -> "Pipeline":
+        for index, stage in enumerate(self.stages):
+            if stage.kind == "process":
+                # 段のスレッドやカメラの取得スレッドが動いているプロセスからの fork は避け、spawn で起動します
+                stage.executor = ProcessPoolExecutor(max_workers=stage.workers, mp_context=mp.get_context("spawn"),
+                                                     initializer=stage.initializer, initargs=stage.initargs)
+            for worker in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(index,), name=f"{stage.name}-{worker}", daemon=True)
+                thread.start()
+                self._threads[index].append(thread)
+        return self
+
+    def submit(self, item: Any) -> None:
+        """
+        先頭の段にフレームを投入します。呼び出し元を待たせることはありません。
+        """
+        self.stages[0].offer(item)
+
+    def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        downstream = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            try:
+                item = stage.queue.get(timeout=_STOP_POLL_SECONDS)
+            except queue.Empty:
+                # 停止の合図が上流から遅れて届いたフレームに押し出された場合も、キューが空になれば止まります
+                if stage._stopping.is_set():
+                    return
+                continue
+            if item is _STOP:
+                # 停止の合図は 1 つだけ入れ、受け取ったワーカーが次のワーカーへ入れ直して順に止めます
+                stage.offer(_STOP)
+                return
+
+            start = time.perf_counter()
+            try:
+                if stage.kind == "process":
+                    job = item.get("job")
+                    item["result"] = None if job is None else stage.executor.submit(stage.fn, job).result()
+                    output = item
+                else:
+                    output = stage.fn(item)
+            except Exception:
+                stage.record(time.perf_counter() - start, failed=True)
+                logging.exception(f"Stage {stage.name} failed")
+                continue
+            stage.record(time.perf_counter() - start)
+
+            if output is not None and downstream is not None:
+                downstream.offer(output)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def stop(self, timeout: float = 1.0) -> None:
+        # 上流の段から順に止めます。停止の合図は満杯でも待たないよう offer で入れ、各段はそれより前に
+        # キューに残ったフレームを処理してから止まります
+        for stage, threads in zip(self.stages, self._threads):
+            stage._stopping.set()
+            stage.offer(_STOP)
+            for thread in threads:
+                thread.join(timeout=timeout)
+            if stage.executor is not None:
+                stage.executor.shutdown(wait=False, cancel_futures=True)
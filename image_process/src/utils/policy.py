@@ -0,0 +1,86 @@
+import time
+import cv2
+import numpy as np
+from typing import Dict, List, Optional
+
+IDLE = "idle"
+MOTION = "motion"
+FACES = "faces"
+
+
+class StateConfig:
+    """
+    状態ごとの送信設定。
+
+    Args:
+        max_fps (float): 状態が変わらない間に送る最大のフレームレート (0 なら状態遷移とハートビートのみ)
+        scale (float): 送信前にフレームを縮小する倍率
+    """
+
+    def __init__(self, max_fps: float, scale: float = 1.0) -> None:
+        self.max_fps = max_fps
+        self.scale = scale
+
+
+DEFAULT_CONFIGS = {
+    IDLE: StateConfig(max_fps=0.0, scale=0.5),
+    MOTION: StateConfig(max_fps=1.0, scale=0.5),
+    FACES: StateConfig(max_fps=5.0, scale=1.0),
+}
+
+
+class UploadPolicy:
+    """
+    どのフレームをサーバーに送るかを決めます。
+
+    状態 (idle / motion / faces) が変わったとき、写っている人物の数や名前が変わったときは
+    必ず送り、それ以外は状態ごとの max_fps と、heartbeat_interval 秒ごとのキーフレームに
+    間引きます。
+    """
+
+    def __init__(self, configs: Optional[Dict[str, StateConfig]] = None, heartbeat_interval: float = 30.0) -> None:
+        self.configs = dict(DEFAULT_CONFIGS)
+        if configs:
+            self.configs.update(configs)
+        self.heartbeat_interval = heartbeat_interval
+        self.last_state: Optional[str] = None
+        self.last_names: List[str] = []
+        self.last_sent = float("-inf")
+
+    def decide(self, state: str, names: Optional[List[str]] = None, now: Optional[float] = None) -> Optional[StateConfig]:
+        """
+        現在のフレームを送るべきかを判定します。
+
+        Args:
+            state (str): 現在の状態 (IDLE, MOTION, FACES)
+            names (Optional[List[str]]): 写っている人物の名前
+            now (Optional[float]): 現在時刻 (省略時は time.monotonic())
+
+        Returns:
+            Optional[StateConfig]: 送る場合はその状態の設定、送らない場合は None
+        """
+        now = time.monotonic() if now is None else now
+        names = sorted(names or [])
+        config = self.configs[state]
+
+        transition = state != self.last_state or names != self.last_names
+        self.last_state = state
+        self.last_names = names
+
+        elapsed = now - self.last_sent
+        due = config.max_fps > 0 and elapsed >= 1.0 / config.max_fps
+        heartbeat = elapsed >= self.heartbeat_interval
+        if not (transition or due or heartbeat):
+            return None
+
+        self.last_sent = now
+        return config
+
+    @staticmethod
+    def prepare(frame: np.ndarray, config: StateConfig) -> np.ndarray:
+        """
+        設定に合わせて送信用のフレームを縮小します。
+        """
+        if config.scale == 1.0:
+            return frame
+        return cv2.resize(frame, None, fx=config.scale, fy=config.scale, interpolation=cv2.INTER_AREA)
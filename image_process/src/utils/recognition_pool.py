@@ -0,0 +1,132 @@
+import logging
+import multiprocessing as mp
+import os
+import queue
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+def recognition_worker(jobs, results: Dict[str, "mp.Queue"], engine_options: Optional[dict] = None,
+                       metrics_path: Optional[str] = None, metrics_interval: float = 10.0) -> None:
+    """
+    共有の待ち行列から顔認識の依頼を受け取り、依頼元のカメラの結果キューへ返します。
+
+    Args:
+        engine_options (Optional[dict]): utils.embedding.create_engine に渡す設定
+        metrics_path (Optional[str]): 指標を書き出す JSON ファイル (None なら書き出しません)
+    """
+    # TensorFlow と PyTorch を読み込むのはワーカーの中だけにします
+    from db.client import get_client
+    from utils.embedding import create_engine
+    from utils.face import FaceRecognition
+    from utils.metrics import MetricsDumper
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    dumper = MetricsDumper(metrics_path, interval=metrics_interval).start() if metrics_path else None
+    # 顔検出はカメラのプロセスで済んでいるため、ワーカーは MTCNN を持たず特徴ベクトルと照合だけを行います
+    face_recognition = FaceRecognition(get_client("face"), engine=create_engine(**(engine_options or {})),
+                                       detector=False)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        camera_id, job_id, frame, boxes, landmarks = job
+        matches = face_recognition.identify_faces(frame, boxes, landmarks)
+        results[camera_id].put((job_id, matches))
+    face_recognition.close()
+    if dumper is not None:
+        dumper.stop()
+
+
+class RecognitionClient:
+    """
+    カメラのプロセスから共有の顔認識プールを呼び出すためのクライアント。
+    FaceRecognition.identify_faces と同じ形で呼び出せます。
+    """
+
+    def __init__(self, camera_id: str, jobs, results, timeout: float = 5.0) -> None:
+        self.camera_id = camera_id
+        self.jobs = jobs
+        self.results = results
+        self.timeout = timeout
+        self._job_id = 0
+
+    def identify_faces(self, frame: np.ndarray, boxes: np.ndarray,
+                       landmarks: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        unknown = [("unknown", 0.0)] * len(boxes)
+        self._job_id += 1
+        try:
+            self.jobs.put((self.camera_id, self._job_id, frame, boxes, landmarks), timeout=self.timeout)
+        except queue.Full:
+            logging.warning(f"Recognition pool is saturated, skipping faces from camera {self.camera_id}")
+            return unknown
+
+        # タイムアウトした過去の依頼の結果が遅れて届くことがあるので、番号が一致するまで読み捨てます
+        while True:
+            try:
+                job_id, matches = self.results.get(timeout=self.timeout)
+            except queue.Empty:
+                logging.warning(f"Recognition timed out for camera {self.camera_id}")
+                return unknown
+            if job_id == self._job_id:
+                return matches
+
+
+class RecognitionPool:
+    """
+    全カメラで共有する顔認識のワーカープロセス群。
+
+    Args:
+        camera_ids (List[str]): 結果キューを用意するカメラの識別子
+        workers (int): ワーカープロセス数 (0 ならコア数に合わせます。ただし max_workers まで)
+        max_workers (int): workers=0 のときのワーカー数の上限 (0 なら上限なし)。ワーカーはそれぞれモデルと
+            ギャラリーを読み込むため、コア数の多いマシンでメモリを使い切らないよう制限します
+        queue_size (int): 処理待ちの依頼の最大数
+        engine_options (Optional[dict]): 各ワーカーで utils.embedding.create_engine に渡す設定
+        metrics_dir (Optional[str]): 各ワーカーの指標を recognition-{番号}.json として書き出すディレクトリ
+    """
+
+    def __init__(self, camera_ids: List[str], workers: int = 0, max_workers: int = 0, queue_size: int = 0,
+                 context: Optional[mp.context.BaseContext] = None,
+                 engine_options: Optional[dict] = None, metrics_dir: Optional[str] = None,
+                 metrics_interval: float = 10.0) -> None:
+        self.context = context or mp.get_context("spawn")
+        self.engine_options = engine_options or {}
+        self.metrics_dir = metrics_dir
+        self.metrics_interval = metrics_interval
+        auto = os.cpu_count() or 1
+        if max_workers:
+            auto = min(auto, max_workers)
+        self.workers = workers or auto
+        self.jobs = self.context.Queue(maxsize=queue_size or self.workers * 2)
+        self.results = {camera_id: self.context.Queue() for camera_id in camera_ids}
+        self.processes: List[mp.Process] = []
+
+    def start(self) -> "RecognitionPool":
+        for index in range(self.workers):
+            metrics_path = None
+            if self.metrics_dir:
+                metrics_path = os.path.join(self.metrics_dir, f"recognition-{index}.json")
+            process = self.context.Process(target=recognition_worker,
+                                           args=(self.jobs, self.results, self.engine_options,
+                                                 metrics_path, self.metrics_interval),
+                                           name=f"recognition-{index}", daemon=True)
+            process.start()
+            self.processes.append(process)
+        logging.info(f"Recognition pool started with {self.workers} workers")
+        return self
+
+    def client(self, camera_id: str) -> RecognitionClient:
+        return RecognitionClient(camera_id, self.jobs, self.results[camera_id])
+
+    def stop(self, timeout: float = 5.0) -> None:
+        for _ in self.processes:
+            try:
+                self.jobs.put(None, timeout=timeout)
+            except queue.Full:
+                break
+        for process in self.processes:
+            process.join(timeout=timeout)
+            if process.is_alive():
+                process.terminate()
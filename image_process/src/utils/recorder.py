@@ -0,0 +1,267 @@
+import logging
+import os
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+class FrameRing:
+    """
+    直近のフレームを固定長で保持するリングバッファ。
+
+    encode_jpeg=False の場合は (capacity, H, W, 3) の配列を最初に確保し、フレームをその場に
+    コピーします。encode_jpeg=True の場合は JPEG のバイト列で保持してメモリを抑えます。
+    どちらもフレームには通し番号 (seq) を振り、上書きされた番号は取り出せません。
+
+    Args:
+        capacity (int): 保持するフレーム数
+        frame_size (Tuple[int, int]): 保持するフレームの (幅, 高さ)。異なる大きさのフレームは縮小します
+        encode_jpeg (bool): JPEG で保持するか
+        jpeg_quality (int): JPEG の画質
+    """
+
+    def __init__(self, capacity: int, frame_size: Tuple[int, int], encode_jpeg: bool = False,
+                 jpeg_quality: int = 80) -> None:
+        self.capacity = capacity
+        self.frame_size = frame_size
+        self.encode_jpeg = encode_jpeg
+        self.jpeg_params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+        width, height = frame_size
+        self._slab = None if encode_jpeg else np.zeros((capacity, height, width, 3), dtype=np.uint8)
+        self._jpegs: List[Optional[bytes]] = [None] * capacity if encode_jpeg else []
+        self._timestamps = np.zeros(capacity, dtype=np.float64)
+        self._lock = threading.Lock()
+        self.next_seq = 0  # 次に書き込むフレームの番号
+
+    @property
+    def oldest_seq(self) -> int:
+        return max(0, self.next_seq - self.capacity)
+
+    def nbytes(self) -> int:
+        if self._slab is not None:
+            return self._slab.nbytes
+        with self._lock:
+            return sum(len(jpeg) for jpeg in self._jpegs if jpeg is not None)
+
+    def push(self, frame: np.ndarray, timestamp: float) -> int:
+        """
+        フレームを書き込み、その番号を返します。満杯の場合は一番古いフレームを上書きします。
+        """
+        width, height = self.frame_size
+        if frame.shape[1] != width or frame.shape[0] != height:
+            frame = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+        jpeg = None
+        if self.encode_jpeg:
+            ret, buffer = cv2.imencode(".jpg", frame, self.jpeg_params)
+            if not ret:
+                raise RuntimeError("Failed to encode frame")
+            jpeg = buffer.tobytes()
+
+        with self._lock:
+            seq = self.next_seq
+            slot = seq % self.capacity
+            if jpeg is not None:
+                self._jpegs[slot] = jpeg
+            else:
+                np.copyto(self._slab[slot], frame)
+            self._timestamps[slot] = timestamp
+            self.next_seq += 1
+        return seq
+
+    def get(self, seq: int, out: Optional[np.ndarray] = None) -> Optional[Tuple[np.ndarray, float]]:
+        """
+        番号 seq のフレームを返します。まだ書き込まれていないか、既に上書きされた場合は None です。
+        out を渡すとそこにコピーします (スラブ形式のとき)。
+        """
+        with self._lock:
+            if seq < self.oldest_seq or seq >= self.next_seq:
+                return None
+            slot = seq % self.capacity
+            timestamp = float(self._timestamps[slot])
+            if not self.encode_jpeg:
+                if out is None:
+                    return self._slab[slot].copy(), timestamp
+                np.copyto(out, self._slab[slot])
+                return out, timestamp
+            jpeg = self._jpegs[slot]
+        # デコードはロックの外で行います (bytes は書き換わらないため安全です)
+        return cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR), timestamp
+
+    def seq_at(self, timestamp: float) -> int:
+        """
+        timestamp 以降に書き込まれた最も古いフレームの番号を返します。
+        """
+        with self._lock:
+            for seq in range(self.oldest_seq, self.next_seq):
+                if self._timestamps[seq % self.capacity] >= timestamp:
+                    return seq
+            return self.next_seq
+
+
+class ClipRecorder:
+    """
+    直近 pre_seconds 秒のフレームを常にリングバッファに保持し、イベントが起きたら
+    その前後の映像を動画ファイルに書き出します。
+
+    書き出しは専用のスレッドがリングバッファを後追いで読むため、取得側は待たされません。
+    イベント後のフレームも同じリングバッファを通るので、メモリ使用量はバッファの大きさで決まります。
+    書き出しが追いつかず上書きされたフレームは dropped_frames に数えて読み飛ばします。
+
+    Args:
+        output_dir (str): 動画の保存先
+        camera_id (str): ファイル名に付けるカメラの識別子
+        frame_size (Tuple[int, int]): 動画の (幅, 高さ)
+        fps (float): バッファに入れる・書き出すフレームレート (これを超えるフレームは間引きます)
+        pre_seconds (float): イベント前に遡って書き出す秒数
+        post_seconds (float): 最後のイベントの後に書き続ける秒数
+        max_clip_seconds (float): 1 つの動画の最大の長さ
+        encode_jpeg (bool): バッファを JPEG で保持するか (FrameRing を参照)
+        fourcc (str): 動画のコーデック
+    """
+
+    def __init__(self, output_dir: str = "clips", camera_id: str = "default",
+                 frame_size: Tuple[int, int] = (640, 480), fps: float = 10.0, pre_seconds: float = 5.0,
+                 post_seconds: float = 10.0, max_clip_seconds: float = 60.0, encode_jpeg: bool = False,
+                 jpeg_quality: int = 80, fourcc: str = "mp4v") -> None:
+        self.output_dir = output_dir
+        self.camera_id = camera_id
+        self.frame_size = frame_size
+        self.fps = fps
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.max_clip_seconds = max_clip_seconds
+        self.fourcc = fourcc
+        # イベント前の分に加え、書き出しの遅れを吸収する分 (1 秒) を確保します
+        capacity = max(1, int(round((pre_seconds + 1.0) * fps)))
+        self.ring = FrameRing(capacity, frame_size, encode_jpeg=encode_jpeg, jpeg_quality=jpeg_quality)
+        width, height = frame_size
+        self._scratch = np.zeros((height, width, 3), dtype=np.uint8)
+
+        self._cond = threading.Condition()
+        self._last_push = 0.0
+        self._clip_start: Optional[float] = None  # 書き出し中の動画の開始時刻
+        self._clip_end = 0.0
+        self._reason = ""
+        self._last_trigger = float("-inf")  # 最後のイベントの時刻と理由
+        self._last_reason = ""
+        self._running = True
+        self.clips = 0
+        self.dropped_frames = 0
+
+        os.makedirs(output_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._write_loop, name=f"recorder-{camera_id}", daemon=True)
+        self._thread.start()
+        if not encode_jpeg:
+            logging.info(f"Clip recorder buffers {capacity} frames ({self.ring.nbytes() / 2 ** 20:.1f} MiB)")
+
+    @property
+    def recording(self) -> bool:
+        with self._cond:
+            return self._clip_start is not None
+
+    def push(self, frame: np.ndarray, timestamp: Optional[float] = None) -> None:
+        """
+        取得したフレームをバッファに入れます。fps を超える分は捨てます。
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        if timestamp - self._last_push < 1.0 / self.fps:
+            return
+        self._last_push = timestamp
+        self.ring.push(frame, timestamp)
+        with self._cond:
+            self._cond.notify_all()
+
+    def trigger(self, reason: str, now: Optional[float] = None) -> None:
+        """
+        イベントを通知します。書き出し中でなければ pre_seconds 前からの動画を開始し、
+        書き出し中であれば終了時刻を延ばします (max_clip_seconds まで)。
+        """
+        now = time.time() if now is None else now
+        with self._cond:
+            self._last_trigger, self._last_reason = now, reason
+            if self._clip_start is None:
+                self._clip_start = now - self.pre_seconds
+                self._reason = reason
+                logging.info(f"Recording clip ({reason})")
+            self._clip_end = min(now + self.post_seconds, self._clip_start + self.max_clip_seconds)
+            self._cond.notify_all()
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._clip_start is not None or not self._running)
+                if not self._running:
+                    return
+                clip_start, reason = self._clip_start, self._reason
+            closed_end = None
+            try:
+                closed_end = self._write_clip(clip_start, reason)
+            except Exception as e:
+                logging.error(f"Failed to write clip: {e}")
+            with self._cond:
+                # 書き終えた後 (writer.release の間を含む) に届いたイベントは終了時刻を延ばしても
+                # 書かれないため、書いた分の続きから次の動画として書き出します
+                if (closed_end is not None and self._running
+                        and self._last_trigger + self.post_seconds > closed_end):
+                    self._clip_start = max(closed_end, self._last_trigger - self.pre_seconds)
+                    self._clip_end = min(self._last_trigger + self.post_seconds,
+                                         self._clip_start + self.max_clip_seconds)
+                    self._reason = self._last_reason
+                    logging.info(f"Recording clip ({self._reason})")
+                else:
+                    self._clip_start = None
+
+    def _write_clip(self, clip_start: float, reason: str) -> Optional[float]:
+        """
+        clip_start から終了時刻までのフレームを動画に書き出し、書き終えた時点の終了時刻を返します。
+        stop() で止めた場合は None です。
+        """
+        name = time.strftime("%Y%m%d-%H%M%S", time.localtime(clip_start))
+        path = os.path.join(self.output_dir, f"{self.camera_id}_{name}_{reason}.mp4")
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, self.frame_size)
+        written = 0
+        closed_end = None
+        seq = self.ring.seq_at(clip_start)
+        try:
+            while True:
+                with self._cond:
+                    # 次のフレームが来るか、終了時刻を過ぎるまで待ちます
+                    self._cond.wait_for(
+                        lambda: self.ring.next_seq > seq or time.time() >= self._clip_end or not self._running,
+                        timeout=0.5)
+                    if self.ring.next_seq <= seq and (time.time() >= self._clip_end or not self._running):
+                        closed_end = self._clip_end if self._running else None
+                        break
+
+                if seq < self.ring.oldest_seq:
+                    # 書き出しが遅れて上書きされた分は読み飛ばします
+                    self.dropped_frames += self.ring.oldest_seq - seq
+                    seq = self.ring.oldest_seq
+                item = self.ring.get(seq, out=self._scratch)
+                if item is None:
+                    continue
+                frame, timestamp = item
+                with self._cond:
+                    if timestamp > self._clip_end:
+                        closed_end = self._clip_end
+                        break
+                writer.write(frame)
+                written += 1
+                seq += 1
+        finally:
+            writer.release()
+        self.clips += 1
+        logging.info(f"Saved clip {path} ({written} frames)")
+        return closed_end
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """
+        書き出し中の動画を閉じてスレッドを止めます。
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join(timeout=timeout)
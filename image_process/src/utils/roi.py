@@ -0,0 +1,134 @@
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+Region = Tuple[int, int, int, int]
+
+# 変化したブロックが無いとき (detector="ssim") に静的な領域を描くグリッドの大きさ (行, 列)
+STATIC_GRID = (60, 80)
+
+
+def merge_regions(regions: Sequence[Region]) -> List[Region]:
+    """
+    重なる・接する矩形を外接矩形にまとめ、互いに重ならない矩形のリストにします。
+    """
+    merged = list(regions)
+    changed = True
+    while changed:
+        changed = False
+        result: List[Region] = []
+        for x1, y1, x2, y2 in merged:
+            for i, (mx1, my1, mx2, my2) in enumerate(result):
+                if x1 <= mx2 and mx1 <= x2 and y1 <= my2 and my1 <= y2:
+                    result[i] = (min(x1, mx1), min(y1, my1), max(x2, mx2), max(y2, my2))
+                    changed = True
+                    break
+            else:
+                result.append((x1, y1, x2, y2))
+        merged = result
+    return merged
+
+
+def region_area(regions: Sequence[Region]) -> int:
+    return sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in regions)
+
+
+class RoiSelector:
+    """
+    顔検出を行う領域 (ROI) を決めます。
+
+    背景との比較で変化したブロックを padding だけ広げ、重なる矩形をまとめたものを ROI とします。
+    zones を指定した場合はその中だけ、masks を指定した場合はその外だけを対象にします。
+    zones と masks はフレームの幅と高さに対する割合 (0〜1) の (x1, y1, x2, y2) で指定します。
+
+    Args:
+        zones (Sequence): 検出の対象にする領域 (空ならフレーム全体)
+        masks (Sequence): 検出から除外する領域
+        padding (int): 変化した領域の周囲に足す余白 (ピクセル)。顔の一部しか動いていない場合に備えます
+        max_coverage (float): ROI の合計面積がフレームのこの割合を超えたら、全体を 1 つの領域として検出します
+    """
+
+    def __init__(self, zones: Sequence[Sequence[float]] = (), masks: Sequence[Sequence[float]] = (),
+                 padding: int = 32, max_coverage: float = 0.6) -> None:
+        self.zones = [tuple(zone) for zone in zones]
+        self.masks = [tuple(mask) for mask in masks]
+        self.padding = padding
+        self.max_coverage = max_coverage
+        self._static: Dict[Tuple[int, int], np.ndarray] = {}
+        self.last_coverage = 1.0
+
+    @staticmethod
+    def _grid_slice(rect: Sequence[float], grid_shape: Tuple[int, int]) -> Tuple[slice, slice]:
+        rows, cols = grid_shape
+        x1, y1, x2, y2 = rect
+        return (slice(int(y1 * rows), math.ceil(y2 * rows)), slice(int(x1 * cols), math.ceil(x2 * cols)))
+
+    def static_mask(self, grid_shape: Tuple[int, int]) -> np.ndarray:
+        """
+        zones と masks から、検出の対象にするセルを 1 とした grid_shape のマスクを作ります (グリッドごとにキャッシュします)。
+        """
+        grid_shape = tuple(grid_shape)
+        if grid_shape in self._static:
+            return self._static[grid_shape]
+        mask = np.zeros(grid_shape, dtype=np.uint8) if self.zones else np.ones(grid_shape, dtype=np.uint8)
+        for zone in self.zones:
+            mask[self._grid_slice(zone, grid_shape)] = 1
+        for masked in self.masks:
+            mask[self._grid_slice(masked, grid_shape)] = 0
+        self._static[grid_shape] = mask
+        return mask
+
+    def select(self, frame_shape: Tuple[int, ...], changed_blocks: Optional[np.ndarray] = None) -> List[Region]:
+        """
+        顔検出を行う領域を元のフレームの座標で返します。
+
+        Args:
+            frame_shape: フレームの shape
+            changed_blocks (Optional[np.ndarray]): Background.last_changed_blocks (無ければ静的な領域だけを使います)
+
+        Returns:
+            List[Region]: 互いに重ならない (x1, y1, x2, y2) のリスト。検出の必要が無ければ空
+        """
+        height, width = frame_shape[:2]
+        if changed_blocks is None:
+            if not self.zones and not self.masks:
+                self.last_coverage = 1.0
+                return [(0, 0, width, height)]
+            blocks = self.static_mask(STATIC_GRID)
+        else:
+            blocks = changed_blocks.astype(np.uint8) & self.static_mask(changed_blocks.shape)
+
+        count, _, stats, _ = cv2.connectedComponentsWithStats(blocks, connectivity=8)
+        rows, cols = blocks.shape
+        sx, sy = width / cols, height / rows
+        pad = self.padding
+        regions = [
+            (max(0, int(x * sx) - pad), max(0, int(y * sy) - pad),
+             min(width, math.ceil((x + w) * sx) + pad), min(height, math.ceil((y + h) * sy) + pad))
+            for x, y, w, h, _ in stats[1:count]
+        ]
+        regions = merge_regions(regions)
+
+        area = region_area(regions)
+        self.last_coverage = area / float(width * height)
+        if self.last_coverage > self.max_coverage:
+            # 小さな領域に分けて何度も検出するより、外接矩形 1 つで検出したほうが速い
+            return [(min(r[0] for r in regions), min(r[1] for r in regions),
+                     max(r[2] for r in regions), max(r[3] for r in regions))]
+        return regions
+
+    def allowed(self, boxes: np.ndarray, frame_shape: Tuple[int, ...]) -> np.ndarray:
+        """
+        中心が検出の対象の領域にある顔だけを True とした配列を返します。
+        ROI は矩形にまとめるため、マスクした領域の顔が含まれることがあり、それを取り除きます。
+        """
+        if not self.zones and not self.masks:
+            return np.ones(len(boxes), dtype=bool)
+        height, width = frame_shape[:2]
+        rows, cols = STATIC_GRID
+        mask = self.static_mask(STATIC_GRID)
+        cx = np.clip(((boxes[:, 0] + boxes[:, 2]) / 2 / width * cols).astype(int), 0, cols - 1)
+        cy = np.clip(((boxes[:, 1] + boxes[:, 3]) / 2 / height * rows).astype(int), 0, rows - 1)
+        return mask[cy, cx].astype(bool)
@@ -0,0 +1,228 @@
+"""
+同じホスト上の image_process とバックエンドの間で、フレームを共有メモリで受け渡します。
+
+1 台のカメラにつき 1 つの共有メモリを使い、先頭のヘッダーと、あらかじめ確保した slots 個の
+スロットからなります。書き込み側 (image_process) はフレームを次のスロットに BGR のままコピーし、
+検出結果などのメタデータを JSON でスロットに添えてから最新の番号 (seq) を更新します。
+読み込み側 (バックエンド) は最新の番号を見てスロットを NumPy のビューとして読みます (コピーもデコードもしません)。
+
+各スロットは書き込みの開始時と終了時に番号を書くため、読み込み側は書きかけのスロットを読まず、
+処理の後で valid() を確かめれば、処理中に上書きされたかも分かります。
+
+書き込み側は共有メモリを閉じるときと、前回の実行で残った共有メモリを作り直すときに、
+古い共有メモリのヘッダーへ閉じた印を付けます。読み込み側は closed を見て開き直します。
+"""
+import json
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+MAGIC = 0x46524D53  # "SMRF"
+VERSION = 1
+PREFIX = "surveillance-frames-"
+
+# magic, version, slots, meta_size, frame_bytes, token, latest_seq, reader_heartbeat
+_HEADER = struct.Struct("<IIIIQQQd")
+_LATEST_OFFSET = 32
+_HEARTBEAT_OFFSET = 40
+_CLOSED_OFFSET = 48
+HEADER_SIZE = 64
+
+# begin_seq, end_seq, height, width, channels, meta_len, timestamp
+_SLOT = struct.Struct("<QQIIIId")
+SLOT_HEADER_SIZE = 64
+
+
+def segment_name(camera_id: str) -> str:
+    return f"{PREFIX}{camera_id}"
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python 3.12 以前は開いただけのプロセスも終了時に共有メモリを削除してしまうため、登録を外します
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _mark_closed(shm: shared_memory.SharedMemory) -> None:
+    """
+    まだ開いている読み込み側が開き直すよう、共有メモリに閉じた印を付けます (フレームのリングの場合だけ)。
+    """
+    if shm.size >= HEADER_SIZE and struct.unpack_from("<I", shm.buf, 0)[0] == MAGIC:
+        struct.pack_into("<I", shm.buf, _CLOSED_OFFSET, 1)
+
+
+class SharedFrame:
+    """
+    共有メモリ上の 1 フレーム。frame は共有メモリのビューなので書き換えないでください。
+    """
+
+    def __init__(self, ring: "SharedFrameRing", seq: int, frame: np.ndarray, metadata: Dict[str, Any],
+                 timestamp: float) -> None:
+        self.ring = ring
+        self.seq = seq
+        self.frame = frame
+        self.metadata = metadata
+        self.timestamp = timestamp
+
+    def valid(self) -> bool:
+        """
+        読み込んだ後にスロットが上書きされていなければ True です。
+        """
+        return self.ring.slot_seq(self.seq) == self.seq
+
+
+class SharedFrameRing:
+    """
+    共有メモリ上のフレームのリングバッファ。create で作成し (書き込み側)、attach で開きます (読み込み側)。
+
+    Args:
+        shm (SharedMemory): 共有メモリ
+        owner (bool): 作成した側か (close 時に削除します)
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool = False) -> None:
+        self.shm = shm
+        self.owner = owner
+        magic, version, self.slots, self.meta_size, self.frame_bytes, self.token, _, _ = \
+            _HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{shm.name} is not a frame ring (version {VERSION})")
+        self.slot_size = SLOT_HEADER_SIZE + self.meta_size + self.frame_bytes
+        self._seq = self.latest_seq
+
+    @classmethod
+    def create(cls, name: str, frame_shape: Tuple[int, int, int], slots: int = 8,
+               meta_size: int = 4096) -> "SharedFrameRing":
+        """
+        frame_shape (高さ, 幅, チャンネル数) までのフレームを slots 枚保持する共有メモリを作ります。
+        前回の実行で残った同名の共有メモリは削除してから作ります。
+        """
+        frame_bytes = int(np.prod(frame_shape))
+        size = HEADER_SIZE + slots * (SLOT_HEADER_SIZE + meta_size + frame_bytes)
+        try:
+            stale = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            pass
+        else:
+            _mark_closed(stale)
+            stale.close()
+            stale.unlink()
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        # 書き込み側が作り直したことを読み込み側が見分けられるよう、作成ごとの識別子を入れます
+        token = int.from_bytes(os.urandom(8), "little")
+        _HEADER.pack_into(shm.buf, 0, MAGIC, VERSION, slots, meta_size, frame_bytes, token, 0, 0.0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedFrameRing":
+        """
+        既存の共有メモリを開きます。無い場合は FileNotFoundError です。
+        """
+        return cls(_attach(name))
+
+    @property
+    def latest_seq(self) -> int:
+        return struct.unpack_from("<Q", self.shm.buf, _LATEST_OFFSET)[0]
+
+    @property
+    def closed(self) -> bool:
+        """
+        書き込み側がこの共有メモリを閉じたか、作り直した場合は True です。
+        """
+        return struct.unpack_from("<I", self.shm.buf, _CLOSED_OFFSET)[0] != 0
+
+    def _slot_offset(self, seq: int) -> int:
+        return HEADER_SIZE + (seq % self.slots) * self.slot_size
+
+    def slot_seq(self, seq: int) -> int:
+        """
+        seq のフレームが入るスロットに、今書き込まれている (書き込み中を含む) フレームの番号を返します。
+        """
+        return struct.unpack_from("<Q", self.shm.buf, self._slot_offset(seq))[0]
+
+    def write(self, frame: np.ndarray, metadata: Optional[Dict[str, Any]] = None,
+              timestamp: Optional[float] = None) -> int:
+        """
+        フレームを次のスロットにコピーし、その番号を返します。書き込み側は 1 つのスレッドに限ります。
+        """
+        if frame.dtype != np.uint8 or frame.nbytes > self.frame_bytes:
+            raise ValueError(f"frame must be uint8 and at most {self.frame_bytes} bytes")
+        meta = json.dumps(metadata or {}).encode()
+        if len(meta) > self.meta_size:
+            raise ValueError(f"metadata must be at most {self.meta_size} bytes")
+        height, width = frame.shape[:2]
+        channels = frame.shape[2] if frame.ndim == 3 else 1
+
+        self._seq += 1
+        seq = self._seq
+        offset = self._slot_offset(seq)
+        # 開始の番号 → 本体 → 終了の番号 の順に書き、読み込み側が書きかけを見分けられるようにします
+        struct.pack_into("<Q", self.shm.buf, offset, seq)
+        self.shm.buf[offset + SLOT_HEADER_SIZE:offset + SLOT_HEADER_SIZE + len(meta)] = meta
+        start = offset + SLOT_HEADER_SIZE + self.meta_size
+        view = np.ndarray(frame.shape, dtype=np.uint8, buffer=self.shm.buf, offset=start)
+        np.copyto(view, frame)
+        del view
+        _SLOT.pack_into(self.shm.buf, offset, seq, seq, height, width, channels, len(meta),
+                        time.time() if timestamp is None else timestamp)
+        struct.pack_into("<Q", self.shm.buf, _LATEST_OFFSET, seq)
+        return seq
+
+    def read(self, seq: int) -> Optional[SharedFrame]:
+        """
+        seq のフレームをコピーせずに返します。書き込み中か、既に上書きされた場合は None です。
+        """
+        if seq <= 0:
+            return None
+        offset = self._slot_offset(seq)
+        begin, end, height, width, channels, meta_len, timestamp = _SLOT.unpack_from(self.shm.buf, offset)
+        if begin != seq or end != seq:
+            return None
+        meta = bytes(self.shm.buf[offset + SLOT_HEADER_SIZE:offset + SLOT_HEADER_SIZE + meta_len])
+        start = offset + SLOT_HEADER_SIZE + self.meta_size
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        frame = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=start)
+        # メタデータを読む間に上書きが始まっていないかを確かめます
+        if self.slot_seq(seq) != seq:
+            return None
+        try:
+            metadata = json.loads(meta) if meta else {}
+        except ValueError:
+            return None
+        return SharedFrame(self, seq, frame, metadata, timestamp)
+
+    def heartbeat(self) -> None:
+        """
+        読み込み側が動いていることを書き込み側に知らせます。
+        """
+        struct.pack_into("<d", self.shm.buf, _HEARTBEAT_OFFSET, time.time())
+
+    def reader_alive(self, timeout: float = 5.0) -> bool:
+        last = struct.unpack_from("<d", self.shm.buf, _HEARTBEAT_OFFSET)[0]
+        return time.time() - last < timeout
+
+    def close(self) -> None:
+        """
+        共有メモリを閉じます。作成した側の場合は削除もします。
+        読み込んだフレームのビューが残っている間は閉じられないため、先に手放してください。
+        """
+        if self.owner:
+            _mark_closed(self.shm)
+        try:
+            self.shm.close()
+        except BufferError:
+            return
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,77 @@
+import logging
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+from utils.http import DetectionData, FrameSender
+from utils.metrics import counter
+from utils.shared_frames import SharedFrameRing, segment_name
+
+_shared_total = counter("shared_frames_total", "Frames handed to the backend", ("transport",))
+
+
+class SharedFrameSender:
+    """
+    同じホストのバックエンドへ共有メモリ (utils.shared_frames) でフレームを渡します。
+    FrameSender と同じく send(frame, data) と close() を持ちます。
+
+    エンコードも HTTP もなく、送信はフレームを共有メモリへ 1 回コピーするだけです。
+    バックエンドが共有メモリを読んでいない間 (ハートビートが reader_timeout 秒より古い間) は
+    fallback の FrameSender で HTTP により送ります。
+
+    Args:
+        camera_id (str): カメラの識別子 (共有メモリの名前に使います)
+        frame_shape (Tuple[int, int, int]): 送るフレームの最大の (高さ, 幅, チャンネル数)
+        fallback (FrameSender): バックエンドが共有メモリを読んでいないときに使う送信
+        slots (int): 共有メモリに保持するフレーム数
+        reader_timeout (float): バックエンドが読んでいないとみなすまでの秒数
+    """
+
+    def __init__(self, camera_id: str, frame_shape: Tuple[int, int, int], fallback: FrameSender,
+                 slots: int = 8, reader_timeout: float = 5.0) -> None:
+        self.camera_id = camera_id
+        self.frame_shape = frame_shape
+        self.fallback = fallback
+        self.reader_timeout = reader_timeout
+        self.ring = SharedFrameRing.create(segment_name(camera_id), frame_shape, slots=slots)
+        self._shared = None
+        self.shared_sent = 0
+        logging.info(f"Shared memory transport ready: {segment_name(camera_id)} "
+                     f"({slots} slots, {self.ring.shm.size / 2 ** 20:.1f} MiB)")
+
+    @property
+    def sent(self) -> int:
+        return self.shared_sent + self.fallback.sent
+
+    @property
+    def dropped(self) -> int:
+        return self.fallback.dropped
+
+    def send(self, frame: np.ndarray, data: DetectionData) -> None:
+        shared = self.ring.reader_alive(self.reader_timeout)
+        if shared != self._shared:
+            self._shared = shared
+            logging.info("Sending frames through shared memory" if shared
+                         else "Backend is not reading shared memory, falling back to HTTP")
+        if not shared:
+            _shared_total.inc(transport="http")
+            self.fallback.send(frame, data)
+            return
+
+        height, width = self.frame_shape[:2]
+        if frame.shape[0] > height or frame.shape[1] > width:
+            # カメラが設定より大きいフレームを返した場合はスロットに収まるよう縮めます
+            scale = min(height / frame.shape[0], width / frame.shape[1])
+            frame = cv2.resize(frame, (int(frame.shape[1] * scale), int(frame.shape[0] * scale)),
+                               interpolation=cv2.INTER_AREA)
+        self.ring.write(np.ascontiguousarray(frame), data.to_dict())
+        self.shared_sent += 1
+        _shared_total.inc(transport="shm")
+
+    def pending(self) -> int:
+        return self.fallback.pending()
+
+    def close(self, timeout: float = 1.0) -> None:
+        self.fallback.close(timeout=timeout)
+        self.ring.close()
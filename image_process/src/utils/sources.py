@@ -0,0 +1,338 @@
+import glob
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+class FrameSource:
+    """
+    フレームの入力の共通部分。Camera と同じ start / read_latest / stats / read / release を持ちます。
+
+    サブクラスは next_frame を実装します。realtime=True の場合は start() 後にスレッドが
+    fps に合わせてフレームを取り出し、処理が追いつかないフレームは Camera と同じく取りこぼします。
+    realtime=False の場合は read_latest のたびに次のフレームを返し、1 枚も取りこぼしません
+    (ベンチマークなどで全てのフレームを処理するとき用)。
+
+    Args:
+        fps (float): 再生するフレームレート
+        realtime (bool): 実時間で再生するか
+    """
+
+    # True の場合、next_frame が None を返しても終わりとみなさず取得を続けます (カメラなど)
+    live = False
+
+    def __init__(self, fps: float = 30.0, realtime: bool = True) -> None:
+        self.fps = fps
+        self.realtime = realtime
+        self.finished = False
+
+        # バックグラウンドで取得した最新フレーム
+        self._cond = threading.Condition()
+        self._frame: Optional[np.ndarray] = None
+        self._timestamp = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self.frame_count = 0
+        self.dropped_frames = 0
+        self.capture_fps = 0.0
+        self._last_read_id = 0
+
+    def next_frame(self) -> Optional[np.ndarray]:
+        """
+        次のフレームを返します。終わりに達した (カメラの場合は取得に失敗した) ときは None です。
+        """
+        raise NotImplementedError
+
+    def start(self):
+        """
+        フレームを取得し続けるスレッドを開始します。以後は read_latest で最新フレームを取得します。
+        """
+        if self._thread is not None or not self.realtime:
+            return self
+        self._running = True
+        self._thread = threading.Thread(target=self._grab_loop, name=f"source-{self}", daemon=True)
+        self._thread.start()
+        return self
+
+    def _publish(self, frame: np.ndarray) -> None:
+        with self._cond:
+            # 読まれないまま上書きされたフレームは取りこぼしとして数えます
+            if self.frame_count > self._last_read_id:
+                self.dropped_frames += 1
+            self._frame = frame
+            self._timestamp = time.time()
+            self.frame_count += 1
+            self._cond.notify_all()
+
+    def _grab_loop(self) -> None:
+        # ライブの入力はデバイスが速度を決めるので、再生の場合だけ fps に合わせて待ちます
+        interval = 0.0 if self.live else 1.0 / self.fps
+        due = time.monotonic()
+        last: Optional[float] = None
+        while self._running:
+            frame = self.next_frame()
+            if frame is None:
+                if self.live:
+                    time.sleep(0.01)
+                    continue
+                with self._cond:
+                    self.finished = True
+                    self._cond.notify_all()
+                return
+            if interval:
+                due += interval
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self._publish(frame)
+            now = time.monotonic()
+            if last is not None and now > last:
+                # 最初の間隔の値で始め、0 からの立ち上がりで最初のフレームレートが低く出ないようにします
+                rate = 1.0 / (now - last)
+                self.capture_fps = rate if self.capture_fps == 0.0 else 0.9 * self.capture_fps + 0.1 * rate
+            last = now
+
+    def read_latest(self, newer_than: int = 0, timeout: float = 0.0) -> Optional[Tuple[np.ndarray, float, int]]:
+        """
+        最新のフレームを返します。待ち行列は持たないため、常にその時点で一番新しいフレームになります。
+
+        Args:
+            newer_than (int): このフレーム番号より新しいフレームだけを返します
+            timeout (float): 新しいフレームを待つ最大秒数 (0 なら待ちません)
+
+        Returns:
+            Optional[Tuple[np.ndarray, float, int]]: (フレーム, 取得時刻, フレーム番号)。無ければ None
+        """
+        if self._thread is None and not self.realtime:
+            if self.finished:
+                return None
+            frame = self.next_frame()
+            if frame is None:
+                self.finished = True
+                return None
+            self._publish(frame)
+
+        with self._cond:
+            if self.frame_count <= newer_than and timeout > 0:
+                self._cond.wait_for(
+                    lambda: self.frame_count > newer_than or not self._running or self.finished, timeout)
+            if self._frame is None or self.frame_count <= newer_than:
+                return None
+            self._last_read_id = self.frame_count
+            return self._frame, self._timestamp, self.frame_count
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "capture_fps": self.capture_fps,
+            "frames": self.frame_count,
+            "dropped_frames": self.dropped_frames
+        }
+
+    def read(self) -> Optional[np.ndarray]:
+        if self._thread is not None:
+            latest = self.read_latest()
+            return None if latest is None else latest[0]
+        return self.next_frame()
+
+    def isOpened(self) -> bool:
+        return True
+
+    def stop(self) -> None:
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+
+    def release(self) -> None:
+        self.stop()
+
+
+class VideoFileSource(FrameSource):
+    """
+    動画ファイルを再生する入力。
+
+    Args:
+        path (str): 動画ファイルのパス
+        fps (Optional[float]): 再生するフレームレート (省略時は動画のフレームレート)
+        loop (bool): 最後まで再生したら先頭に戻るか
+    """
+
+    def __init__(self, path: str, fps: Optional[float] = None, loop: bool = False, realtime: bool = True) -> None:
+        self.path = path
+        self.loop = loop
+        self.cap = cv2.VideoCapture(path)
+        super().__init__(fps=fps or self.cap.get(cv2.CAP_PROP_FPS) or 30.0, realtime=realtime)
+
+    def next_frame(self) -> Optional[np.ndarray]:
+        ret, frame = self.cap.read()
+        if not ret and self.loop:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.cap.read()
+        return frame if ret else None
+
+    def isOpened(self) -> bool:
+        return self.cap.isOpened()
+
+    def release(self) -> None:
+        self.stop()
+        self.cap.release()
+
+    def __str__(self) -> str:
+        return f"video {self.path}"
+
+
+class ImageDirSource(FrameSource):
+    """
+    ディレクトリ内の画像をファイル名の順に再生する入力。
+
+    Args:
+        path (str): 画像のディレクトリ
+        fps (float): 再生するフレームレート
+        loop (bool): 最後まで再生したら先頭に戻るか
+    """
+
+    def __init__(self, path: str, fps: float = 10.0, loop: bool = False, realtime: bool = True) -> None:
+        super().__init__(fps=fps, realtime=realtime)
+        self.path = path
+        self.loop = loop
+        self.paths = sorted(p for p in glob.glob(os.path.join(path, "*"))
+                            if p.lower().endswith(IMAGE_EXTENSIONS))
+        self._index = 0
+
+    def next_frame(self) -> Optional[np.ndarray]:
+        while self.paths:
+            if self._index >= len(self.paths):
+                if not self.loop:
+                    return None
+                self._index = 0
+            frame = cv2.imread(self.paths[self._index])
+            self._index += 1
+            if frame is not None:
+                return frame
+        return None
+
+    def isOpened(self) -> bool:
+        return len(self.paths) > 0
+
+    def __str__(self) -> str:
+        return f"images {self.path}"
+
+
+class SyntheticSource(FrameSource):
+    """
+    固定の背景に、動く物体や顔を決まった割合で差し込む合成の入力。
+
+    映像は segment_seconds ごとの区間に分かれ、各区間は乱数 (seed で固定) で
+    「変化なし」「動く物体」「顔」のいずれかになります。最初の区間は背景の保存のため常に「変化なし」です。
+    顔を差し込むには face_dir に顔写真を置いてください (無い場合は顔の区間も動く物体になります)。
+    各区間の種類は events に数えます。
+
+    Args:
+        width (int): フレームの幅
+        height (int): フレームの高さ
+        fps (float): フレームレート
+        frames (int): 生成するフレーム数 (0 なら無制限)
+        motion_rate (float): 動く物体の区間の割合
+        face_rate (float): 顔の区間の割合
+        face_dir (Optional[str]): 差し込む顔写真のディレクトリ
+        segment_seconds (float): 1 区間の長さ
+        seed (int): 乱数の種
+    """
+
+    def __init__(self, width: int = 640, height: int = 480, fps: float = 30.0, frames: int = 0,
+                 motion_rate: float = 0.3, face_rate: float = 0.1, face_dir: Optional[str] = None,
+                 segment_seconds: float = 2.0, seed: int = 0, realtime: bool = True) -> None:
+        super().__init__(fps=fps, realtime=realtime)
+        self.width = width
+        self.height = height
+        self.frames = frames
+        self.motion_rate = motion_rate
+        self.face_rate = face_rate
+        self.segment_frames = max(1, int(segment_seconds * fps))
+        self._rng = np.random.default_rng(seed)
+
+        # なめらかな模様の背景 (一様な画像だと SSIM やブロック差分の負荷が実際と違うため)
+        noise = self._rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+        self.background = cv2.GaussianBlur(cv2.resize(noise, (width, height), interpolation=cv2.INTER_LINEAR),
+                                           (0, 0), 3)
+
+        self.faces: List[np.ndarray] = []
+        if face_dir:
+            for path in sorted(glob.glob(os.path.join(face_dir, "*"))):
+                if path.lower().endswith(IMAGE_EXTENSIONS):
+                    face = cv2.imread(path)
+                    if face is not None:
+                        size = height // 3
+                        self.faces.append(cv2.resize(face, (size * face.shape[1] // face.shape[0], size)))
+
+        self.events = {"idle": 0, "motion": 0, "face": 0}
+        self.current_event = "idle"
+        self._index = 0
+
+    def _choose_event(self) -> str:
+        if self._index == 0:
+            return "idle"
+        r = self._rng.random()
+        if r < self.face_rate:
+            return "face" if self.faces else "motion"
+        if r < self.face_rate + self.motion_rate:
+            return "motion"
+        return "idle"
+
+    def next_frame(self) -> Optional[np.ndarray]:
+        if self.frames and self._index >= self.frames:
+            return None
+        position = self._index % self.segment_frames
+        if position == 0:
+            self.current_event = self._choose_event()
+            self.events[self.current_event] += 1
+            self._face = self.faces[int(self._rng.integers(len(self.faces)))] if self.faces else None
+        self._index += 1
+
+        frame = self.background.copy()
+        if self.current_event == "idle":
+            return frame
+
+        # 区間の間に左から右へ横切ります
+        if self.current_event == "face":
+            patch = self._face
+        else:
+            patch = np.full((self.height // 3, self.width // 8, 3), 40, dtype=np.uint8)
+        ph, pw = patch.shape[:2]
+        ph, pw = min(ph, self.height), min(pw, self.width)
+        x = int((self.width - pw) * position / max(1, self.segment_frames - 1))
+        y = (self.height - ph) // 2
+        frame[y:y + ph, x:x + pw] = patch[:ph, :pw]
+        return frame
+
+    def __str__(self) -> str:
+        return "synthetic"
+
+
+def open_source(source: Union[int, str], width: int = 640, height: int = 480, fps: float = 30.0,
+                realtime: bool = True) -> FrameSource:
+    """
+    設定の source からフレームの入力を作ります。
+
+        デバイス番号・URL: Camera
+        "synthetic": SyntheticSource
+        ディレクトリ: ImageDirSource
+        ファイル: VideoFileSource
+    """
+    if isinstance(source, str) and source == "synthetic":
+        return SyntheticSource(width, height, fps=fps, realtime=realtime)
+    if isinstance(source, str) and os.path.isdir(source):
+        return ImageDirSource(source, fps=fps, realtime=realtime)
+    if isinstance(source, str) and os.path.isfile(source):
+        return VideoFileSource(source, fps=fps, realtime=realtime)
+
+    from utils.camera import Camera
+    return Camera(source, width=width, height=height, fps=fps)
@@ -0,0 +1,158 @@
+import time
+import numpy as np
+from typing import List, Optional
+
+# これ以上の IoU で対応付いたトラックは同じ人物が静止・ゆっくり移動しているとみなします
+STABLE_IOU = 0.5
+
+
+def iou(box_a: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """
+    1 つのボックスと複数のボックスの IoU を計算します。ボックスは (x1, y1, x2, y2)。
+    """
+    x1 = np.maximum(box_a[0], boxes[:, 0])
+    y1 = np.maximum(box_a[1], boxes[:, 1])
+    x2 = np.minimum(box_a[2], boxes[:, 2])
+    y2 = np.minimum(box_a[3], boxes[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    union = area_a + areas - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-6), 0.0)
+
+
+class Track:
+    """
+    フレームをまたいで追跡している 1 つの顔。認識結果 (名前と類似度) をキャッシュします。
+    """
+
+    def __init__(self, track_id: int, box: np.ndarray, now: float) -> None:
+        self.track_id = track_id
+        self.box = np.asarray(box, dtype=np.float32)
+        self.velocity = np.zeros(4, dtype=np.float32)  # 1 秒あたりのボックスの変化量
+        self.last_seen = now
+        self.misses = 0
+
+        self.name = "unknown"
+        self.score = 0.0
+        self.confidence = 0.0
+        self.identified_at: Optional[float] = None
+        self.pending_since: Optional[float] = None  # 認識を依頼して結果を待っている間の時刻
+
+    def predict(self, now: float) -> np.ndarray:
+        """
+        等速運動を仮定して現在時刻のボックスを予測します。
+        """
+        return self.box + self.velocity * (now - self.last_seen)
+
+    def update(self, box: np.ndarray, now: float, overlap: float) -> None:
+        box = np.asarray(box, dtype=np.float32)
+        dt = now - self.last_seen
+        if dt > 0:
+            # 速度は指数移動平均で滑らかにします
+            self.velocity = 0.5 * self.velocity + 0.5 * (box - self.box) / dt
+        self.box = box
+        self.last_seen = now
+        self.misses = 0
+        # 予測から大きくずれた対応付けは別人に入れ替わった可能性があるので信頼度を下げます
+        if overlap < STABLE_IOU:
+            self.confidence *= overlap
+
+
+class FaceTracker:
+    """
+    IoU と動き予測でフレーム間の顔を対応付け、認識結果を使い回すトラッカー。
+
+    新しいトラック、信頼度が下がったトラック、前回の認識から reidentify_interval 秒
+    以上経ったトラックだけを再認識の対象にします。
+    """
+
+    def __init__(self, iou_threshold: float = 0.3, max_misses: int = 10,
+                 reidentify_interval: float = 5.0, confidence_half_life: float = 10.0,
+                 min_confidence: float = 0.5, pending_timeout: float = 2.0) -> None:
+        self.iou_threshold = iou_threshold
+        self.pending_timeout = pending_timeout
+        self.max_misses = max_misses
+        self.reidentify_interval = reidentify_interval
+        self.confidence_half_life = confidence_half_life
+        self.min_confidence = min_confidence
+        self.tracks: List[Track] = []
+        self._next_id = 1
+
+    def update(self, boxes: Optional[np.ndarray], now: Optional[float] = None) -> List[Track]:
+        """
+        検出結果でトラックを更新します。
+
+        Args:
+            boxes (Optional[np.ndarray]): 現在フレームの顔のバウンディングボックス (x1, y1, x2, y2)
+            now (Optional[float]): 現在時刻 (省略時は time.monotonic())
+
+        Returns:
+            List[Track]: boxes と同じ順序で対応するトラック
+        """
+        now = time.monotonic() if now is None else now
+        boxes = np.empty((0, 4), dtype=np.float32) if boxes is None else np.asarray(boxes, dtype=np.float32)
+
+        assigned: List[Optional[Track]] = [None] * len(boxes)
+        if len(self.tracks) > 0 and len(boxes) > 0:
+            predicted = np.stack([track.predict(now) for track in self.tracks])
+            overlaps = np.stack([iou(p, boxes) for p in predicted])  # (num_tracks, num_boxes)
+
+            # IoU の大きい順に貪欲に対応付けます
+            matched = set()
+            for flat in np.argsort(-overlaps, axis=None):
+                t, b = np.unravel_index(flat, overlaps.shape)
+                if overlaps[t, b] < self.iou_threshold:
+                    break
+                if assigned[b] is not None or t in matched:
+                    continue
+                self.tracks[t].update(boxes[b], now, float(overlaps[t, b]))
+                assigned[b] = self.tracks[t]
+                matched.add(t)
+
+        matched_ids = {id(track) for track in assigned if track is not None}
+        for track in self.tracks:
+            if id(track) not in matched_ids:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+        for b, track in enumerate(assigned):
+            if track is None:
+                track = Track(self._next_id, boxes[b], now)
+                self._next_id += 1
+                self.tracks.append(track)
+                assigned[b] = track
+
+        return assigned
+
+    def needs_identification(self, track: Track, now: Optional[float] = None) -> bool:
+        """
+        トラックに対して顔認識をやり直す必要があるかを判定します。
+        """
+        now = time.monotonic() if now is None else now
+        if track.pending_since is not None and now - track.pending_since < self.pending_timeout:
+            # 別のフレームで認識中の結果を待ちます
+            return False
+        if track.identified_at is None:
+            return True
+        elapsed = now - track.identified_at
+        if elapsed >= self.reidentify_interval:
+            return True
+        decayed = track.confidence * 0.5 ** (elapsed / self.confidence_half_life)
+        return decayed < self.min_confidence
+
+    def mark_pending(self, track: Track, now: Optional[float] = None) -> None:
+        """
+        トラックの認識を依頼したことを記録し、結果が届くまで重ねて依頼しないようにします。
+        """
+        track.pending_since = time.monotonic() if now is None else now
+
+    def assign(self, track: Track, name: str, score: float, now: Optional[float] = None) -> None:
+        """
+        顔認識の結果をトラックに記録します。
+        """
+        track.name = name
+        track.score = score
+        track.confidence = 1.0
+        track.pending_since = None
+        track.identified_at = time.monotonic() if now is None else now